@@ -24,7 +24,8 @@ __docformat__ = "restructuredtext en"
 
 #------------------------------------------------------------------------------
 
-import os, sys, tempfile, traceback, subprocess, time, shutil, Image, glob
+import os, sys, tempfile, traceback, subprocess, time, shutil, glob, re
+import hashlib, struct
 
 try:
     import scribus
@@ -49,6 +50,742 @@ main_widget = qApp.mainWidget()
 
 CWD = os.getcwd()
 
+# Resolution of PNG images at scale 1
+DPI = 600.0
+
+# Whether new objects are placed as vector PDF instead of PNG
+VECTOR = False
+
+#------------------------------------------------------------------------------
+# Render cache
+#------------------------------------------------------------------------------
+
+# Output types: PNG through dvipng, or vector PDF through pdflatex
+IMAGE_EXTENSIONS = ['png', 'pdf']
+
+if sys.platform.startswith('win'):
+    GS = 'gswin32c'
+else:
+    GS = 'gs'
+
+def get_cache_dir():
+    """Return the directory where the rendered images are cached"""
+    if sys.platform.startswith('win'):
+        base = os.environ.get('APPDATA', os.path.expanduser("~"))
+        return os.path.join(base, "Scribus", "textext-cache")
+    return os.path.expanduser("~/.scribus/textext-cache")
+
+def read_preamble(filename):
+    """Return the contents of the preamble file, or "" if there is none"""
+    if not os.path.isfile(filename):
+        return ""
+    f = open(filename, 'r')
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+def read_png_size(filename):
+    """
+    Return the (width, height) of a PNG image in pixels, read from its
+    header without decoding the image.
+    """
+    f = open(filename, 'rb')
+    try:
+        head = f.read(24)
+    finally:
+        f.close()
+    if (len(head) < 24 or head[:8] != '\x89PNG\r\n\x1a\n'
+            or head[12:16] != 'IHDR'):
+        raise RuntimeError("%s is not a PNG image" % filename)
+    return struct.unpack('>II', head[16:24])
+
+class ImageCache(object):
+    """
+    Persistent on-disk cache of rendered images, shared by all
+    documents.
+
+    Each entry is an image file named after a hash of everything that
+    affects the rendering, with its size stored alongside: in pixels
+    for PNG images, in points for PDF.
+    When the total size of the entries exceeds `max_size` bytes, the
+    least recently used ones are evicted. A `max_size` of zero
+    disables the cache.
+    """
+
+    DEFAULT_MAX_SIZE = 50*1024*1024
+
+    def __init__(self, path=None, max_size=DEFAULT_MAX_SIZE):
+        if path is None:
+            path = get_cache_dir()
+        self.path = path
+        self.max_size = max_size
+
+    def key(self, preamble, text, *options):
+        """
+        Return the cache key for rendering `text` with the `preamble`
+        contents, and the rendering `options` (output type, scale,
+        resolution).
+        """
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        return hashlib.md5("\0".join([preamble, text] +
+                                     [repr(x) for x in options])).hexdigest()
+
+    def get(self, key, ext='png'):
+        """
+        :Returns: (file name, (width, height)) for `key`, or None
+                  if not cached
+        """
+        if not self.max_size:
+            return None
+
+        filename = self._filename(key, ext)
+        try:
+            f = open(filename + '.size', 'r')
+            try:
+                size = tuple([float(x) for x in f.read().split()])
+            finally:
+                f.close()
+            # Mark the entry as recently used
+            os.utime(filename, None)
+        except (IOError, OSError, ValueError):
+            return None
+        if len(size) != 2:
+            return None
+        return filename, size
+
+    def put(self, key, image_file, size, ext='png'):
+        """
+        Store a copy of `image_file`, of the given `size`, under `key`,
+        evicting old entries if needed.
+        """
+        if not self.max_size:
+            return
+
+        filename = self._filename(key, ext)
+        tmp_filename = "%s.%d.tmp" % (filename, os.getpid())
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            shutil.copyfile(image_file, tmp_filename)
+            if os.path.exists(filename):
+                os.remove(filename)
+            os.rename(tmp_filename, filename)
+
+            # The size is written last: entries without one are ignored
+            f = open(filename + '.size', 'w')
+            try:
+                f.write("%r %r\n" % tuple(size))
+            finally:
+                f.close()
+        except (IOError, OSError):
+            # The cache is best-effort only
+            if os.path.isfile(tmp_filename):
+                os.remove(tmp_filename)
+            return
+
+        self._evict()
+
+    def _filename(self, key, ext):
+        return os.path.join(self.path, '%s.%s' % (key, ext))
+
+    def _evict(self):
+        """Remove least recently used entries until within `max_size`"""
+        entries = []
+        total = 0
+        filenames = []
+        for ext in IMAGE_EXTENSIONS:
+            filenames += glob.glob(os.path.join(self.path, '*.' + ext))
+        for filename in filenames:
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, filename))
+            total += st.st_size
+
+        entries.sort()
+        while total > self.max_size and entries:
+            mtime, size, filename = entries.pop(0)
+            # The size file goes first, so that a half-removed entry is
+            # ignored; either file may already be gone
+            for name in (filename + '.size', filename):
+                try:
+                    os.remove(name)
+                except OSError:
+                    pass
+            if not os.path.exists(filename):
+                total -= size
+
+image_cache = ImageCache()
+
+#------------------------------------------------------------------------------
+# Image bookkeeping
+#------------------------------------------------------------------------------
+
+IMAGE_PREFIX = 'latex-image-'
+
+def get_all_objects():
+    """Return the names of the objects on all pages of the document"""
+    current = scribus.currentPage()
+    names = []
+    try:
+        for page in range(1, scribus.pageCount() + 1):
+            scribus.gotoPage(page)
+            names.extend(scribus.getAllObjects())
+    finally:
+        scribus.gotoPage(current)
+    return names
+
+class ImageIndex(object):
+    """
+    Names of the TexText images in the document and of the image files
+    in the working directory, looked up from a single enumeration of
+    the document instead of asking Scribus about each name in turn.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.objects = set()
+        self.files = set()
+        self.next_number = 0
+        self.refresh()
+
+    def refresh(self):
+        """Enumerate the document objects and the image files again"""
+        self.objects = set([name for name in get_all_objects()
+                            if name.startswith(IMAGE_PREFIX)])
+        self.files = set()
+        for ext in IMAGE_EXTENSIONS:
+            pattern = os.path.join(self.path, IMAGE_PREFIX + '*.' + ext)
+            for filename in glob.glob(pattern):
+                name = os.path.basename(filename)
+                self.files.add(name[:-len(ext)-1])
+
+        self.next_number = 0
+        for name in self.objects | self.files:
+            try:
+                number = int(name[len(IMAGE_PREFIX):])
+            except ValueError:
+                continue
+            self.next_number = max(self.next_number, number + 1)
+
+    def new_name(self):
+        """Return a name not used by any image object or image file"""
+        name = '%s%d' % (IMAGE_PREFIX, self.next_number)
+        try:
+            # Objects may have been added behind our back
+            scribus.getImageFile(name)
+            self.refresh()
+            name = '%s%d' % (IMAGE_PREFIX, self.next_number)
+        except scribus.NoValidObjectError:
+            pass
+        self.next_number += 1
+        self.objects.add(name)
+        self.files.add(name)
+        return name
+
+    def dead_images(self):
+        """Return the names of image files without an image object"""
+        return self.files - self.objects
+
+    def remove(self, name, keep=None):
+        """
+        Remove the files of the image `name`, except the image file
+        `keep`.
+        """
+        for ext in IMAGE_EXTENSIONS:
+            filename = os.path.join(self.path, '%s.%s' % (name, ext))
+            if keep is not None and filename == os.path.abspath(keep):
+                continue
+            for fn in [filename, filename + '.info']:
+                if os.path.exists(fn):
+                    os.remove(fn)
+        if keep is None:
+            self.files.discard(name)
+
+_image_index = None
+
+def get_image_index(path=None):
+    """Return the ImageIndex for `path`, by default the working directory"""
+    global _image_index
+    if path is None:
+        path = CWD
+    path = os.path.abspath(unicode(path))
+    if _image_index is None or _image_index.path != path:
+        _image_index = ImageIndex(path)
+    return _image_index
+
+#------------------------------------------------------------------------------
+# Background rendering
+#------------------------------------------------------------------------------
+
+GS_BBOX_RE = re.compile(r'%%HiResBoundingBox:\s*(\S+)\s+(\S+)\s+(\S+)\s+(\S+)')
+LATEX_PAGES_RE = re.compile(r'Output written on .*?\((\d+) pages?', re.S)
+
+# Saves the values of the counters in \textextcounters, for setting them
+# back before each snippet of a shared Latex run
+SNIPPET_SETUP = r"""\begingroup\makeatletter
+\def\@elt#1{\noexpand\setcounter{#1}{\the\value{#1}}}%
+\xdef\textextcounters{\cl@@ckpt}%
+\endgroup"""
+
+# Snippets doing any of this affect the ones after them even in a group
+GLOBAL_DEF_RE = re.compile(r'\\(?:[gx]def|global|new(?:counter|length|'
+                           r'savebox|if|toks|count|dimen|skip|box|read|'
+                           r'write|font))(?![A-Za-z])')
+
+def cpu_count():
+    """Return the number of processors, or 1 if it cannot be found out"""
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+class ImageInfo(object):
+    """
+    What a TexText image is made from, as saved in the ``.info`` file
+    next to the image.
+    """
+
+    def __init__(self, name, path, text=u"", preamble=u"", scale=1.0,
+                 vector=False):
+        """
+        :Parameters:
+          - `name`: name of the Scribus image object
+          - `path`: working directory, where the image files are
+          - `text`: Latex code
+          - `preamble`: preamble file name, relative to `path`
+          - `scale`: scale factor
+          - `vector`: whether the image is a PDF instead of PNG
+        """
+        self.name = name
+        self.path = path
+        self.text = text
+        self.preamble = preamble
+        self.scale = scale
+        self.vector = vector
+
+    def load(cls, name, path):
+        """
+        Load the information for the image `name` in `path`.
+
+        :Returns: ImageInfo, or None if there is no ``.info`` file
+        """
+        for ext in IMAGE_EXTENSIONS:
+            info_name = os.path.join(path, '%s.%s.info' % (name, ext))
+            if os.path.exists(info_name):
+                break
+        else:
+            return None
+
+        f = open(info_name, 'r')
+        try:
+            preamble = f.readline().strip().decode('utf-8')
+            scale = float(f.readline().strip())
+            text = f.read().decode('utf-8')
+        finally:
+            f.close()
+        return cls(name, path, text, preamble, scale, ext == 'pdf')
+    load = classmethod(load)
+
+    def save(self):
+        f = open(self.get_image_file() + '.info', 'w')
+        try:
+            f.write("%s\n" % self.preamble.encode('utf-8'))
+            f.write("%g\n" % self.scale)
+            f.write(self.text.encode('utf-8'))
+        finally:
+            f.close()
+
+    def get_ext(self):
+        if self.vector:
+            return 'pdf'
+        return 'png'
+
+    def get_image_file(self):
+        return os.path.join(self.path, '%s.%s' % (self.name, self.get_ext()))
+
+    def get_dpi(self):
+        """Return the resolution of PNG images"""
+        return DPI*self.scale
+
+    def read_preamble(self):
+        return read_preamble(os.path.join(self.path, self.preamble))
+
+    def get_group_key(self, preamble_text):
+        """
+        Return a key that is the same for images that can be typeset
+        in the same Latex run, or None if the image needs its own.
+        """
+        if self.vector:
+            # pdfcrop can't crop each page to its own bounding box
+            return None
+        if GLOBAL_DEF_RE.search(self.text):
+            # Would leak into the images typeset after it
+            return None
+        return (preamble_text, self.get_dpi())
+
+    def get_cache_key(self, preamble_text):
+        if self.vector:
+            options = ('pdf',)
+        else:
+            options = ('png', float(self.scale), self.get_dpi())
+        return image_cache.key(preamble_text, self.text, *options)
+
+class RenderJob(object):
+    """
+    Rendering of a group of images sharing a preamble, each typeset
+    on its own page in a single Latex run. The external programs run
+    as child processes, one after another, and `poll` is called from
+    the GUI thread to advance to the next one, so that Scribus never
+    waits for them.
+    """
+
+    def __init__(self, infos, preamble):
+        """
+        :Parameters:
+          - `infos`: ImageInfos of the images, all with the same
+            `ImageInfo.get_group_key`
+          - `preamble`: preamble contents
+        """
+        self.infos = list(infos)
+        self.preamble = preamble
+        # The image on each page; infos may be discarded while rendering
+        self.pages = self.get_names()
+        self.vector = self.infos[0].vector
+        self.dpi = self.infos[0].get_dpi()
+        if self.vector and len(self.infos) != 1:
+            raise ValueError("PDF images must be rendered one by one")
+
+        # The result: {name: size in pixels or points}, or the error
+        self.sizes = {}
+        self.error = None
+        self.cancelled = False
+
+        self.path = tempfile.mkdtemp()
+        self.process = None
+        self.cmd = None
+        self.out = ""
+
+        texts = [info.text.encode('utf-8') for info in self.infos]
+        if len(texts) == 1:
+            body = texts[0]
+        else:
+            # Typeset each snippet as it would be alone: in a group, and
+            # with the counters set back
+            body = "%s\n%s" % (SNIPPET_SETUP,
+                "\n\\clearpage\n\\textextcounters\n\\noindent\n".join(
+                    ["\\begingroup\n%s\n\\endgroup" % t for t in texts]))
+        texwrapper = r"""
+        \documentclass[landscape,a0]{article}
+        %s
+        \pagestyle{empty}
+        \begin{document}
+        \noindent
+        %s
+        \end{document}
+        """ % (preamble, body)
+        f_tex = open(self.tmp('x.tex'), 'w')
+        try:
+            f_tex.write(texwrapper.strip())
+        finally:
+            f_tex.close()
+
+        self._steps = self._run()
+
+    def get_names(self):
+        return [info.name for info in self.infos]
+
+    def discard(self, name):
+        """
+        Don't place the image `name` when done; cancel the job if
+        there are no images left.
+        """
+        self.infos = [info for info in self.infos if info.name != name]
+        if not self.infos:
+            self.cancel()
+
+    def tmp(self, name):
+        return os.path.join(self.path, name)
+
+    def poll(self):
+        """
+        Start the next program if the previous one has finished.
+
+        :Returns: whether the job is done
+        """
+        while self._steps is not None:
+            if self.process is not None:
+                if self.process.poll() is None:
+                    return False
+                f = open(self.tmp('out.log'), 'r')
+                try:
+                    self.out = f.read()
+                finally:
+                    f.close()
+                if self.process.returncode != 0:
+                    self._finish(RuntimeError(
+                        "Command %s failed (code %d): %s"
+                        % (' '.join(self.cmd), self.process.returncode,
+                           self.out)))
+                    break
+                self.process = None
+            try:
+                self._steps.next()
+            except StopIteration:
+                self._finish(None)
+            except (RuntimeError, IOError, OSError), e:
+                self._finish(e)
+        return True
+
+    def cancel(self):
+        """Stop the job, killing the running program"""
+        self.cancelled = True
+        if self.process is not None and self.process.poll() is None:
+            try:
+                self.process.kill()
+                self.process.wait()
+            except OSError:
+                pass
+        self._finish(RuntimeError("Cancelled"))
+
+    def _run(self):
+        """The programs to run: yields each time one has been started"""
+        latexOpts = ['-interaction=nonstopmode']
+
+        if self.vector:
+            info = self.infos[0]
+            yield self._start(['pdflatex', self.tmp('x.tex')] + latexOpts)
+            if not os.path.exists(self.tmp('x.pdf')):
+                raise RuntimeError("pdflatex didn't produce output")
+
+            yield self._start([GS, '-q', '-dBATCH', '-dNOPAUSE',
+                               '-dLastPage=1', '-sDEVICE=bbox',
+                               self.tmp('x.pdf')])
+            m = GS_BBOX_RE.search(self.out)
+            if not m:
+                raise RuntimeError("No bounding box from %s: %s"
+                                   % (GS, self.out))
+            x0, y0, x1, y1 = [float(x) for x in m.groups()]
+
+            # Pass on the bounding box, so that pdfcrop needn't
+            # compute it again
+            yield self._start(['pdfcrop', '--bbox',
+                               '%f %f %f %f' % (x0, y0, x1, y1),
+                               self.tmp('x.pdf'), self.tmp('x-crop.pdf')])
+            if not os.path.exists(self.tmp('x-crop.pdf')):
+                raise RuntimeError("pdfcrop didn't produce output")
+
+            shutil.copy(self.tmp('x-crop.pdf'), info.get_image_file())
+            self.sizes[info.name] = (x1 - x0, y1 - y0)
+            return
+
+        yield self._start(['latex', self.tmp('x.tex')] + latexOpts)
+        if not os.path.exists(self.tmp('x.dvi')):
+            raise RuntimeError("latex didn't produce output")
+        if len(self.pages) > 1:
+            # A snippet taking more or less than a page would shift the
+            # others onto the wrong images
+            m = LATEX_PAGES_RE.search(self.out)
+            if m is None or int(m.group(1)) != len(self.pages):
+                raise RuntimeError("latex produced %s pages for %d images"
+                                   % (m and m.group(1) or "no",
+                                      len(self.pages)))
+
+        # All pages at once, to x1.png, x2.png, ...
+        yield self._start(['dvipng', '-D', '%d' % self.dpi,
+                           '-o', self.tmp('x%d.png'),
+                           '-T', 'tight', self.tmp('x.dvi')])
+
+        for info in self.infos:
+            page = self.pages.index(info.name)
+            png = self.tmp('x%d.png' % (page + 1))
+            if not os.path.exists(png):
+                raise RuntimeError("dvipng didn't produce output")
+            shutil.copy(png, info.get_image_file())
+            self.sizes[info.name] = read_png_size(png)
+
+    def _start(self, cmd):
+        # The output goes to a file: a pipe could fill up while the
+        # program is not being polled
+        log = open(self.tmp('out.log'), 'w')
+        try:
+            self.process = subprocess.Popen(cmd, cwd=self.path,
+                                            stdout=log,
+                                            stderr=subprocess.STDOUT,
+                                            stdin=subprocess.PIPE)
+        finally:
+            log.close()
+        self.process.stdin.close()
+        self.cmd = cmd
+
+    def _finish(self, error):
+        self.error = error
+        self.process = None
+        self._steps = None
+        shutil.rmtree(self.path, True)
+
+class RenderQueue(object):
+    """
+    Render jobs in progress, polled with a timer in the GUI thread.
+    Up to `max_running` jobs render at the same time.
+    """
+
+    POLL_INTERVAL = 100 # ms
+
+    def __init__(self, parent, max_running=None):
+        self.max_running = max_running or cpu_count()
+        self.running = []
+        self.waiting = []
+        self.timer = QTimer(parent)
+        QObject.connect(self.timer, SIGNAL("timeout()"), self.poll)
+
+    def add(self, job, callback):
+        """
+        Queue `job`, and call `callback(job)` when it is done. Jobs
+        still in progress stop rendering the same images.
+        """
+        for name in job.get_names():
+            self.discard(name)
+        self.waiting.append((job, callback))
+        self.poll()
+        if not self.timer.isActive():
+            self.timer.start(self.POLL_INTERVAL)
+
+    def discard(self, name):
+        """
+        Stop rendering the image `name` in the jobs in progress, so that
+        they don't place it when done.
+        """
+        for entry in self.running + self.waiting:
+            entry[0].discard(name)
+        self.waiting = [entry for entry in self.waiting
+                        if not entry[0].cancelled]
+
+    def poll(self):
+        finished = []
+        while True:
+            running = []
+            for entry in self.running:
+                if entry[0].poll():
+                    finished.append(entry)
+                else:
+                    running.append(entry)
+            self.running = running
+            if not self.waiting or len(self.running) >= self.max_running:
+                break
+            self.running.append(self.waiting.pop(0))
+
+        if not self.running and not self.waiting:
+            self.timer.stop()
+
+        for job, callback in finished:
+            if not job.cancelled:
+                callback(job)
+
+_render_queue = None
+
+def get_render_queue():
+    global _render_queue
+    if _render_queue is None:
+        _render_queue = RenderQueue(main_widget)
+    return _render_queue
+
+def render_images(infos):
+    """
+    Render the images `infos` and place them when done, reusing cached
+    images. Images sharing a preamble are typeset together, and the
+    groups render in parallel.
+    """
+    queue = get_render_queue()
+    groups = {}
+    group_order = []
+    preambles = {}
+    for info in infos:
+        if info.preamble not in preambles:
+            preambles[info.preamble] = info.read_preamble()
+        preamble_text = preambles[info.preamble]
+        key = info.get_cache_key(preamble_text)
+        cached = image_cache.get(key, info.get_ext())
+        if cached is not None:
+            # An older rendering still in progress would overwrite it
+            queue.discard(info.name)
+            shutil.copyfile(cached[0], info.get_image_file())
+            place_image(info, cached[1])
+            continue
+
+        group_key = info.get_group_key(preamble_text)
+        if group_key is None:
+            group_key = ('single', info.name)
+        if group_key not in groups:
+            groups[group_key] = (preamble_text, [])
+            group_order.append(group_key)
+        groups[group_key][1].append(info)
+
+    for group_key in group_order:
+        preamble_text, group = groups[group_key]
+        queue.add(RenderJob(group, preamble_text), _render_done)
+
+def _render_done(job):
+    if job.error is not None:
+        if len(job.pages) > 1:
+            # A single bad snippet spoils a shared Latex run: render
+            # the images one by one instead
+            queue = get_render_queue()
+            for info in job.infos:
+                queue.add(RenderJob([info], job.preamble), _render_done)
+            return
+        scribus.messageBox("Error", "Rendering %s failed:\n%s"
+                           % (job.infos[0].name, job.error),
+                           scribus.ICON_WARNING)
+        return
+
+    for info in job.infos:
+        size = job.sizes[info.name]
+        image_cache.put(info.get_cache_key(job.preamble),
+                        info.get_image_file(), size, info.get_ext())
+        place_image(info, size)
+
+def place_image(info, size):
+    """
+    Load the rendered image of `size` pixels (PNG) or points (PDF) to
+    its object, and save the information for editing it later.
+    """
+    img = info.name
+    img_file = info.get_image_file()
+    try:
+        scribus.getImageFile(img)
+    except scribus.NoValidObjectError:
+        # Deleted while rendering
+        return
+
+    # Drop the files left over from the other output type; the working
+    # directory may have changed since the image was rendered
+    if img.startswith(IMAGE_PREFIX):
+        get_image_index(info.path).remove(img, keep=img_file)
+
+    # Size in millimetres
+    w, h = size
+    if info.vector:
+        w = w*info.scale*25.4/72
+        h = h*info.scale*25.4/72
+    else:
+        w = w*25.4/DPI
+        h = h*25.4/DPI
+
+    info.save()
+
+    scribus.setUnit(scribus.UNIT_MILLIMETERS)
+    scribus.loadImage(img_file, img)
+    scribus.setScaleImageToFrame(True, True, img)
+    x, y = scribus.getPosition(img)
+    scribus.sizeObject(x + w, y + h, img)
+
+#------------------------------------------------------------------------------
+# Dialog
 #------------------------------------------------------------------------------
 
 class LatexDialog(QDialog):
@@ -62,6 +799,7 @@ class LatexDialog(QDialog):
         self.cwd      = QLineEdit(self)
         self.preamble = QLineEdit(self)
         self.scale    = QSpinBox(0.1, 10, 1, self)
+        self.vector   = QCheckBox("Vector output (PDF)", self)
         self.text     = QMultiLineEdit(self)
         self.ok       = QPushButton("OK", self)
         self.cancel   = QPushButton("Cancel", self)
@@ -70,6 +808,7 @@ class LatexDialog(QDialog):
         self.text.setText(text)
         self.preamble.setText(preamble_file)
         self.scale.setValue(scale_factor)
+        self.vector.setChecked(VECTOR)
         
         layout = QVBoxLayout(self)
         layout_btn = QHBoxLayout(None)
@@ -77,6 +816,7 @@ class LatexDialog(QDialog):
         layout.addWidget(self.cwd)
         layout.addWidget(self.preamble)
         layout.addWidget(self.scale)
+        layout.addWidget(self.vector)
         layout.addWidget(self.text)
 
         layout_btn.addWidget(self.ok)
@@ -89,166 +829,66 @@ class LatexDialog(QDialog):
         self.fetch_info()
 
     def get_new_image_name(self):
-        count = 0
-        while True:
-            name = 'latex-image-%d' % count
-            try:
-                scribus.getImageFile(name)
-            except scribus.NoValidObjectError:
-                return name
-            count += 1
+        return get_image_index().new_name()
 
     def fetch_info(self):
         try:
             name = scribus.getImageFile()
-            info_name = '%s.info' % name
-
-            if os.path.exists(info_name):
-                f = open(info_name, 'r')
-                try:
-                    preamble = f.readline().strip()
-                    scale = float(f.readline().strip())
-                    text = f.read()
-
-                    self.text.setText(text)
-                    self.scale.setValue(scale)
-                    self.preamble.setText(preamble)
-                finally:
-                    f.close()
         except scribus.NoValidObjectError:
             return
 
-    def slotOkClicked(self):
-        global CWD
+        path, filename = os.path.split(name)
+        info = ImageInfo.load(os.path.splitext(filename)[0], path)
+        if info is not None:
+            self.text.setText(info.text)
+            self.scale.setValue(info.scale)
+            self.preamble.setText(info.preamble)
+            self.vector.setChecked(info.vector)
 
-        text = self.text.text()
-        preamble = self.preamble.text()
-        scale = self.scale.value()
-        CWD = self.cwd.text()
+    def slotOkClicked(self):
+        global CWD, VECTOR
 
-        DPI = 600.0
-        os.chdir(CWD)
+        CWD = unicode(self.cwd.text())
+        VECTOR = self.vector.isChecked()
 
         try:
             img = scribus.getSelectedObject()
             scribus.getImageFile(img)
         except scribus.NoValidObjectError:
+            # The empty frame stands in for the image until it is ready
             img = self.get_new_image_name()
             scribus.createImage(0, 0, 10, 10, img)
 
-        img_file = os.path.abspath('%s.png' % img)
-        self.generate_latex(text, preamble, scale, img_file, DPI*scale)
-
-        info = open(img_file + '.info', 'w')
-        info.write("%s\n" % preamble)
-        info.write("%g\n" % scale)
-        info.write(text)
-        info.close()
-
-        x = Image.open(img_file, 'r')
-        w, h = x.size
-        del x
-
-        scribus.setUnit(scribus.UNIT_MILLIMETERS)
-        scribus.loadImage(img_file, img)
-        scribus.setScaleImageToFrame(True, True, img)
-        x, y = scribus.getPosition(img)
-        scribus.sizeObject(x + w*25.4/DPI, y + h*25.4/DPI, img)
-        
+        info = ImageInfo(img, os.path.abspath(CWD),
+                         unicode(self.text.text()),
+                         unicode(self.preamble.text()),
+                         self.scale.value(), VECTOR)
+        render_images([info])
         self.accept()
 
-    def generate_latex(self, text, preamble, scale, output, dpi):
-        if os.path.isfile(preamble):
-            f = open(preamble, 'r')
-            try:
-                preamble = f.read()
-            finally:
-                f.close()
-        else:
-            preamble = ""
-        
-        latexOpts = ['-interaction=nonstopmode']
-        texwrapper = r"""
-        \documentclass[landscape,a0]{article}
-        %s
-        \pagestyle{empty}
-        \begin{document}
-        \noindent
-        %s
-        \end{document}
-        """ % (preamble, text)
-
-        path = tempfile.mkdtemp()
-        cwd = os.getcwd()
-        os.chdir(path)
-
-        def tmp(name):
-            return os.path.join(path, name)
-
-        # Convert TeX to SVG
-        try:
-            # Write tex
-            f_tex = open(tmp('x.tex'), 'w')
-            try:
-                f_tex.write(texwrapper.strip())
-            finally:
-                f_tex.close()
-
-            self.exec_command(['latex', tmp('x.tex')] + latexOpts)
-            if not os.path.exists(tmp('x.dvi')):
-                raise RuntimeError("latex didn't produce output")
-
-            self.exec_command(['dvipng', '-D', '%d' % dpi, '-o', tmp('x.png'),
-                               '-T', 'tight', tmp('x.dvi')])
-            if not os.path.exists(tmp('x.png')):
-                raise RuntimeError("dvipng didn't produce output")
-
-            os.chdir(cwd)
-            shutil.copy(tmp('x.png'), output)
-        finally:
-            os.chdir(cwd)
-            self.remove_temp_files(path)
-
-    def exec_command(self, cmd):
-        """Run given command, check return value"""
-        p = subprocess.Popen(cmd,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE,
-                             stdin=subprocess.PIPE)
-        out, err = p.communicate()
-        if p.returncode != 0:
-            raise RuntimeError("Command %s failed (code %d): %s%s"
-                               % (' '.join(cmd), p.returncode, out, err))
-    
-    def remove_temp_files(self, path):
-        """Remove files made in /tmp"""
-        for filename in ['x.tex', 'x.log', 'x.aux', 'x.pdf', 'x.svg',
-                         'x.pdf.sk', 'x.eps', 'x.dvi', 'x.ps', 'x.png']:
-            self.try_remove(os.path.join(path, filename))
-        self.try_remove(path)
-
-    def try_remove(self, filename):
-        """Try to remove given file, skipping if not exists."""
-        if os.path.isfile(filename):
-            os.remove(filename)
-        elif os.path.isdir(filename):
-            os.rmdir(filename)
-
 def cleanup_dead_images(self):
-    os.chdir(CWD)
-    files = glob.glob('latex-image-*.png')
-    for filename in files:
-        imgname = filename[:-4]
+    index = get_image_index()
+    index.refresh()
+    for name in index.dead_images():
+        index.remove(name)
+
+def regenerate_all_images(self):
+    """Render all the images in the document again, e.g. after the
+    preamble has changed"""
+    index = get_image_index()
+    index.refresh()
+    infos = []
+    for name in sorted(index.objects):
+        # The .info file is next to the image, which need not be in the
+        # working directory
         try:
-            img_file = scribus.getImageFile(imgname)
-            continue
+            path = os.path.dirname(scribus.getImageFile(name))
         except scribus.NoValidObjectError:
-            pass
-        
-        if os.path.exists(filename):
-            os.remove(filename)
-        if os.path.exists(filename + '.info'):
-            os.remove(filename + '.info')
+            continue
+        info = ImageInfo.load(name, path or index.path)
+        if info is not None:
+            infos.append(info)
+    render_images(infos)
 
 def insert_latex_object():
     main_widget = qApp.mainWidget()
@@ -276,6 +916,7 @@ def main(argv):
     menu = get_extension_menu()
     menu.insertItem("Insert/modify LaTeX object", insert_latex_object)
     menu.insertItem("Clean up dead LaTeX images", cleanup_dead_images)
+    menu.insertItem("Regenerate all LaTeX images", regenerate_all_images)
 
 if __name__ == "__main__":
     main(sys.argv[1:])
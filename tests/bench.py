@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the Python side of TexText.
+
+By default the LaTeX tools are replaced by stand-in executables that
+emit canned PDF and SVG output, of configurable size and latency, so
+that the numbers measure the overhead of TexText itself:
+
+    python bench.py [--sizes=1,10,100,1000,10000] [--segments=N]
+                    [--latency=SECONDS] [--cases=effect,replace_node,...]
+                    [--converter=NAME] [--real] [--json=FILE]
+
+With --real, the tools found on PATH are used instead.
+
+Each case runs in a fresh process, so that the reported peak memory
+(ru_maxrss) belongs to that case alone. The size is the number of
+objects in the document, or of glyphs in the converted SVG.
+"""
+import os, sys, time, tempfile, shutil, optparse, resource, copy
+try:
+    import json
+except ImportError:
+    json = None
+
+BASEDIR = os.path.abspath(os.path.dirname(__file__))
+TEST_FILE = os.path.join(BASEDIR, 'base.svg')
+
+sys.path.append(os.path.join(BASEDIR, '..'))
+
+CASES = ['probe', 'svg_to_group', 'replace_node', 'effect', 'effect_edit',
+         'batch']
+
+# Cases that start processes for each item are run only up to this size
+MAX_SIZES = {'probe': 100, 'batch': 100}
+
+#------------------------------------------------------------------------------
+# Stand-in executables
+#------------------------------------------------------------------------------
+
+FAKE_COMMON = r'''
+import sys, os, time, re
+time.sleep(float(os.environ.get('TEXTEXT_BENCH_LATENCY', '0')))
+SEGMENTS = int(os.environ.get('TEXTEXT_BENCH_SEGMENTS', '8'))
+
+def glyph_path(i, bold=False):
+    d = ['M %d.%d,0.5' % (i, bold and 75 or 25)]
+    for k in range(SEGMENTS):
+        d.append('C %d.1,%d.2 %d.3,%d.4 %d.5,%d.6' % (i, k, i, k, i, k))
+    d.append('Z')
+    return ' '.join(d)
+
+def get_body(src):
+    return src.split('\\begin{document}')[-1].split('\\end{document}')[0]
+
+def get_pages(src):
+    return re.split(r'\\(?:newpage|clearpage)', get_body(src))
+
+def page_words(pdf, page):
+    """
+    The words on `page`, as (word, bold) pairs. \\bfseries makes the
+    rest of the \\begingroup ... \\endgroup bold, across pages too.
+    """
+    body = get_body(open(pdf).read())
+    pages = [[]]
+    bold = [False]
+    for token in re.findall(r'\\[A-Za-z@]+|[A-Za-z]\w*', body):
+        if token in ('\\newpage', '\\clearpage'):
+            pages.append([])
+        elif token == '\\begingroup':
+            bold.append(bold[-1])
+        elif token == '\\endgroup' and len(bold) > 1:
+            bold.pop()
+        elif token == '\\bfseries':
+            bold[-1] = True
+        elif not token.startswith('\\'):
+            pages[-1].append((token, bold[-1]))
+    if page > len(pages):
+        return []
+    return pages[page-1]
+
+def write_svg(filename, words):
+    out = ['<?xml version="1.0" encoding="UTF-8"?>\n'
+           '<svg xmlns="http://www.w3.org/2000/svg" '
+           'xmlns:xlink="http://www.w3.org/1999/xlink" width="100pt" '
+           'height="20pt" viewBox="0 0 100 20" version="1.1">\n<defs>\n<g>\n']
+    for i in range(len(words)):
+        out.append('<symbol overflow="visible" id="glyph0-%d">'
+                   '<path style="stroke:none;" d="%s"/></symbol>\n'
+                   % (i, glyph_path(i, words[i][1])))
+    out.append('</g>\n<clipPath id="clip1">'
+               '<path d="M 0 0 L 100 0 L 100 20 Z"/>'
+               '</clipPath>\n</defs>\n<g id="surface1">\n'
+               '<g clip-path="url(#clip1)" style="fill:rgb(0%,0%,0%);">\n')
+    for i in range(len(words)):
+        out.append('<use xlink:href="#glyph0-%d" x="%d" y="10"/>\n'
+                   % (i, 5*i))
+    out.append('</g>\n</g>\n</svg>\n')
+    open(filename, 'w').write(''.join(out))
+'''
+
+# Installed as latex too, writing DVI instead of PDF
+FAKE_PDFLATEX = FAKE_COMMON + r'''
+args = sys.argv[1:]
+output = 'pdf'
+if os.path.basename(sys.argv[0]) == 'latex':
+    output = 'dvi'
+tex = [a for a in args if a.endswith('.tex')]
+if not tex:
+    print("pdfTeX 3.1415926 (fake)")
+    sys.exit(0)
+
+def opt(name, default=None):
+    for a in args:
+        if a.startswith(name + '='):
+            return a.split('=', 1)[1]
+    return default
+
+src = open(tex[0]).read()
+if '\\read16' in src:
+    # resident worker driver: the body file name comes from stdin
+    name = sys.stdin.readline().strip()
+    if not name:
+        sys.exit(1)
+    src += open(name).read()
+base = opt('-jobname', os.path.splitext(os.path.basename(tex[0]))[0])
+outdir = opt('-output-directory', '.')
+if '-ini' in args:
+    open(os.path.join(outdir, base + '.fmt'), 'w').write(src)
+    sys.exit(0)
+fmt = opt('-fmt')
+if fmt is not None:
+    src = open(fmt + '.fmt').read() + src
+open(os.path.join(outdir, base + '.' + output), 'w').write(
+    '%' + output.upper() + '-fake\n' + src)
+open(os.path.join(outdir, base + '.log'), 'w').write('fake log\n')
+print("Output written on %s.%s (%d pages, %d bytes)."
+      % (base, output, len(get_pages(src)), len(src)))
+'''
+
+FAKE_PDF2SVG = FAKE_COMMON + r'''
+if len(sys.argv) < 3:
+    sys.exit(254)
+page = 1
+if len(sys.argv) > 3:
+    page = int(sys.argv[3])
+write_svg(sys.argv[2], page_words(sys.argv[1], page))
+'''
+
+FAKE_DVISVGM = FAKE_COMMON + r'''
+args = sys.argv[1:]
+if '--version' in args:
+    print("dvisvgm 2.8.1 (fake)")
+    sys.exit(0)
+page, output = 1, None
+for a in args:
+    if a.startswith('--page='):
+        page = int(a.split('=', 1)[1])
+    elif a.startswith('--output='):
+        output = a.split('=', 1)[1]
+write_svg(output, page_words(args[-1], page))
+'''
+
+FAKE_PSTOEDIT = FAKE_COMMON + r'''
+args = sys.argv[1:]
+if '-help' in args or len(args) < 4:
+    sys.stderr.write("pstoedit: version 3.50 (fake)\n"
+                     "available formats:\n\tplot-svg: SVG via plotutils\n")
+    sys.exit(1)
+k = args.index('-f')
+words = page_words(args[k+2], 1)
+out = ['<?xml version="1.0" encoding="UTF-8"?>\n'
+       '<svg xmlns="http://www.w3.org/2000/svg" version="1.1" '
+       'width="8.5in" height="11in" viewBox="0 0 1 1">\n'
+       '<g transform="translate(0,1) scale(1,-1)" stroke="black">\n']
+for i in range(len(words)):
+    out.append('<path d="%s" style="fill:black"/>\n'
+               % glyph_path(i, words[i][1]))
+out.append('</g>\n</svg>\n')
+open(args[k+3], 'w').write(''.join(out))
+'''
+
+def install_fakes(path):
+    """Write the stand-in executables to `path`"""
+    for name, src in [('pdflatex', FAKE_PDFLATEX), ('latex', FAKE_PDFLATEX),
+                      ('pdf2svg', FAKE_PDF2SVG), ('dvisvgm', FAKE_DVISVGM),
+                      ('pstoedit', FAKE_PSTOEDIT)]:
+        filename = os.path.join(path, name)
+        f = open(filename, 'w')
+        try:
+            f.write('#!%s\n%s' % (sys.executable, src))
+        finally:
+            f.close()
+        os.chmod(filename, 0755)
+
+#------------------------------------------------------------------------------
+# Benchmark cases
+#------------------------------------------------------------------------------
+
+def make_text(size):
+    """LaTeX source producing `size` glyphs"""
+    return ' '.join(['x'] * size)
+
+def make_document(textext, filename, size):
+    """Write a document with `size` TexText objects to `filename`"""
+    from lxml import etree
+    tree = etree.parse(TEST_FILE)
+    root = tree.getroot()
+    glyph = '<path d="M 0,0 C 1,2 3,4 5,6 Z"/>'
+    for i in xrange(size):
+        node = etree.fromstring(
+            '<g xmlns="%s" id="tt%d" transform="translate(%d,0)">%s</g>'
+            % (textext.SVG_NS, i, 10*i, glyph))
+        node.attrib['{%s}text' % textext.TEXTEXT_NS] = '$x_{%d}$' % i
+        node.attrib['{%s}preamble' % textext.TEXTEXT_NS] = ''
+        node.attrib['{%s}page_width' % textext.TEXTEXT_NS] = ''
+        root.append(node)
+    tree.write(filename)
+
+def run_effect(textext, filename, args):
+    effect = textext.TexText()
+    effect.converter_kw['cache'] = None
+    effect.affect(['--text-to-path'] + args + [filename], output=False)
+    return effect
+
+def bench_probe(textext, size, tmp):
+    info = textext.ConvertInfo()
+    start = time.time()
+    for i in xrange(size):
+        info._probed = {}
+        info._find_converters()
+    return time.time() - start
+
+def bench_svg_to_group(textext, size, tmp):
+    info = textext.ConvertInfo()
+    info.load_from_settings(textext.Settings())
+    info.text = make_text(size)
+    converter = textext.CONVERTERS[0](None)
+    try:
+        converter.tex_to_pdf(info)
+        converter.pdf_to_svg()
+        converter.hash = info.hash()
+        start = time.time()
+        converter.svg_to_group()
+        return time.time() - start
+    finally:
+        converter.finish()
+
+def bench_replace_node(textext, size, tmp):
+    filename = os.path.join(tmp, 'doc.svg')
+    make_document(textext, filename, size)
+    effect = textext.TexText()
+    effect.getoptions([filename])
+    effect.parse(filename)
+    nodes = effect.find_all_nodes()
+    new_nodes = [copy.copy(node) for node in nodes]
+    start = time.time()
+    for old_node, new_node in zip(nodes, new_nodes):
+        effect.replace_node(old_node, new_node)
+    return time.time() - start
+
+def bench_effect(textext, size, tmp):
+    filename = os.path.join(tmp, 'doc.svg')
+    make_document(textext, filename, size)
+    start = time.time()
+    run_effect(textext, filename, ['--text=' + make_text(1)])
+    return time.time() - start
+
+def bench_effect_edit(textext, size, tmp):
+    filename = os.path.join(tmp, 'doc.svg')
+    make_document(textext, filename, size)
+    start = time.time()
+    run_effect(textext, filename, ['--text=' + make_text(2),
+                                   '--id=tt%d' % (size - 1)])
+    return time.time() - start
+
+def bench_batch(textext, size, tmp):
+    filename = os.path.join(tmp, 'doc.svg')
+    make_document(textext, filename, size)
+    start = time.time()
+    run_effect(textext, filename, ['--batch'])
+    return time.time() - start
+
+def run_case(case, size, real):
+    """Run a benchmark case, and return the time taken and peak memory"""
+    tmp = tempfile.mkdtemp()
+    try:
+        # Keep the user's settings and caches out of the way
+        os.environ['HOME'] = tmp
+        os.environ['APPDATA'] = tmp
+        if not real:
+            install_fakes(tmp)
+            os.environ['PATH'] = tmp + os.pathsep + os.environ.get('PATH', '')
+
+        import textext
+        if not real:
+            textext.CONVERTERS = [textext.Pdf2Svg, textext.PstoeditPlotSvg]
+        name = os.environ.get('TEXTEXT_BENCH_CONVERTER')
+        if name:
+            textext.CONVERTERS = [cls for cls in textext.CONVERTERS
+                                  if cls.name == name]
+        seconds = globals()['bench_' + case](textext, size, tmp)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        maxrss //= 1024
+    return seconds, maxrss
+
+#------------------------------------------------------------------------------
+# Driver
+#------------------------------------------------------------------------------
+
+def run_in_subprocess(case, size, opts):
+    import subprocess
+    cmd = [sys.executable, os.path.abspath(__file__),
+           '--run=%s:%d' % (case, size)]
+    if opts.real:
+        cmd.append('--real')
+    env = dict(os.environ)
+    env['TEXTEXT_BENCH_LATENCY'] = str(opts.latency)
+    env['TEXTEXT_BENCH_SEGMENTS'] = str(opts.segments)
+    if opts.converter:
+        env['TEXTEXT_BENCH_CONVERTER'] = opts.converter
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, env=env)
+    out = p.communicate()[0]
+    if p.returncode != 0:
+        return None
+    seconds, maxrss = out.split()[-2:]
+    return float(seconds), int(maxrss)
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__.strip())
+    parser.add_option("--sizes", default="1,10,100,1000,10000")
+    parser.add_option("--cases", default=','.join(CASES))
+    parser.add_option("--segments", type="int", default=8,
+                      help="curve segments per glyph in the canned output")
+    parser.add_option("--latency", type="float", default=0.0,
+                      help="seconds each stand-in executable sleeps")
+    parser.add_option("--converter", default=None,
+                      help="name of the converter to use")
+    parser.add_option("--real", action="store_true", default=False,
+                      help="use the real tools on PATH")
+    parser.add_option("--json", default=None,
+                      help="also write the results to this file")
+    parser.add_option("--run", default=None, help=optparse.SUPPRESS_HELP)
+    opts, args = parser.parse_args()
+
+    if opts.run:
+        case, size = opts.run.split(':')
+        seconds, maxrss = run_case(case, int(size), opts.real)
+        print "%r %d" % (seconds, maxrss)
+        return
+
+    sizes = [int(x) for x in opts.sizes.split(',')]
+    results = []
+    print "%-14s %8s %10s %12s %10s" % ("case", "size", "seconds",
+                                         "items/s", "maxrss kB")
+    for case in opts.cases.split(','):
+        for size in sizes:
+            if size > MAX_SIZES.get(case, size):
+                continue
+            result = run_in_subprocess(case, size, opts)
+            if result is None:
+                print "%-14s %8d %10s" % (case, size, "failed")
+                continue
+            seconds, maxrss = result
+            rate = size / max(seconds, 1e-9)
+            print "%-14s %8d %10.4f %12.1f %10d" % (case, size, seconds,
+                                                    rate, maxrss)
+            sys.stdout.flush()
+            results.append(dict(case=case, size=size, seconds=seconds,
+                                rate=rate, maxrss=maxrss))
+
+    if opts.json:
+        f = open(opts.json, 'w')
+        try:
+            f.write(json.dumps(results, indent=1))
+        finally:
+            f.close()
+
+if __name__ == "__main__":
+    main()
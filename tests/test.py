@@ -1,5 +1,5 @@
 #!/usr/bin/env python
-import os, sys, unittest
+import os, sys, unittest, tempfile, shutil, copy, glob, threading, time
 from lxml import etree
 
 BASEDIR = os.path.abspath(os.path.dirname(__file__))
@@ -8,6 +8,7 @@ TEST_OUTPUT = os.path.join(BASEDIR, 'out.svg')
 
 sys.path.append(os.path.join(BASEDIR, '..'))
 import textext
+import bench
 
 class EffectTester(textext.TexText):
     def affect(self, args):
@@ -67,6 +68,653 @@ class TestConverterOutput(unittest.TestCase):
         assert cmp_files(TEST_OUTPUT,
                          os.path.join(BASEDIR, 'out-plotsvg.svg'))
 
+class FakeToolsTestCase(unittest.TestCase):
+    """
+    Run the effect on a document of its own, with the stand-in Latex
+    tools of the benchmarks, and settings and caches kept out of the
+    way of the user's.
+    """
+
+    converters = [textext.Pdf2Svg]
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ['HOME'] = self.path
+        os.environ['APPDATA'] = self.path
+        bench.install_fakes(self.path)
+        os.environ['PATH'] = self.path + os.pathsep + os.environ.get('PATH', '')
+        self.saved_converters = textext.CONVERTERS
+        textext.CONVERTERS = list(self.converters)
+        self.filename = os.path.join(self.path, 'doc.svg')
+        shutil.copy(TEST_FILE, self.filename)
+
+    def tearDown(self):
+        textext.CONVERTERS = self.saved_converters
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.path)
+
+    def run_effect(self, *args):
+        """Run the effect on the document, and save the result"""
+        effect = textext.TexText()
+        effect.affect(['--text-to-path'] + list(args) + [self.filename],
+                      output=False)
+        effect.document.write(self.filename)
+        return effect
+
+    def make_document(self, texts):
+        """Add TexText objects with `texts`, not rendered yet"""
+        tree = etree.parse(self.filename)
+        for j, text in enumerate(texts):
+            node = etree.SubElement(tree.getroot(), '{%s}g' % textext.SVG_NS)
+            node.attrib['id'] = 'tt%d' % j
+            node.attrib['{%s}text' % textext.TEXTEXT_NS] = text
+            node.attrib['{%s}preamble' % textext.TEXTEXT_NS] = ''
+            node.attrib['{%s}page_width' % textext.TEXTEXT_NS] = ''
+        tree.write(self.filename)
+
+    def count_uses(self, node):
+        """Number of glyphs drawn by `node`: one per word with the fakes"""
+        return len(node.xpath('.//svg:use', namespaces=textext.NSS))
+
+    def set_ids(self):
+        """Give the TexText objects ids, for selecting them"""
+        tree = etree.parse(self.filename)
+        for j, node in enumerate(tree.xpath('//svg:g[@textext:text]',
+                                            namespaces=textext.NSS)):
+            node.attrib['id'] = 'tt%d' % j
+        tree.write(self.filename)
+
+    def get_nodes(self):
+        effect = textext.TexText()
+        effect.getoptions([self.filename])
+        effect.parse(self.filename)
+        return effect.find_all_nodes()
+
+class TestRenderCache(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_roundtrip(self):
+        cache = textext.RenderCache(self.path)
+        node = etree.fromstring('<g><path d="M 0,0 L 1,1"/></g>')
+        assert cache.get('a') is None
+        cache.put('a', node)
+        assert etree.tostring(cache.get('a')) == etree.tostring(node)
+
+    def test_evict_lru(self):
+        node = etree.fromstring('<g><path d="M 0,0 L 1,1"/></g>')
+        size = len(etree.tostring(node))
+        cache = textext.RenderCache(self.path, max_size=2*size)
+        cache.put('a', node)
+        cache.put('b', node)
+        os.utime(os.path.join(self.path, 'a.svg'), (0, 0))
+        cache.put('c', node)
+        assert cache.get('a') is None
+        assert cache.get('b') is not None
+        assert cache.get('c') is not None
+
+    def test_disabled(self):
+        cache = textext.RenderCache(self.path, max_size=0)
+        cache.put('a', etree.fromstring('<g/>'))
+        assert cache.get('a') is None
+
+    def test_id_prefix(self):
+        cache = textext.RenderCache(self.path)
+        cache.put('a', etree.fromstring('<g><path id="p-0"/></g>'))
+        assert cache.get('a', 'x-')[0].attrib['id'] == 'x-0'
+        assert cache.get('a', 'y-')[0].attrib['id'] == 'y-0'
+
+class TestFormatCache(FakeToolsTestCase):
+    def test_retry_failed(self):
+        cache = textext.FormatCache(os.path.join(self.path, 'formats'))
+        markers = os.path.join(cache.path, '*.failed')
+        work_path = tempfile.mkdtemp(dir=self.path)
+
+        # no pdflatex on the path: the failure is remembered...
+        path = os.environ['PATH']
+        os.environ['PATH'] = work_path
+        assert cache.get('head', 'pdflatex', work_path) is None
+        os.environ['PATH'] = path
+        assert cache.get('head', 'pdflatex', work_path) is None
+        assert len(glob.glob(markers)) == 1
+
+        # ...until it expires
+        os.utime(glob.glob(markers)[0], (0, 0))
+        name = cache.get('head', 'pdflatex', work_path)
+        assert os.path.isfile(name + '.fmt')
+        assert not glob.glob(markers)
+
+class TestProbeCache(FakeToolsTestCase):
+    def probe(self):
+        """Find a converter; return the commands run for probing"""
+        commands = []
+        exec_command = textext.exec_command
+        def record(cmd, *args, **kw):
+            commands.append(cmd[0])
+            return exec_command(cmd, *args, **kw)
+        textext.exec_command = record
+        try:
+            info = textext.ConvertInfo()
+            info.load_from_settings(textext.Settings())
+            info.text_to_path = True
+            assert info.get_converter_cls() is textext.Pdf2Svg
+        finally:
+            textext.exec_command = exec_command
+        return commands
+
+    def test_reuse(self):
+        assert self.probe() == ['pdf2svg']
+        assert self.probe() == []
+
+    def test_tool_changed(self):
+        self.probe()
+        os.utime(os.path.join(self.path, 'pdf2svg'), (0, 0))
+        assert self.probe() == ['pdf2svg']
+        assert self.probe() == []
+
+class TestConverterChoice(FakeToolsTestCase):
+    converters = [textext.DviSvgm, textext.Pdf2Svg]
+
+    def get_converter_cls(self, text_to_path=True):
+        info = textext.ConvertInfo()
+        info.load_from_settings(textext.Settings())
+        info.text_to_path = text_to_path
+        return info.get_converter_cls()
+
+    def test_dvisvgm(self):
+        assert self.get_converter_cls() is textext.DviSvgm
+        self.run_effect('--text=a b')
+        assert self.count_uses(self.get_nodes()[0]) == 2
+
+    def test_fallback(self):
+        os.remove(os.path.join(self.path, 'dvisvgm'))
+        assert self.get_converter_cls() is textext.Pdf2Svg
+        self.run_effect('--text=a b')
+        assert self.count_uses(self.get_nodes()[0]) == 2
+
+    def test_no_preference(self):
+        # Without a text-to-path setting, the first available one wins
+        assert self.get_converter_cls(None) is textext.DviSvgm
+        info = textext.ConvertInfo()
+        info.load_from_settings(textext.Settings())
+        assert info.text_to_path is None
+        assert info.get_converter_cls() is textext.DviSvgm
+
+    def test_no_latex(self):
+        # dvisvgm alone is of no use without latex to make the DVI
+        os.remove(os.path.join(self.path, 'latex'))
+        assert self.get_converter_cls(None) is textext.Pdf2Svg
+
+class TestUniqueIds(FakeToolsTestCase):
+    def test_cached_twice(self):
+        self.run_effect('--text=a b', '-s', '1')
+        self.run_effect('--text=a b', '-s', '2')
+        tree = etree.parse(self.filename)
+        ids = tree.xpath('//@id')
+        assert len(self.get_nodes()) == 2
+        assert len(ids) == len(set(ids))
+        # Each object only refers to its own definitions
+        for node in self.get_nodes():
+            own = set(['#' + x for x in node.xpath('.//@id')])
+            refs = node.xpath('.//@xlink:href', namespaces=textext.NSS)
+            assert refs and set(refs) <= own
+
+class TestUnchanged(FakeToolsTestCase):
+    def test_noop_edit(self):
+        # Without a render cache, any conversion would run the tools
+        settings = textext.Settings()
+        settings.set('cache_size', 0)
+        settings.save()
+
+        self.run_effect('--text=a b')
+        self.set_ids()
+        before = etree.tostring(self.get_nodes()[0])
+
+        commands = []
+        exec_command = textext.exec_command
+        def record(cmd, *args, **kw):
+            commands.append(cmd[0])
+            return exec_command(cmd, *args, **kw)
+        textext.exec_command = record
+        try:
+            self.run_effect('--id=tt0', '--text=a b')
+        finally:
+            textext.exec_command = exec_command
+        assert 'pdflatex' not in commands and 'pdf2svg' not in commands
+        assert etree.tostring(self.get_nodes()[0]) == before
+
+class TestBatch(FakeToolsTestCase):
+    def test_batch(self):
+        texts = [' '.join(['w%d' % j] * (j + 1)) for j in range(5)]
+        self.make_document(texts)
+        self.run_effect('--batch')
+        nodes = self.get_nodes()
+        assert len(nodes) == len(texts)
+        for node, text in zip(nodes, texts):
+            assert node.attrib['{%s}text' % textext.TEXTEXT_NS] == text
+            assert self.count_uses(node) == len(text.split())
+
+    def test_threads_share_pools(self):
+        closed = []
+        close, cpu_count = textext.WorkspacePool.close, textext.cpu_count
+        def record(pool):
+            closed.append(pool)
+            close(pool)
+        textext.WorkspacePool.close = record
+        textext.cpu_count = lambda: 4
+        try:
+            self.make_document(['a', 'b', 'c d', 'e', 'f g h', 'i', 'j', 'k'])
+            self.run_effect('--batch', '--threads')
+        finally:
+            textext.WorkspacePool.close = close
+            textext.cpu_count = cpu_count
+        assert len(closed) == 1
+        assert [self.count_uses(n) for n in self.get_nodes()] == \
+               [1, 1, 2, 1, 3, 1, 1, 1]
+
+class TestSharedGlyphs(FakeToolsTestCase):
+    def get_glyphs(self):
+        tree = etree.parse(self.filename)
+        return tree.xpath('//svg:defs/*[starts-with(@id, "%s")]/@id'
+                          % textext.GLYPH_PREFIX, namespaces=textext.NSS)
+
+    def get_refs(self, node):
+        return set([x[1:] for x in
+                    node.xpath('.//@xlink:href', namespaces=textext.NSS)])
+
+    def test_shared(self):
+        self.run_effect('--shared-glyphs', '--text=a b')
+        self.run_effect('--shared-glyphs', '--text=c d e')
+        first, second = self.get_nodes()
+        assert not first.xpath('.//symbol') and not second.xpath('.//symbol')
+        assert len(self.get_glyphs()) == 3
+        assert self.get_refs(first) < self.get_refs(second)
+        assert self.get_refs(second) == set(self.get_glyphs())
+
+    def test_collect(self):
+        self.run_effect('--shared-glyphs', '--text=a b')
+        self.run_effect('--shared-glyphs', '--text=c d e')
+        self.set_ids()
+        first, second = self.get_nodes()
+
+        # Replacing the object leaves its third glyph unused
+        self.run_effect('--shared-glyphs', '--id=%s' % second.attrib['id'],
+                        '--text=f')
+        assert len(self.get_glyphs()) == 2
+
+        # ...and deleting the other one its second glyph
+        tree = etree.parse(self.filename)
+        node = tree.xpath('//*[@id="%s"]' % first.attrib['id'])[0]
+        node.getparent().remove(node)
+        tree.write(self.filename)
+        self.run_effect('--shared-glyphs', '--text=g')
+        assert len(self.get_glyphs()) == 1
+
+class TestClones(FakeToolsTestCase):
+    def get_masters(self):
+        tree = etree.parse(self.filename)
+        return tree.xpath('//svg:defs/*[starts-with(@id, "%s")]'
+                          % textext.MASTER_PREFIX, namespaces=textext.NSS)
+
+    def get_href(self, node):
+        uses = node.xpath('svg:use', namespaces=textext.NSS)
+        assert len(uses) == 1 and len(node) == 1
+        return uses[0].attrib['{%s}href' % textext.XLINK_NS]
+
+    def test_clone(self):
+        self.run_effect('--clones', '--text=a b')
+        self.run_effect('--clones', '--text=a b')
+        assert 'xlink:href="#%s' % textext.MASTER_PREFIX in \
+               open(self.filename).read()
+
+        masters = self.get_masters()
+        assert len(masters) == 1 and self.count_uses(masters[0]) == 2
+        assert masters[0].attrib.keys() == ['id']
+        first, second = self.get_nodes()
+        assert self.get_href(first) == self.get_href(second) == \
+               '#' + masters[0].attrib['id']
+        assert first.attrib['transform'] == second.attrib['transform'] == \
+               textext.Pdf2Svg.get_transform(1.0)
+
+    def test_edit(self):
+        self.run_effect('--clones', '--text=a b')
+        self.run_effect('--clones', '--text=a b')
+        self.set_ids()
+        self.run_effect('--clones', '--id=tt0', '--text=c d e')
+
+        masters = self.get_masters()
+        assert len(masters) == 2
+        first, second = self.get_nodes()
+        hrefs = dict([('#' + m.attrib['id'], self.count_uses(m))
+                      for m in masters])
+        assert hrefs[self.get_href(first)] == 3
+        assert hrefs[self.get_href(second)] == 2
+
+    def test_unclone(self):
+        self.run_effect('--clones', '--text=a b')
+        self.run_effect('--clones', '--text=a b')
+        self.set_ids()
+
+        self.run_effect('--no-clones', '--id=tt0', '--text=a b')
+        first, second = self.get_nodes()
+        assert self.count_uses(first) == 2
+        assert not first.xpath('svg:use', namespaces=textext.NSS)
+        assert self.get_href(second)
+        assert len(self.get_masters()) == 1
+
+        self.run_effect('--no-clones', '--id=tt1', '--text=a b')
+        assert self.count_uses(self.get_nodes()[1]) == 2
+        assert not self.get_masters()
+
+class TestPages(FakeToolsTestCase):
+    def make_infos(self, texts):
+        infos = []
+        for text in texts:
+            info = textext.ConvertInfo()
+            info.text = text
+            info.preamble_file = ''
+            info.page_width = ''
+            info.scale_factor = 1.0
+            infos.append(info)
+        return infos
+
+    def test_page_per_snippet(self):
+        cache = textext.RenderCache(os.path.join(self.path, 'cache'))
+        infos = self.make_infos(['a', 'b b', 'c c c'])
+        converter = textext.Pdf2Svg(None, cache=cache)
+        try:
+            nodes = converter.convert_many(infos)
+        finally:
+            converter.finish()
+        assert [len(node.xpath('.//use')) for node in nodes] == [1, 2, 3]
+
+    def test_extra_page(self):
+        # The second snippet takes two pages: the objects must not get
+        # each other's pages, in the result nor in the cache
+        cache = textext.RenderCache(os.path.join(self.path, 'cache'))
+        infos = self.make_infos(['a', 'b \\newpage c c c', 'd d d d d d d'])
+        converter = textext.Pdf2Svg(None, cache=cache)
+        try:
+            nodes = converter.convert_many(infos)
+        finally:
+            converter.finish()
+        assert [len(node.xpath('.//use')) for node in nodes] == [1, 1, 7]
+        for info, count in zip(infos, [1, 1, 7]):
+            node = cache.get(info.cache_key(textext.Pdf2Svg))
+            assert len(node.xpath('.//use')) == count
+
+    def get_paths(self, node):
+        return node.xpath('.//path/@d')
+
+    def test_isolated(self):
+        # Changes made by one snippet don't show in the next one
+        converter = textext.Pdf2Svg(None)
+        try:
+            nodes = converter.convert_many(self.make_infos(['\\bfseries a',
+                                                            'x y']))
+            alone = converter.convert(self.make_infos(['x y'])[0])
+        finally:
+            converter.finish()
+        assert self.get_paths(nodes[1]) == self.get_paths(alone)
+        assert self.get_paths(nodes[0])[0] != self.get_paths(alone)[0]
+
+    def test_global_definition(self):
+        runs = []
+        exec_command = textext.exec_command
+        def record(cmd, *args, **kw):
+            if cmd[0] == 'pdflatex':
+                runs.append(cmd)
+            return exec_command(cmd, *args, **kw)
+        textext.exec_command = record
+        converter = textext.Pdf2Svg(None)
+        try:
+            infos = self.make_infos(['\\gdef\\x{} a', 'b', 'c c'])
+            nodes = converter.convert_many(infos)
+        finally:
+            converter.finish()
+            textext.exec_command = exec_command
+        assert len(runs) == 2
+        assert [len(node.xpath('.//use')) for node in nodes] == [1, 1, 2]
+
+class TestTexWorker(FakeToolsTestCase):
+    def setUp(self):
+        FakeToolsTestCase.setUp(self)
+        settings = textext.Settings()
+        settings.set('resident_tex', 1)
+        settings.save()
+
+    def test_single_shot(self):
+        effect = self.run_effect('--text=a b')
+        assert 'tex_worker' not in effect.converter_kw
+        assert self.count_uses(self.get_nodes()[0]) == 2
+
+    def test_batch(self):
+        self.make_document(['a', 'b c'])
+        effect = self.run_effect('--batch')
+        assert 'tex_worker' in effect.converter_kw
+        assert effect.converter_kw['tex_worker'].process is None
+
+    def test_process_pool(self):
+        # Nothing is left behind by the worker processes
+        workspaces = os.path.join(self.path, 'workspaces')
+        os.mkdir(workspaces)
+        settings = textext.Settings()
+        settings.set('workspace_dir', workspaces)
+        settings.save()
+
+        cpu_count = textext.cpu_count
+        textext.cpu_count = lambda: 4
+        try:
+            self.make_document(['a', 'b c', 'd', 'e f g', 'h', 'i j'])
+            self.run_effect('--batch')
+        finally:
+            textext.cpu_count = cpu_count
+        assert [self.count_uses(n) for n in self.get_nodes()] == \
+               [1, 2, 1, 3, 1, 2]
+        assert os.listdir(workspaces) == []
+        for cmdline in glob.glob('/proc/[0-9]*/cmdline'):
+            try:
+                assert self.path not in open(cmdline).read()
+            except IOError:
+                pass
+
+class TestReadSvg(unittest.TestCase):
+    SVG = '''<svg xmlns="http://www.w3.org/2000/svg"
+     xmlns:xlink="http://www.w3.org/1999/xlink">
+  <g clip-path="url(#clip)" style="fill:url( #grad );stroke:none">
+    <use xlink:href="#glyph" mask="url(#missing)"/>
+  </g>
+  <defs>
+    <clipPath id="clip"><rect width="1" height="1"/></clipPath>
+    <linearGradient id="grad"/>
+    <path id="glyph" d="M 0,0 L 1,1"/>
+  </defs>
+</svg>'''
+
+    def test_references(self):
+        converter = textext.Pdf2Svg(None)
+        try:
+            f = open(converter.tmp('svg'), 'w')
+            f.write(self.SVG)
+            f.close()
+            root = converter.read_svg('p-')
+        finally:
+            converter.finish()
+        g, use = root[0], root[0][0]
+        assert g.attrib['clip-path'] == 'url(#p-0)'
+        assert g.attrib['style'] == 'fill:url(#p-1);stroke:none'
+        assert use.attrib['{%s}href' % textext.XLINK_NS] == '#p-2'
+        assert use.attrib['mask'] == 'url(#missing)'
+        assert root.xpath('//@id') == ['p-0', 'p-1', 'p-2']
+
+class TestExecCommand(unittest.TestCase):
+    SLEEP = [sys.executable, '-c', 'import time; time.sleep(30)']
+
+    def setUp(self):
+        self.threads = threading.activeCount()
+
+    def tearDown(self):
+        assert threading.activeCount() == self.threads
+
+    def test_finished(self):
+        out = textext.exec_command([sys.executable, '-c', 'print 1'],
+                                   timeout=30)
+        assert out.strip() == '1'
+
+    def test_timeout(self):
+        start = time.time()
+        self.assertRaises(textext.CommandTimeout, textext.exec_command,
+                          self.SLEEP, timeout=0.5)
+        assert time.time() - start < 10
+
+    def test_cancel(self):
+        jobs = textext.JobControl()
+        canceller = threading.Timer(0.5, jobs.cancel)
+        canceller.start()
+        start = time.time()
+        try:
+            self.assertRaises(RuntimeError, textext.exec_command,
+                              self.SLEEP, timeout=30, jobs=jobs)
+        finally:
+            canceller.join()
+        assert time.time() - start < 10
+
+class TestInkscapeShell(unittest.TestCase):
+    # Writes its output in pieces, with prompt-like text in between
+    FAKE_INKSCAPE = r'''
+import sys, os, time
+def write(s):
+    sys.stdout.write(s)
+    sys.stdout.flush()
+    time.sleep(0.01)
+if '--shell' not in sys.argv:
+    write("once %s\n" % ' '.join(sys.argv[1:]))
+    sys.exit(0)
+if os.environ.get('FAKE_SHELL_BROKEN'):
+    sys.exit(1)
+write("Inkscape interactive shell mode.\n")
+write(">")
+write(" ")
+for line in iter(sys.stdin.readline, ''):
+    if line.strip() == 'quit':
+        break
+    if os.environ.get('FAKE_SHELL_HANG'):
+        time.sleep(30)
+    write("a>")
+    write("\nshell %s\n" % line.strip())
+    write(">")
+    write(" ")
+'''
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.inkscape = os.path.join(self.path, 'inkscape')
+        f = open(self.inkscape, 'w')
+        f.write('#!%s\n%s' % (sys.executable, self.FAKE_INKSCAPE))
+        f.close()
+        os.chmod(self.inkscape, 0755)
+        self.environ = dict(os.environ)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.path)
+
+    def test_prompt(self):
+        shell = textext.InkscapeShell(self.inkscape)
+        try:
+            assert shell.run(['x', 'y z']) == "a>\nshell x 'y z'\n"
+            assert shell.run(['w']) == "a>\nshell w\n"
+        finally:
+            shell.close()
+
+    def test_fallback(self):
+        os.environ['FAKE_SHELL_BROKEN'] = '1'
+        converter = textext.Inkscape(None, shells=textext.InkscapeShellPool())
+        converter.INKSCAPE = self.inkscape
+        try:
+            assert converter.run_inkscape(['x']).strip() == 'once x'
+            assert converter.shells is None
+        finally:
+            converter.finish()
+
+    def test_timeout(self):
+        # The deadline covers the command, without another try
+        os.environ['FAKE_SHELL_HANG'] = '1'
+        shells = textext.InkscapeShellPool()
+        jobs = textext.JobControl(deadlines={'pdf_to_svg': 0.5})
+        converter = textext.Inkscape(None, shells=shells, jobs=jobs)
+        converter.INKSCAPE = self.inkscape
+        try:
+            self.assertRaises(textext.CommandTimeout,
+                              converter.run_inkscape, ['x'])
+        finally:
+            converter.finish()
+            shells.close()
+
+class TestWorkspacePool(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_reuse(self):
+        pool = textext.WorkspacePool(self.path, max_idle=1)
+        a = pool.acquire()
+        b = pool.acquire()
+        assert a != b and os.path.dirname(a) == self.path
+        open(os.path.join(a, 'tmp.log'), 'w').close()
+        pool.release(a)
+        pool.release(b)
+        assert not os.path.exists(b)
+        assert pool.acquire() == a
+        assert os.listdir(a) == []
+        pool.release(a)
+        pool.close()
+        assert os.listdir(self.path) == []
+
+class TestSvgOptimizer(unittest.TestCase):
+    def test_parse_path(self):
+        cmds = textext.parse_path("m 1,2 3,4 h 5 v -1 z M 0 0 s 1 1 2 2")
+        assert cmds == [('M', [1, 2]), ('L', [4, 6]), ('L', [9, 6]),
+                        ('L', [9, 5]), ('Z', []), ('M', [0, 0]),
+                        ('C', [0, 0, 1, 1, 2, 2])]
+        assert textext.parse_path("M 0 0 A 1 1 0 0 0 2 2") is None
+
+    def test_round_relative(self):
+        node = etree.fromstring('<g><g><path style="" '
+                                'd="M 1.00001,2 L 3.5,2 Z"/></g></g>')
+        opt = textext.SvgOptimizer(precision=2)
+        assert not opt.optimize(node)
+        assert etree.tostring(node) == '<g><path d="m1 2l2.5 0z"/></g>'
+
+    def test_bake(self):
+        node = etree.fromstring('<g><g transform="translate(1,0)">'
+                                '<path style="stroke-width:1" d="M 0,0 L 1,1"/>'
+                                '</g></g>')
+        opt = textext.SvgOptimizer(precision=3)
+        assert opt.optimize(node, textext.parse_transform('scale(2)'))
+        assert etree.tostring(node) == \
+               '<g><path style="stroke-width:2" d="m2 0l2 2"/></g>'
+
+        node = etree.fromstring('<g><use/></g>')
+        assert not opt.optimize(node, textext.parse_transform('scale(2)'))
+
+    def test_bbox(self):
+        node = etree.fromstring(
+            '<g xmlns:xlink="http://www.w3.org/1999/xlink">'
+            '<defs><path id="a" d="M 0,0 L 1,2"/></defs>'
+            '<use xlink:href="#a" x="1" transform="scale(2)"/>'
+            '<rect x="-1" y="0" width="1" height="1"/></g>')
+        assert textext.get_bbox(node) == (-1, 0, 4, 4)
+        assert textext.get_bbox(etree.fromstring('<g/>')) is None
+
 if __name__ == "__main__":
     unittest.main()
 
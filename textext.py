@@ -47,7 +47,8 @@ __version__ = "0.4.dev"
 __docformat__ = "restructuredtext en"
 
 import sys, os, glob, traceback, platform
-import shutil, tempfile, re, copy
+import shutil, tempfile, re, copy, atexit, threading, math, time, signal
+import Queue
 
 sys.path.append('/usr/share/inkscape/extensions')
 sys.path.append(r'c:/Program Files/Inkscape/share/extensions')
@@ -61,22 +62,6 @@ try:
 except ImportError:
     import md5 as hashlib
 
-USE_GTK = False
-try:
-    import pygtk
-    pygtk.require('2.0')
-    import gtk
-    USE_GTK = True
-except ImportError:
-    pass
-
-USE_TK = False
-try:
-    import Tkinter as Tk
-    USE_TK = True
-except ImportError:
-    pass
-
 USE_WINDOWS = (platform.system() == "Windows")
 
 TEXTEXT_NS = u"http://www.iki.fi/pav/software/textext/"
@@ -84,6 +69,8 @@ SVG_NS = u"http://www.w3.org/2000/svg"
 XLINK_NS = u"http://www.w3.org/1999/xlink"
 
 ID_PREFIX = "textext-"
+GLYPH_PREFIX = ID_PREFIX + "glyph-"
+MASTER_PREFIX = ID_PREFIX + "master-"
 
 NSS = {
     u'textext': TEXTEXT_NS,
@@ -95,312 +82,534 @@ NSS = {
 # GUI
 #------------------------------------------------------------------------------
 
-if USE_GTK:
-    class AskText(object):
-        """GUI for editing TexText objects"""
-        def __init__(self, info):
-            self.info = info
-            self.callback = None
+# The GUI toolkit is imported only once a dialog is needed, so that
+# command line and library use work without it (and without a display).
+gtk = None
+gobject = None
+Tk = None
 
-        def ask(self, callback):
-            self.callback = callback
-            
-            window = gtk.Window(gtk.WINDOW_TOPLEVEL)
-            window.set_title("TeX Text")
-            window.set_default_size(600, 400)
-    
-            label_preamble = gtk.Label(u"Preamble file:")
-            label_scale = gtk.Label(u"Scale factor:")
-            label_text = gtk.Label(u"Text:")
-            label_converter = gtk.Label(u"Converter:")
-            label_page_width = gtk.Label(u"LaTeX page width:")
-
-            if hasattr(gtk, 'FileChooserButton'):
-                self._preamble = gtk.FileChooserButton("Preamble file")
-                if os.path.isfile(self.info.preamble_file):
-                    self._preamble.set_filename(self.info.preamble_file)
-                self._preamble.set_action(gtk.FILE_CHOOSER_ACTION_OPEN)
-            else:
-                self._preamble = gtk.Entry()
-                self._preamble.set_text(self.info.preamble_file)
-            
-            self._scale_adj = gtk.Adjustment(lower=0.01, upper=100,
-                                             step_incr=0.1, page_incr=1)
-            self._scale = gtk.SpinButton(self._scale_adj, digits=2)
-            
-            if not self.info.has_node:
-                self._scale_adj.set_value(self.info.scale_factor)
-            else:
-                self._scale_adj.set_value(1.0)
-                self._scale.set_sensitive(False)
-
-            self._page_width = gtk.Entry()
-            self._page_width.set_text(self.info.page_width)
-
-            self._converter = gtk.combo_box_new_text()
-            for conv in self.info.available_converters:
-                self._converter.append_text(conv.name)
-            for conv in self.info.unavailable_converters:
-                self._converter.append_text(conv.name
-                                            + ' [NOT AVAILABLE CURRENTLY]')
-            self._converter.set_active(0)
-            for j, conv in enumerate(self.info.available_converters):
-                if conv.name == self.info.selected_converter:
-                    self._converter.set_active(j)
-                    break
+def load_gui():
+    """
+    Import a GUI toolkit, preferring pygtk over Tkinter.
 
-            self._text = gtk.TextView()
-            self._text.get_buffer().set_text(self.info.text)
+    :Returns: 'gtk' or 'tk'
+    """
+    global gtk, gobject, Tk
+
+    if gtk is not None:
+        return 'gtk'
+    if Tk is not None:
+        return 'tk'
+
+    try:
+        import pygtk
+        pygtk.require('2.0')
+        import gtk
+        import gobject
+        return 'gtk'
+    except (ImportError, RuntimeError):
+        pass
 
-            sw = gtk.ScrolledWindow()
-            sw.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
-            sw.set_shadow_type(gtk.SHADOW_IN)
-            sw.add(self._text)
-            
-            self._ok = gtk.Button(stock=gtk.STOCK_OK)
-            self._cancel = gtk.Button(stock=gtk.STOCK_CANCEL)
-    
-            # layout
-            table = gtk.Table(5, 2, False)
+    try:
+        import Tkinter as Tk
+        return 'tk'
+    except ImportError:
+        pass
+
+    raise RuntimeError("Neither pygtk nor Tkinter is available!")
+
+def make_preview_svg(node, max_width=800, max_height=240):
+    """
+    Wrap a converted node in a standalone SVG document showing just
+    its contents, for previewing.
+
+    :Returns: SVG document as a string, or None if the extent of the
+              node cannot be determined
+    """
+    bbox = get_bbox(node)
+    if bbox is None:
+        return None
+    x0, y0, x1, y1 = bbox
+    margin = 2
+    x0 -= margin
+    y0 -= margin
+    w = x1 - x0 + margin
+    h = y1 - y0 + margin
+    zoom = min(2.0, max_width / w, max_height / h)
+    return ('<svg xmlns="%s" xmlns:xlink="%s" width="%d" height="%d" '
+            'viewBox="%f %f %f %f">%s</svg>'
+            % (SVG_NS, XLINK_NS, max(1, int(w*zoom)), max(1, int(h*zoom)),
+               x0, y0, w, h, etree.tostring(node, with_tail=False)))
+
+class AskTextGtk(object):
+    """GUI for editing TexText objects"""
+
+    # Milliseconds to wait after the last edit before rendering a preview
+    PREVIEW_DELAY = 500
+
+    def __init__(self, info, preview=None):
+        """
+        :Parameters:
+          - `info`: ConvertInfo to edit
+          - `preview`: function(info, jobs) returning a preview as an SVG
+            string, run in a background thread; None for no preview
+        """
+        self.info = info
+        self.callback = None
+        self.preview = preview
+
+        # Preview state: the render in flight is cancelled through its
+        # JobControl, and results of older renders are ignored
+        self._generation = 0
+        self._timeout_id = None
+        self._preview_jobs = None
+        self._preview_thread = None
+        self._preview_input = None
+
+    def ask(self, callback):
+        self.callback = callback
+        
+        window = gtk.Window(gtk.WINDOW_TOPLEVEL)
+        window.set_title("TeX Text")
+        window.set_default_size(600, 400)
+
+        label_preamble = gtk.Label(u"Preamble file:")
+        label_scale = gtk.Label(u"Scale factor:")
+        label_text = gtk.Label(u"Text:")
+        label_converter = gtk.Label(u"Converter:")
+        label_page_width = gtk.Label(u"LaTeX page width:")
+
+        if hasattr(gtk, 'FileChooserButton'):
+            self._preamble = gtk.FileChooserButton("Preamble file")
+            if os.path.isfile(self.info.preamble_file):
+                self._preamble.set_filename(self.info.preamble_file)
+            self._preamble.set_action(gtk.FILE_CHOOSER_ACTION_OPEN)
+        else:
+            self._preamble = gtk.Entry()
+            self._preamble.set_text(self.info.preamble_file)
+        
+        self._scale_adj = gtk.Adjustment(lower=0.01, upper=100,
+                                         step_incr=0.1, page_incr=1)
+        self._scale = gtk.SpinButton(self._scale_adj, digits=2)
+        
+        if not self.info.has_node:
+            self._scale_adj.set_value(self.info.scale_factor)
+        else:
+            self._scale_adj.set_value(1.0)
+            self._scale.set_sensitive(False)
+
+        self._page_width = gtk.Entry()
+        self._page_width.set_text(self.info.page_width)
+
+        self._converter = gtk.combo_box_new_text()
+        for conv in self.info.available_converters:
+            self._converter.append_text(conv.name)
+        for conv in self.info.unavailable_converters:
+            self._converter.append_text(conv.name
+                                        + ' [NOT AVAILABLE CURRENTLY]')
+        self._converter.set_active(0)
+        for j, conv in enumerate(self.info.available_converters):
+            if conv.name == self.info.selected_converter:
+                self._converter.set_active(j)
+                break
+
+        self._text = gtk.TextView()
+        self._text.get_buffer().set_text(self.info.text)
+
+        sw = gtk.ScrolledWindow()
+        sw.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
+        sw.set_shadow_type(gtk.SHADOW_IN)
+        sw.add(self._text)
+
+        if self.preview is not None:
+            label_preview = gtk.Label(u"Preview:")
+            self._preview_image = gtk.Image()
+            self._preview_status = gtk.Label()
+            self._preview_status.set_alignment(0, 0.5)
+
+            preview_sw = gtk.ScrolledWindow()
+            preview_sw.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
+            preview_sw.add_with_viewport(self._preview_image)
+            preview_sw.set_size_request(-1, 150)
+
+            preview_box = gtk.VBox(False, 2)
+            preview_box.pack_start(preview_sw)
+            preview_box.pack_start(self._preview_status, expand=False)
+        
+        self._ok = gtk.Button(stock=gtk.STOCK_OK)
+        self._cancel = gtk.Button(stock=gtk.STOCK_CANCEL)
 
-            table.attach(label_preamble,     0,1,0,1,xoptions=0,yoptions=gtk.FILL)
-            table.attach(self._preamble,     1,2,0,1,yoptions=gtk.FILL)
+        # layout
+        table = gtk.Table(6, 2, False)
 
-            table.attach(label_scale,        0,1,1,2,xoptions=0,yoptions=gtk.FILL)
-            table.attach(self._scale,        1,2,1,2,yoptions=gtk.FILL)
+        table.attach(label_preamble,     0,1,0,1,xoptions=0,yoptions=gtk.FILL)
+        table.attach(self._preamble,     1,2,0,1,yoptions=gtk.FILL)
 
-            table.attach(label_page_width,   0,1,2,3,xoptions=0,yoptions=gtk.FILL)
-            table.attach(self._page_width,   1,2,2,3,yoptions=gtk.FILL)
+        table.attach(label_scale,        0,1,1,2,xoptions=0,yoptions=gtk.FILL)
+        table.attach(self._scale,        1,2,1,2,yoptions=gtk.FILL)
 
-            table.attach(label_converter,    0,1,3,4,xoptions=0,yoptions=gtk.FILL)
-            table.attach(self._converter,    1,2,3,4,yoptions=gtk.FILL)
+        table.attach(label_page_width,   0,1,2,3,xoptions=0,yoptions=gtk.FILL)
+        table.attach(self._page_width,   1,2,2,3,yoptions=gtk.FILL)
 
-            table.attach(label_text,         0,1,4,5,xoptions=0,yoptions=gtk.FILL)
-            table.attach(sw,                 1,2,4,5)
+        table.attach(label_converter,    0,1,3,4,xoptions=0,yoptions=gtk.FILL)
+        table.attach(self._converter,    1,2,3,4,yoptions=gtk.FILL)
 
-            vbox = gtk.VBox(False, 5)
-            vbox.pack_start(table)
-            
-            hbox = gtk.HButtonBox()
-            hbox.add(self._ok)
-            hbox.add(self._cancel)
-            hbox.set_layout(gtk.BUTTONBOX_SPREAD)
-            
-            vbox.pack_end(hbox, expand=False, fill=False)
-    
-            window.add(vbox)
-    
-            # signals
-            window.connect("delete-event", self.cb_delete_event)
-            window.connect("key-press-event", self.cb_key_press)
-            self._ok.connect("clicked", self.cb_ok)
-            self._cancel.connect("clicked", self.cb_cancel)
-    
-            # show
-            window.show_all()
-            self._text.grab_focus()
+        table.attach(label_text,         0,1,4,5,xoptions=0,yoptions=gtk.FILL)
+        table.attach(sw,                 1,2,4,5)
 
-            # run
-            self._window = window
-            gtk.main()
-    
-        def cb_delete_event(self, widget, event, data=None):
-            gtk.main_quit()
-            return False
+        if self.preview is not None:
+            table.attach(label_preview,  0,1,5,6,xoptions=0,yoptions=gtk.FILL)
+            table.attach(preview_box,    1,2,5,6)
 
-        def cb_key_press(self, widget, event, data=None):
-            # ctrl+return clicks the ok button
-            if gtk.gdk.keyval_name(event.keyval) == 'Return' \
-                   and gtk.gdk.CONTROL_MASK & event.state:
-                self._ok.clicked()
-                return True
-            return False
+        vbox = gtk.VBox(False, 5)
+        vbox.pack_start(table)
         
-        def cb_cancel(self, widget, data=None):
-            raise SystemExit(1)
+        hbox = gtk.HButtonBox()
+        hbox.add(self._ok)
+        hbox.add(self._cancel)
+        hbox.set_layout(gtk.BUTTONBOX_SPREAD)
         
-        def cb_ok(self, widget, data=None):
-            buf = self._text.get_buffer()
-            self.info.text = buf.get_text(buf.get_start_iter(),
-                                     buf.get_end_iter())
+        vbox.pack_end(hbox, expand=False, fill=False)
+
+        window.add(vbox)
+
+        # signals
+        window.connect("delete-event", self.cb_delete_event)
+        window.connect("key-press-event", self.cb_key_press)
+        self._ok.connect("clicked", self.cb_ok)
+        self._cancel.connect("clicked", self.cb_cancel)
+
+        if self.preview is not None:
+            self._text.get_buffer().connect("changed", self.cb_changed)
+            self._page_width.connect("changed", self.cb_changed)
+            self._converter.connect("changed", self.cb_changed)
             if isinstance(self._preamble, gtk.FileChooser):
-                self.info.preamble_file = self._preamble.get_filename()
-                if not self.info.preamble_file:
-                    self.info.preamble_file = ""
+                self._preamble.connect("selection-changed", self.cb_changed)
             else:
-                self.info.preamble_file = self._preamble.get_text()
+                self._preamble.connect("changed", self.cb_changed)
+
+            # The previews are rendered in background threads
+            gobject.threads_init()
+            self.schedule_preview()
+
+        # show
+        window.show_all()
+        self._text.grab_focus()
+
+        # run
+        self._window = window
+        gtk.main()
+
+    def cb_delete_event(self, widget, event, data=None):
+        self.cancel_preview()
+        gtk.main_quit()
+        return False
+
+    def cb_changed(self, widget, data=None):
+        self.schedule_preview()
+
+    def schedule_preview(self):
+        """Render a preview once the user stops typing"""
+        if self._timeout_id is not None:
+            gobject.source_remove(self._timeout_id)
+        self._timeout_id = gobject.timeout_add(self.PREVIEW_DELAY,
+                                               self.start_preview)
+
+    def start_preview(self):
+        self._timeout_id = None
+
+        info = copy.copy(self.info)
+        self.update_info(info)
+        preview_input = self._get_preview_input(info)
+        if preview_input == self._preview_input:
+            return False
 
-            self.info.page_width = self._page_width.get_text()
+        # An older render still in flight is no longer wanted
+        self.cancel_preview()
+
+        self._generation += 1
+        self._preview_input = preview_input
+        self._preview_jobs = JobControl()
+        self._preview_thread = threading.Thread(
+            target=self._render_preview,
+            args=(self._generation, info, self._preview_jobs))
+        self._preview_thread.setDaemon(True)
+        self._preview_thread.start()
+        self._preview_status.set_text(u"Rendering...")
+        return False
+
+    def cancel_preview(self):
+        if self._timeout_id is not None:
+            gobject.source_remove(self._timeout_id)
+            self._timeout_id = None
+        if self._preview_jobs is not None:
+            self._preview_jobs.cancel()
+        self._preview_jobs = self._preview_thread = None
+        self._preview_input = None
+
+    def _get_preview_input(self, info):
+        return (info.text, info.preamble_file, info.page_width,
+                info.selected_converter)
+
+    def _render_preview(self, generation, info, jobs):
+        # Runs in a background thread: no GUI calls here
+        svg = error = None
+        try:
+            svg = self.preview(info, jobs)
+        except StandardError, e:
+            error = e
+        gobject.idle_add(self._show_preview, generation, svg, error)
+
+    def _show_preview(self, generation, svg, error):
+        if generation != self._generation:
+            return False # stale
+
+        self._preview_jobs = self._preview_thread = None
+        if error is not None:
+            # Keep the last good preview visible
+            lines = str(error).strip().splitlines() or [u""]
+            self._preview_status.set_text(u"Error: %s" % lines[0])
+            return False
 
-            j = self._converter.get_active()
-            try:
-                self.info.selected_converter = \
-                    self.info.available_converters[j].name
-            except IndexError:
-                self.info.selected_converter = None
+        if svg is None:
+            self._preview_image.clear()
+            self._preview_status.set_text(u"")
+            return False
 
-            if not self.info.has_node:
-                self.info.scale_factor = self._scale_adj.get_value()
-            
-            try:
-                self.callback()
+        try:
+            loader = gtk.gdk.PixbufLoader('svg')
+            loader.write(svg)
+            loader.close()
+            self._preview_image.set_from_pixbuf(loader.get_pixbuf())
+            self._preview_status.set_text(u"")
+        except (gobject.GError, RuntimeError), e:
+            self._preview_status.set_text(u"Preview not available: %s" % e)
+        return False
+
+    def finish_preview(self):
+        """
+        Wait for a preview of the current input to finish, as it leaves
+        the result in the render cache; cancel any other.
+        """
+        if self._timeout_id is not None:
+            gobject.source_remove(self._timeout_id)
+            self._timeout_id = None
+        thread = self._preview_thread
+        if (thread is not None and self._preview_input
+                == self._get_preview_input(self.info)):
+            thread.join()
+        self.cancel_preview()
+        self._generation += 1
+
+    def cb_key_press(self, widget, event, data=None):
+        # ctrl+return clicks the ok button
+        if gtk.gdk.keyval_name(event.keyval) == 'Return' \
+               and gtk.gdk.CONTROL_MASK & event.state:
+            self._ok.clicked()
+            return True
+        return False
+    
+    def cb_cancel(self, widget, data=None):
+        if self.preview is not None:
+            self.cancel_preview()
+        raise SystemExit(1)
+
+    def update_info(self, info):
+        """Store the values in the dialog to `info`"""
+        buf = self._text.get_buffer()
+        info.text = buf.get_text(buf.get_start_iter(),
+                                 buf.get_end_iter())
+        if isinstance(self._preamble, gtk.FileChooser):
+            info.preamble_file = self._preamble.get_filename()
+            if not info.preamble_file:
+                info.preamble_file = ""
+        else:
+            info.preamble_file = self._preamble.get_text()
 
-            except StandardError, e:
-                err_msg = traceback.format_exc()
-                dlg = gtk.Dialog("Textext Error", self._window, 
-                                 gtk.DIALOG_MODAL)
-                dlg.set_default_size(600, 400)
-                btn = dlg.add_button(gtk.STOCK_OK, gtk.RESPONSE_CLOSE)
-                btn.connect("clicked", lambda w, d=None: dlg.destroy())
-                msg = gtk.Label()
-                msg.set_markup("<b>Error occurred while converting text from Latex to SVG:</b>")
-                
-                txtw = gtk.ScrolledWindow()
-                txtw.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
-                txtw.set_shadow_type(gtk.SHADOW_IN)
-                txt = gtk.TextView()
-                txt.set_editable(False)
-                txt.get_buffer().set_text(err_msg)
-                txtw.add(txt)
-                
-                dlg.vbox.pack_start(msg, expand=False, fill=True)
-                dlg.vbox.pack_start(txtw, expand=True, fill=True)
-                dlg.show_all()
-                dlg.run()
-                return False
-            
-            gtk.main_quit()
-            return False
+        info.page_width = self._page_width.get_text()
+
+        j = self._converter.get_active()
+        try:
+            info.selected_converter = \
+                info.available_converters[j].name
+        except IndexError:
+            info.selected_converter = None
 
-elif USE_TK:
-    class AskText(object):
-        """GUI for editing TexText objects"""
-        def __init__(self, info):
-            self.info = info
-            self.callback = None
+        if not info.has_node:
+            info.scale_factor = self._scale_adj.get_value()
     
-        def ask(self, callback):
-            self.callback = callback
-            
-            root = Tk.Tk()
-            
-            self._frame = Tk.Frame(root)
-            self._frame.pack()
-            
-            box = Tk.Frame(self._frame)
-            label = Tk.Label(box, text="Preamble file:")
-            label.pack(pady=2, padx=5, side="left", anchor="w")
-            self._preamble = Tk.Entry(box)
-            self._preamble.pack(expand=True, fill="x", pady=2, padx=5, side="right")
-            self._preamble.insert(Tk.END, self.info.preamble_file)
-            box.pack(fill="x", expand=True)
-
-            box = Tk.Frame(self._frame)
-            label = Tk.Label(box, text="LaTeX page width:")
-            label.pack(pady=2, padx=5, side="left", anchor="w")
-            self._page_width = Tk.Entry(box)
-            self._page_width.pack(expand=True, fill="x", pady=2, padx=5, side="right")
-            self._page_width.insert(Tk.END, self.info.page_width)
-            box.pack(fill="x", expand=True)
- 
-            box = Tk.Frame(self._frame)
-            label = Tk.Label(box, text="Scale factor:")
-            label.pack(pady=2, padx=5, side="left", anchor="w")
-            self._scale = Tk.Scale(box, orient="horizontal", from_=0.1, to=10, resolution=0.1)
-            self._scale.pack(expand=True, fill="x", pady=2, padx=5, anchor="e")
-            if not self.info.has_node:
-                self._scale.set(self.info.scale_factor)
-            else:
-                self._scale.set(1.0)
-            box.pack(fill="x", expand=True)
+    def cb_ok(self, widget, data=None):
+        self.update_info(self.info)
+        if self.preview is not None:
+            self.finish_preview()
+        
+        try:
+            self.callback()
+
+        except StandardError, e:
+            err_msg = traceback.format_exc()
+            dlg = gtk.Dialog("Textext Error", self._window, 
+                             gtk.DIALOG_MODAL)
+            dlg.set_default_size(600, 400)
+            btn = dlg.add_button(gtk.STOCK_OK, gtk.RESPONSE_CLOSE)
+            btn.connect("clicked", lambda w, d=None: dlg.destroy())
+            msg = gtk.Label()
+            msg.set_markup("<b>Error occurred while converting text from Latex to SVG:</b>")
             
-            box = Tk.Frame(self._frame)
-            label = Tk.Label(box, text="Converter:")
-            label.pack(pady=2, padx=5, side="left", anchor="w")
-            cvs = ([conv.name for conv in self.info.available_converters]
-                   + [conv.name + " [NOT AVAILABLE CURRENTLY]"
-                      for conv in self.info.unavailable_converters])
-            self._converter = Tk.StringVar()
-            self._converter.set(cvs[0])
-            opt = Tk.OptionMenu(box, self._converter, *cvs)
-            opt.pack(expand=True, fill="x", pady=2, padx=5, anchor="e")
-            box.pack(fill="x", expand=True)
-
-            label = Tk.Label(self._frame, text="Text:")
-            label.pack(pady=2, padx=5, anchor="w")
-
-
-            box = Tk.Frame(self._frame)
-            scrollbar = Tk.Scrollbar(box)
-            scrollbar.pack(side=Tk.RIGHT, fill=Tk.Y)
-
-            self._text = Tk.Text(box)
-            self._text.pack(expand=True, side=Tk.LEFT, fill="both", pady=5, padx=5)
-            self._text.insert(Tk.END, self.info.text)
-
-            self._text.config(yscrollcommand=scrollbar.set)
-            scrollbar.config(command=self._text.yview)
-
-            box.pack(fill="x", expand=True)
-           
-            box = Tk.Frame(self._frame)
-            self._btn = Tk.Button(box, text="OK", command=self.cb_ok)
-            self._btn.pack(ipadx=30, ipady=4, pady=5, padx=5, side="left")
+            txtw = gtk.ScrolledWindow()
+            txtw.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
+            txtw.set_shadow_type(gtk.SHADOW_IN)
+            txt = gtk.TextView()
+            txt.set_editable(False)
+            txt.get_buffer().set_text(err_msg)
+            txtw.add(txt)
             
-            self._cancel = Tk.Button(box, text="Cancel", command=self.cb_cancel)
-            self._cancel.pack(ipadx=30, ipady=4, pady=5, padx=5, side="right")
+            dlg.vbox.pack_start(msg, expand=False, fill=True)
+            dlg.vbox.pack_start(txtw, expand=True, fill=True)
+            dlg.show_all()
+            dlg.run()
+            return False
+        
+        gtk.main_quit()
+        return False
 
-            box.pack(expand=True)
+class AskTextTk(object):
+    """GUI for editing TexText objects"""
+    def __init__(self, info):
+        self.info = info
+        self.callback = None
 
-            while True:
-                root.mainloop()
-                try:
-                    self.callback()
-                    return
-                except StandardError, e:
-                    err = traceback.format_exc()
-
-                    dlg = Tk.Toplevel()
-                    dlg.title("Error")
-
-                    msg = Tk.Message(dlg, text=u"Error occurred while converting text from Latex to SVG:")
-                    msg.pack(expand=True, fill=Tk.X, padx=5)
-
-                    box = Tk.Frame(dlg)
-                    scrollbar = Tk.Scrollbar(box)
-                    scrollbar.pack(side=Tk.RIGHT, fill=Tk.Y)
-                    txt = Tk.Text(box)
-                    txt.pack(expand=True, fill="both", pady=5, padx=5)
-                    txt.insert(Tk.END, err)
-                    txt.config(yscrollcommand=scrollbar.set)
-                    scrollbar.config(command=txt.yview)
-                    box.pack()
-
-                    btn = Tk.Button(dlg, text="OK", command=dlg.destroy)
-                    btn.pack()
-                    dlg.mainloop()
-
-        def cb_cancel(self):
-            raise SystemExit(1)
-    
-        def cb_ok(self):
-            def stru(s):
-                if isinstance(s, unicode):
-                    return s.encode('utf-8')
-                else:
-                    return s
+    def ask(self, callback):
+        self.callback = callback
+        
+        root = Tk.Tk()
+        
+        self._frame = Tk.Frame(root)
+        self._frame.pack()
+        
+        box = Tk.Frame(self._frame)
+        label = Tk.Label(box, text="Preamble file:")
+        label.pack(pady=2, padx=5, side="left", anchor="w")
+        self._preamble = Tk.Entry(box)
+        self._preamble.pack(expand=True, fill="x", pady=2, padx=5, side="right")
+        self._preamble.insert(Tk.END, self.info.preamble_file)
+        box.pack(fill="x", expand=True)
+
+        box = Tk.Frame(self._frame)
+        label = Tk.Label(box, text="LaTeX page width:")
+        label.pack(pady=2, padx=5, side="left", anchor="w")
+        self._page_width = Tk.Entry(box)
+        self._page_width.pack(expand=True, fill="x", pady=2, padx=5, side="right")
+        self._page_width.insert(Tk.END, self.info.page_width)
+        box.pack(fill="x", expand=True)
+
+        box = Tk.Frame(self._frame)
+        label = Tk.Label(box, text="Scale factor:")
+        label.pack(pady=2, padx=5, side="left", anchor="w")
+        self._scale = Tk.Scale(box, orient="horizontal", from_=0.1, to=10, resolution=0.1)
+        self._scale.pack(expand=True, fill="x", pady=2, padx=5, anchor="e")
+        if not self.info.has_node:
+            self._scale.set(self.info.scale_factor)
+        else:
+            self._scale.set(1.0)
+        box.pack(fill="x", expand=True)
+        
+        box = Tk.Frame(self._frame)
+        label = Tk.Label(box, text="Converter:")
+        label.pack(pady=2, padx=5, side="left", anchor="w")
+        cvs = ([conv.name for conv in self.info.available_converters]
+               + [conv.name + " [NOT AVAILABLE CURRENTLY]"
+                  for conv in self.info.unavailable_converters])
+        self._converter = Tk.StringVar()
+        self._converter.set(cvs[0])
+        opt = Tk.OptionMenu(box, self._converter, *cvs)
+        opt.pack(expand=True, fill="x", pady=2, padx=5, anchor="e")
+        box.pack(fill="x", expand=True)
+
+        label = Tk.Label(self._frame, text="Text:")
+        label.pack(pady=2, padx=5, anchor="w")
+
+
+        box = Tk.Frame(self._frame)
+        scrollbar = Tk.Scrollbar(box)
+        scrollbar.pack(side=Tk.RIGHT, fill=Tk.Y)
+
+        self._text = Tk.Text(box)
+        self._text.pack(expand=True, side=Tk.LEFT, fill="both", pady=5, padx=5)
+        self._text.insert(Tk.END, self.info.text)
+
+        self._text.config(yscrollcommand=scrollbar.set)
+        scrollbar.config(command=self._text.yview)
+
+        box.pack(fill="x", expand=True)
+       
+        box = Tk.Frame(self._frame)
+        self._btn = Tk.Button(box, text="OK", command=self.cb_ok)
+        self._btn.pack(ipadx=30, ipady=4, pady=5, padx=5, side="left")
+        
+        self._cancel = Tk.Button(box, text="Cancel", command=self.cb_cancel)
+        self._cancel.pack(ipadx=30, ipady=4, pady=5, padx=5, side="right")
+
+        box.pack(expand=True)
+
+        while True:
+            root.mainloop()
+            try:
+                self.callback()
+                return
+            except StandardError, e:
+                err = traceback.format_exc()
+
+                dlg = Tk.Toplevel()
+                dlg.title("Error")
+
+                msg = Tk.Message(dlg, text=u"Error occurred while converting text from Latex to SVG:")
+                msg.pack(expand=True, fill=Tk.X, padx=5)
+
+                box = Tk.Frame(dlg)
+                scrollbar = Tk.Scrollbar(box)
+                scrollbar.pack(side=Tk.RIGHT, fill=Tk.Y)
+                txt = Tk.Text(box)
+                txt.pack(expand=True, fill="both", pady=5, padx=5)
+                txt.insert(Tk.END, err)
+                txt.config(yscrollcommand=scrollbar.set)
+                scrollbar.config(command=txt.yview)
+                box.pack()
+
+                btn = Tk.Button(dlg, text="OK", command=dlg.destroy)
+                btn.pack()
+                dlg.mainloop()
+
+    def cb_cancel(self):
+        raise SystemExit(1)
+
+    def cb_ok(self):
+        def stru(s):
+            if isinstance(s, unicode):
+                return s.encode('utf-8')
+            else:
+                return s
 
-            self.info.text = stru(self._text.get(1.0, Tk.END))
-            self.info.preamble_file = stru(self._preamble.get())
-            self.info.page_width = stru(self._page_width.get())
-            self.info.selected_converter = bool(self._converter.get())
+        self.info.text = stru(self._text.get(1.0, Tk.END))
+        self.info.preamble_file = stru(self._preamble.get())
+        self.info.page_width = stru(self._page_width.get())
+        self.info.selected_converter = bool(self._converter.get())
 
-            if not self.info.has_node:
-                self.info.scale_factor = self._scale.get()
-            self._frame.quit()
+        if not self.info.has_node:
+            self.info.scale_factor = self._scale.get()
+        self._frame.quit()
 
-else:
-    raise RuntimeError("Neither pygtk nor Tkinter is available!")
+def AskText(info, preview=None):
+    """
+    Create a dialog for editing TexText objects, using any available GUI.
+    The `preview` function is used if the GUI supports previews; see
+    `AskTextGtk`.
+    """
+    toolkit = load_gui()
+    if toolkit == 'gtk':
+        return AskTextGtk(info, preview)
+    else:
+        return AskTextTk(info)
 
 #------------------------------------------------------------------------------
 # Inkscape plugin functionality
@@ -411,6 +620,29 @@ class TexText(inkex.Effect):
         inkex.Effect.__init__(self)
 
         self.settings = Settings()
+
+        # Keyword arguments for the converters
+        self.converter_kw = {}
+        self.converter_kw['cache'] = RenderCache(
+            max_size=self.settings.get("cache_size", int,
+                                       RenderCache.DEFAULT_MAX_SIZE))
+        if self.settings.get("reuse_workspaces", int, 1):
+            self.converter_kw['workspaces'] = WorkspacePool(
+                self.settings.get("workspace_dir", str, None))
+        if self.settings.get("precompile_preamble", int, 1):
+            self.converter_kw['formats'] = FormatCache()
+        deadlines = {}
+        for stage in JobControl.DEFAULT_DEADLINES:
+            value = self.settings.get("timeout_" + stage, float)
+            if value is not None:
+                deadlines[stage] = value
+        self.converter_kw['jobs'] = JobControl(
+            self.settings.get("max_processes", int, 0), deadlines)
+        if self.settings.get("resident_tex", int, 0):
+            self.converter_kw['tex_worker'] = TexWorker(
+                workspaces=self.converter_kw.get('workspaces'))
+        if self.settings.get("resident_inkscape", int, 1):
+            self.converter_kw['shells'] = InkscapeShellPool()
         
         self.OptionParser.add_option(
             "-t", "--text", action="store", type="string",
@@ -433,9 +665,52 @@ class TexText(inkex.Effect):
         self.OptionParser.add_option(
             "-c", "--converter", action="store", type="string",
             dest="selected_converter", default=None)
+        self.OptionParser.add_option(
+            "-b", "--batch", action="store_true",
+            dest="batch", default=False)
+        self.OptionParser.add_option(
+            "--shared-glyphs", action="store_true",
+            dest="shared_glyphs", default=None)
+        self.OptionParser.add_option(
+            "--no-shared-glyphs", action="store_false",
+            dest="shared_glyphs", default=None)
+        self.OptionParser.add_option(
+            "--precision", action="store", type="int",
+            dest="precision", default=None)
+        self.OptionParser.add_option(
+            "--clones", action="store_true",
+            dest="clones", default=None)
+        self.OptionParser.add_option(
+            "--no-clones", action="store_false",
+            dest="clones", default=None)
+        self.OptionParser.add_option(
+            "--bake-transform", action="store_true",
+            dest="bake_transform", default=None)
+        self.OptionParser.add_option(
+            "--no-bake-transform", action="store_false",
+            dest="bake_transform", default=None)
+        self.OptionParser.add_option(
+            "--threads", action="store_true",
+            dest="batch_threads", default=None)
+        self.OptionParser.add_option(
+            "--trace", action="store", type="string",
+            dest="trace", default=None)
 
     def effect(self):
         """Perform the effect: create/modify TexText objects"""
+        if self.options.trace:
+            tracer.open(self.options.trace)
+
+        # Re-render many objects at once, without asking
+        if self.options.batch or (self.options.text is None
+                                  and len(self.get_old_nodes()) > 1):
+            stage = tracer.start('batch_convert')
+            try:
+                self.batch_convert()
+            finally:
+                stage.end()
+            return
+
         # Load default convert info from settings
         info = ConvertInfo()
         info.load_from_settings(self.settings)
@@ -452,34 +727,236 @@ class TexText(inkex.Effect):
 
         # Update convert info from GUI (if we're not supplied with text from cmd)
         if self.options.text is None:
-            asker = AskText(info)
+            asker = AskText(info, self.render_preview)
+            if getattr(asker, 'preview', None) is None:
+                self.drop_tex_worker()
             asker.ask(lambda: self.do_convert(info, old_node))
         else:
+            self.drop_tex_worker()
             self.do_convert(info, old_node)
 
-    def do_convert(self, info, old_node):
-        # Must have some text to convert
+    def drop_tex_worker(self):
+        """
+        Don't use a resident pdflatex for a single conversion: it would
+        only start a standby process that no job ever takes.
+        """
+        self.converter_kw.pop('tex_worker', None)
+
+    def render_preview(self, info, jobs=None):
+        """
+        Convert `info` for previewing. This is safe to run in a
+        background thread, and leaves the result in the render cache
+        for the final conversion.
+
+        :Parameters:
+          - `jobs`: JobControl through which the conversion can be
+            cancelled, or None
+        :Returns: standalone SVG document as a string, or None
+        """
         if not info.text:
-            return
+            return None
+
+        converter_kw = dict(self.converter_kw)
+        if jobs is not None:
+            if converter_kw.get('jobs') is not None:
+                jobs.deadlines.update(converter_kw['jobs'].deadlines)
+            converter_kw['jobs'] = jobs
 
-        # Convert
         converter = None
         try:
             converter_cls = info.get_converter_cls()
-            converter = converter_cls(self.document)
-            new_node = converter.convert(info)
+            converter = converter_cls(None, **converter_kw)
+            node = converter.convert(info)
         finally:
             if converter is not None:
                 converter.finish()
+        if node is None:
+            return None
+        return make_preview_svg(node)
+
+    def do_convert(self, info, old_node):
+        # Must have some text to convert
+        if not info.text:
+            return
+
+        converter_cls = info.get_converter_cls()
+        fingerprint = info.fingerprint(converter_cls)
+
+        # Nothing to do if the source is unchanged, unless the object
+        # is to stop being a clone
+        if (old_node is not None and fingerprint == info.old_fingerprint
+                and (self.use_clones() or not self.is_clone(old_node))):
+            tracer.record('unchanged', converter=converter_cls.name)
+            info.save_to_node(old_node)
+            info.save_to_settings(self.settings)
+            return
+
+        # Show an identical object already in the document, if any
+        master = None
+        if self.use_clones():
+            master = self.get_master(fingerprint, bool(info.bake_transform))
+
+        if master is not None:
+            tracer.record('clone', converter=converter_cls.name)
+            new_node = self.make_clone(master, info, converter_cls)
+        else:
+            # Convert
+            converter = None
+            try:
+                converter = converter_cls(self.document, **self.converter_kw)
+                new_node = converter.convert(info)
+            finally:
+                if converter is not None:
+                    converter.finish()
 
         if new_node is None:
             return # noop
 
-        # Insert into document
+        new_node.attrib['{%s}fingerprint' % TEXTEXT_NS] = fingerprint
+        self.insert_node(info, old_node, new_node)
+        # Objects may also have been deleted since the last run
+        self.collect_masters()
+        if self.use_shared_glyphs():
+            self.collect_glyphs()
+
+        # -- Save settings
+        info.save_to_settings(self.settings)
+
+    def batch_convert(self):
+        """
+        Re-render the selected TexText objects, or all of them in the
+        document if none are selected. The conversions are run in
+        parallel, in a pool of worker processes or threads.
+        """
+        nodes = self.get_old_nodes()
+        if not nodes:
+            nodes = self.find_all_nodes()
+        if not nodes:
+            return
+
+        base_info = ConvertInfo()
+        base_info.load_from_settings(self.settings)
+
+        infos = []
+        for node in nodes:
+            info = copy.copy(base_info)
+            info.load_from_node(node)
+            text = info.text
+            info.load_from_options(self.options)
+            info.text = text
+            infos.append(info)
+
+        # Group objects that can share a Latex run, and split the groups
+        # in chunks so that all the workers have something to do.
+        # Objects whose source is unchanged are skipped, and with clones,
+        # identical objects are converted only once.
+        groups = {}
+        group_order = []
+        fingerprints = {}
+        clones = []
+        converted = set()
+        use_clones = self.use_clones()
+        for j, info in enumerate(infos):
+            converter_cls = info.get_converter_cls()
+            fingerprints[j] = info.fingerprint(converter_cls)
+            if (fingerprints[j] == info.old_fingerprint
+                    and (use_clones or not self.is_clone(nodes[j]))):
+                continue
+            if use_clones:
+                master_key = (fingerprints[j], bool(info.bake_transform))
+                if (master_key in converted
+                        or self.get_master(*master_key) is not None):
+                    clones.append(j)
+                    continue
+                converted.add(master_key)
+            group_key = (converter_cls, info.read_preamble(),
+                         info.page_width)
+            if group_key not in groups:
+                groups[group_key] = []
+                group_order.append(group_key)
+            groups[group_key].append(j)
+
+        if not groups and not clones:
+            return
+
+        chunk_size = -(-len(infos) // cpu_count())
+        jobs = []
+        job_nodes = []
+        for group_key in group_order:
+            group = groups[group_key]
+            for k in range(0, len(group), chunk_size):
+                chunk = group[k:k+chunk_size]
+                jobs.append((group_key[0], [infos[j] for j in chunk],
+                             self.converter_kw, os.getpid()))
+                job_nodes.append(chunk)
+
+        threads = self.options.batch_threads
+        if threads is None:
+            threads = self.settings.get("batch_threads", int, 0)
+        results = []
+        if jobs:
+            try:
+                results = map_parallel(_batch_convert, jobs,
+                                       threads=bool(threads))
+            finally:
+                close_resources(self.converter_kw)
+
+        errors = []
+        for chunk, job_results in zip(job_nodes, results):
+            for j, (xml, err) in zip(chunk, job_results):
+                if err is not None:
+                    errors.append("%s:\n%s" % (infos[j].text, err))
+                elif xml is not None:
+                    new_node = etree.fromstring(xml)
+                    new_node.attrib['{%s}fingerprint' % TEXTEXT_NS] = \
+                        fingerprints[j]
+                    self.insert_node(infos[j], nodes[j], new_node)
+
+        # The masters exist now, unless their conversion failed. The
+        # transform may not have been baked in as asked, but the clones
+        # follow their master in that.
+        for j in clones:
+            master = (self.get_master(fingerprints[j],
+                                      bool(infos[j].bake_transform))
+                      or self.get_master(fingerprints[j]))
+            if master is None:
+                continue
+            new_node = self.make_clone(master, infos[j],
+                                       infos[j].get_converter_cls())
+            new_node.attrib['{%s}fingerprint' % TEXTEXT_NS] = fingerprints[j]
+            self.insert_node(infos[j], nodes[j], new_node)
+
+        self.collect_masters()
+        if self.use_shared_glyphs():
+            self.collect_glyphs()
+
+        if errors:
+            inkex.errormsg("Failed to convert %d of %d objects:\n\n%s"
+                           % (len(errors), len(nodes), "\n".join(errors)))
+
+    def insert_node(self, info, old_node, new_node):
+        """
+        Insert a freshly converted node into the document,
+        in place of `old_node` if it is given.
+        """
+        stage = tracer.start('insert_node')
+        try:
+            self._insert_node(info, old_node, new_node)
+        finally:
+            stage.end()
 
+    def _insert_node(self, info, old_node, new_node):
         # -- Set textext attribs
         info.save_to_node(new_node)
 
+        # -- Share glyph definitions with other objects
+        if self.use_shared_glyphs():
+            self.share_glyphs(new_node)
+
+        # -- Share the rendering with identical objects
+        if self.use_clones():
+            self.share_rendering(new_node)
+
         # -- Copy transform
         try:
             # Note: the new node does *not* have the SVG namespace prefixes!
@@ -519,32 +996,44 @@ class TexText(inkex.Effect):
 
         # -- Replace
         self.replace_node(old_node, new_node)
-
-        # -- Save settings
-        info.save_to_settings(self.settings)
    
     def get_old(self):
         """
         Dig out LaTeX code and name of preamble file from old
         TexText-generated objects.
 
-        :Returns: (old_node, ConvertInfo)
+        :Returns: old_node, or None
         """
-        
-        info = ConvertInfo()
+        nodes = self.get_old_nodes()
+        if nodes:
+            return nodes[0]
+        return None
+
+    def get_old_nodes(self):
+        """
+        :Returns: list of the selected TexText-generated objects
+        """
+        nodes = []
         for i in self.options.ids:
             node = self.selected[i]
             if node.tag != '{%s}g' % SVG_NS: continue
             
             if '{%s}text'%TEXTEXT_NS in node.attrib:
                 # starting from 0.2, use namespaces
-                return node
+                nodes.append(node)
 
             elif '{%s}text'%SVG_NS in node.attrib:
                 # < 0.2 backward compatibility
-                return node
+                nodes.append(node)
 
-        return None
+        return nodes
+
+    def find_all_nodes(self):
+        """
+        :Returns: list of all TexText-generated objects in the document
+        """
+        return self.document.xpath('//svg:g[@textext:text or @svg:text]',
+                                   namespaces=NSS)
 
     def replace_node(self, old_node, new_node):
         """
@@ -555,8 +1044,177 @@ class TexText(inkex.Effect):
             self.current_layer.append(new_node)
         else:
             parent = old_node.getparent()
+            parent.insert(parent.index(old_node), new_node)
             parent.remove(old_node)
-            parent.append(new_node)
+
+    #-- Shared glyph definitions
+
+    def use_shared_glyphs(self):
+        """Whether glyph definitions are shared between objects"""
+        if self.options.shared_glyphs is not None:
+            return self.options.shared_glyphs
+        return bool(self.settings.get("shared_glyphs", int, 0))
+
+    def get_defs(self):
+        """Return the <svg:defs> element of the document, creating it if needed"""
+        root = self.document.getroot()
+        defs = root.find('{%s}defs' % SVG_NS)
+        if defs is None:
+            defs = etree.Element('{%s}defs' % SVG_NS)
+            root.insert(0, defs)
+        return defs
+
+    def share_glyphs(self, new_node):
+        """
+        Move the glyph definitions of `new_node` to the document <defs>,
+        under ids derived from their outlines, so that each distinct
+        glyph is stored only once in the document.
+
+        Glyphs are the <symbol> and <path> definitions that the
+        converter output references from <use> elements.
+        """
+        href = '{%s}href' % XLINK_NS
+        uses = new_node.xpath('.//use[@xlink:href]', namespaces=NSS)
+        used_ids = set([use.attrib[href][1:] for use in uses])
+
+        defs = self.get_defs()
+        shared_ids = set(defs.xpath('*[starts-with(@id, "%s")]/@id'
+                                    % GLYPH_PREFIX))
+
+        href_map = {}
+        for el in new_node.xpath('.//defs//*[@id]'):
+            cur_id = el.attrib['id']
+            if cur_id not in used_ids or el.tag not in ('symbol', 'path'):
+                continue
+
+            # Identify the glyph by everything except its id
+            del el.attrib['id']
+            digest = hashlib.md5(etree.tostring(el, with_tail=False))
+            new_id = GLYPH_PREFIX + digest.hexdigest()[:16]
+            href_map['#' + cur_id] = '#' + new_id
+
+            parent = el.getparent()
+            parent.remove(el)
+            if new_id not in shared_ids:
+                el.tail = None
+                el.attrib['id'] = new_id
+                defs.append(el)
+                shared_ids.add(new_id)
+
+            # Drop containers left empty
+            while (len(parent) == 0 and parent is not new_node
+                   and parent.tag in ('g', 'defs')):
+                grandparent = parent.getparent()
+                grandparent.remove(parent)
+                parent = grandparent
+
+        for use in uses:
+            value = use.attrib[href]
+            use.attrib[href] = href_map.get(value, value)
+
+    def collect_glyphs(self):
+        """Remove shared glyph definitions no longer used in the document"""
+        used = set(self.document.xpath('//@xlink:href', namespaces=NSS))
+        for el in self.get_defs().xpath('*[starts-with(@id, "%s")]'
+                                        % GLYPH_PREFIX):
+            if '#' + el.attrib['id'] not in used:
+                el.getparent().remove(el)
+
+    #-- Clones of identical objects
+
+    def use_clones(self):
+        """
+        Whether identical objects show a single master rendering
+        through <use>, instead of each having its own copy
+        """
+        if self.options.clones is not None:
+            return self.options.clones
+        return bool(self.settings.get("clones", int, 0))
+
+    def get_master(self, fingerprint, baked=None):
+        """
+        Return the master rendering in <defs> for objects with
+        `fingerprint`, or None. Unless `baked` is None, the master must
+        have the transform baked in (or not) as given.
+        """
+        master_id = MASTER_PREFIX + fingerprint
+        for el in self.get_defs().xpath('*[starts-with(@id, $id)]',
+                                        id=master_id):
+            suffix = el.attrib['id'][len(master_id):]
+            if suffix not in ('', '-baked'):
+                continue
+            if baked is None or baked == (suffix == '-baked'):
+                return el
+        return None
+
+    def make_clone(self, master, info, converter_cls):
+        """
+        Create an object showing `master`, with the transform a fresh
+        conversion of `info` with `converter_cls` would have.
+        """
+        baked = master.attrib['id'].endswith('-baked')
+        new_node = etree.Element('g')
+        use = etree.SubElement(new_node, 'use', nsmap={'xlink': XLINK_NS})
+        use.attrib['{%s}href' % XLINK_NS] = '#' + master.attrib['id']
+        if info.scale_factor is not None:
+            if baked:
+                new_node.attrib['transform'] = 'scale(%f,%f)' % (
+                    info.scale_factor, info.scale_factor)
+            else:
+                new_node.attrib['transform'] = \
+                    converter_cls.get_transform(info.scale_factor)
+        if baked:
+            new_node.attrib['{%s}baked' % TEXTEXT_NS] = '1'
+        return new_node
+
+    def is_clone(self, node):
+        """Whether `node` shows a master rendering"""
+        if len(node) != 1 or node[0].tag not in ('use', '{%s}use' % SVG_NS):
+            return False
+        href = node[0].attrib.get('{%s}href' % XLINK_NS, '')
+        return href.startswith('#' + MASTER_PREFIX)
+
+    def share_rendering(self, new_node):
+        """
+        Turn a freshly converted `new_node` into a clone: move its
+        contents to a new master rendering in <defs>, or drop them if
+        there already is an identical one.
+
+        The master holds only the contents, in the coordinates of the
+        converter output; the transform stays on the clone, as it would
+        on a converted object.
+        """
+        fingerprint = new_node.attrib.get('{%s}fingerprint' % TEXTEXT_NS)
+        if fingerprint is None or self.is_clone(new_node):
+            return
+
+        baked = new_node.attrib.get('{%s}baked' % TEXTEXT_NS) == '1'
+        master = self.get_master(fingerprint, baked)
+        if master is None:
+            master = etree.SubElement(self.get_defs(), 'g')
+            master.attrib['id'] = MASTER_PREFIX + fingerprint
+            if baked:
+                master.attrib['id'] += '-baked'
+            for child in new_node:
+                master.append(child)
+        else:
+            for child in list(new_node):
+                new_node.remove(child)
+
+        new_node.text = None
+        use = etree.SubElement(new_node, 'use', nsmap={'xlink': XLINK_NS})
+        use.attrib['{%s}href' % XLINK_NS] = '#' + master.attrib['id']
+
+    def collect_masters(self):
+        """Remove master renderings no longer used in the document"""
+        masters = self.get_defs().xpath('*[starts-with(@id, "%s")]'
+                                        % MASTER_PREFIX)
+        if not masters:
+            return
+        used = set(self.document.xpath('//@xlink:href', namespaces=NSS))
+        for el in masters:
+            if '#' + el.attrib['id'] not in used:
+                el.getparent().remove(el)
 
 
     STYLE_ATTRS = ['fill','fill-opacity','fill-rule',
@@ -583,24 +1241,125 @@ class TexText(inkex.Effect):
         except (KeyError, IndexError, TypeError, AttributeError):
             pass
 
+def _batch_convert(job):
+    """
+    Convert a list of objects in a batch job.
+
+    This runs in a worker process, so the results are passed back
+    serialized. Jobs run in the process `parent_pid` share its
+    resources for reuse, and leave closing them to it.
+
+    :Returns: list of (xml, error) pairs, either of which may be None
+    """
+    converter_cls, infos, converter_kw, parent_pid = job
+    converter = None
+    try:
+        try:
+            converter = converter_cls(None, **converter_kw)
+            # Nothing follows the job in a worker process
+            nodes = converter.convert_many(
+                infos, standby=os.getpid() == parent_pid)
+        except StandardError:
+            if converter is None or len(infos) == 1:
+                return [(None, traceback.format_exc())] * len(infos)
+
+            # A single bad snippet spoils a shared Latex run:
+            # convert the objects one by one instead
+            nodes = []
+            errors = []
+            for info in infos:
+                try:
+                    nodes.append(converter.convert(info))
+                    errors.append(None)
+                except StandardError:
+                    nodes.append(None)
+                    errors.append(traceback.format_exc())
+        else:
+            errors = [None] * len(infos)
+    finally:
+        if converter is not None:
+            converter.finish()
+        # Worker processes exit without running atexit handlers
+        if os.getpid() != parent_pid:
+            close_resources(converter_kw)
+
+    results = []
+    for new_node, err in zip(nodes, errors):
+        if new_node is None:
+            results.append((None, err))
+        else:
+            results.append((etree.tostring(new_node, with_tail=False), None))
+    return results
+
+def close_resources(converter_kw):
+    """
+    Stop the processes and remove the directories kept for reuse in
+    the converter keyword arguments `converter_kw`
+    """
+    # The worker returns its workspace to the pool: close it first
+    for name in ('tex_worker', 'workspaces', 'shells'):
+        if converter_kw.get(name) is not None:
+            converter_kw[name].close()
+
+def cpu_count():
+    """Return the number of available cores"""
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+def map_parallel(func, jobs, threads=False):
+    """
+    Apply `func` to each of `jobs` in a pool of worker processes, or of
+    threads if `threads` is true, one per available core. Falls back to
+    running sequentially.
+    """
+    num_workers = min(cpu_count(), len(jobs))
+    if num_workers < 2:
+        return map(func, jobs)
+
+    if threads:
+        from multiprocessing.dummy import Pool
+    else:
+        from multiprocessing import Pool
+
+    pool = Pool(num_workers)
+    try:
+        return pool.map(func, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
 #------------------------------------------------------------------------------
 # Settings backend
 #------------------------------------------------------------------------------
 
+def get_config_dir():
+    """
+    Return the directory where Textext keeps its configuration and caches.
+    """
+    if USE_WINDOWS:
+        base = os.environ.get('APPDATA', os.path.expanduser("~"))
+        return os.path.join(base, "TexText")
+
+    dir_1 = os.path.expanduser("~/.config/inkscape")
+    dir_2 = os.path.expanduser("~/.inkscape")
+
+    if os.path.isdir(dir_1):
+        # Since Inkscape 0.47
+        return dir_1
+    else:
+        return dir_2
+
 class Settings(object):
     def __init__(self):
         self.values = {}
 
-        dir_1 = os.path.expanduser("~/.config/inkscape")
-        dir_2 = os.path.expanduser("~/.inkscape")
-
         if USE_WINDOWS:
             self.keyname = r"Software\TexText\TexText"
-        elif os.path.isdir(dir_1):
-            # Since Inkscape 0.47
-            self.filename = os.path.join(dir_1, "textextrc")
         else:
-            self.filename = os.path.join(dir_2, "textextrc")
+            self.filename = os.path.join(get_config_dir(), "textextrc")
 
         self.load()
 
@@ -655,22 +1414,1368 @@ class Settings(object):
             
             f = open(self.filename, 'w')
             try:
-                data = '\n'.join(["%s = %s" % (k, v)
-                                  for k, v in self.values.iteritems()])
-                data += '\n'
-                f.write(data)
-            finally:
-                f.close()
-    
-    def get(self, key, typecast, default=None):
-        try:
-            return typecast(self.values[key])
-        except (KeyError, ValueError, TypeError):
-            return default
+                data = '\n'.join(["%s = %s" % (k, v)
+                                  for k, v in self.values.iteritems()])
+                data += '\n'
+                f.write(data)
+            finally:
+                f.close()
+    
+    def get(self, key, typecast, default=None):
+        try:
+            return typecast(self.values[key])
+        except (KeyError, ValueError, TypeError):
+            return default
+
+    def set(self, key, value):
+        self.values[key] = str(value)
+
+
+#------------------------------------------------------------------------------
+# Instrumentation
+#------------------------------------------------------------------------------
+
+try:
+    import json
+except ImportError:
+    json = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+def get_rusage():
+    """
+    :Returns: CPU times and peak memory of this process and of its
+              waited-for children, or None if not available
+    """
+    if resource is None:
+        return None
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return dict(utime=own.ru_utime, stime=own.ru_stime,
+                maxrss=own.ru_maxrss,
+                child_utime=children.ru_utime, child_stime=children.ru_stime,
+                child_maxrss=children.ru_maxrss)
+
+class TraceStage(dict):
+    """
+    A stage being timed. Extra fields (output sizes, cache outcomes,
+    ...) can be set as items before calling `end`.
+    """
+
+    def __init__(self, tracer, name, fields):
+        dict.__init__(self, fields)
+        self.tracer = tracer
+        self['stage'] = name
+        self['pid'] = os.getpid()
+        self['time'] = time.time()
+        self._usage = get_rusage()
+
+    def end(self, **fields):
+        """Finish the stage, and write its record"""
+        self.update(fields)
+        self['wall'] = time.time() - self['time']
+        usage = get_rusage()
+        if usage is not None:
+            for key in ('utime', 'stime', 'child_utime', 'child_stime'):
+                self[key] = usage[key] - self._usage[key]
+            # Peaks cannot be subtracted; the children's one is the largest
+            # of all children waited for so far
+            self['maxrss'] = usage['maxrss']
+            self['child_maxrss'] = usage['child_maxrss']
+        self.tracer.write(self)
+
+class NullTraceStage(dict):
+    """Stage returned when tracing is disabled"""
+    def end(self, **fields):
+        pass
+
+class Tracer(object):
+    """
+    Record the wall time and resource usage of conversion stages as
+    JSON lines appended to a file, for analysis offline. Tracing is
+    disabled unless a file is given, in the TEXTEXT_TRACE environment
+    variable or with the --trace option.
+
+    Usage::
+
+        stage = tracer.start('pdf_to_svg', converter='Pdf2Svg')
+        try:
+            ...
+            stage['bytes'] = os.path.getsize(svg_file)
+        finally:
+            stage.end()
+    """
+
+    def __init__(self, filename=None):
+        self.filename = None
+        self._file = None
+        self._lock = threading.Lock()
+        if filename:
+            self.open(filename)
+
+    def open(self, filename):
+        """Start appending records to `filename`"""
+        if json is None:
+            return
+        self.close()
+        self._file = open(filename, 'a')
+        self.filename = filename
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+        self.filename = None
+
+    def enabled(self):
+        return self._file is not None
+    enabled = property(enabled)
+
+    def start(self, name, **fields):
+        """
+        Start timing a stage.
+
+        :Returns: `TraceStage`, whose `end` method must be called
+        """
+        if self._file is None:
+            return NullTraceStage()
+        return TraceStage(self, name, fields)
+
+    def record(self, name, **fields):
+        """Write a record for an event without a duration"""
+        if self._file is None:
+            return
+        fields['stage'] = name
+        fields['pid'] = os.getpid()
+        fields['time'] = time.time()
+        self.write(fields)
+
+    def write(self, fields):
+        line = json.dumps(fields, sort_keys=True)
+        self._lock.acquire()
+        try:
+            # One write per line, so that records written by batch
+            # worker processes do not get mixed up
+            self._file.write(line + '\n')
+            self._file.flush()
+        finally:
+            self._lock.release()
+
+tracer = Tracer(os.environ.get('TEXTEXT_TRACE'))
+
+#------------------------------------------------------------------------------
+# Render cache
+#------------------------------------------------------------------------------
+
+class RenderCache(object):
+    """
+    Persistent on-disk cache of rendered SVG fragments.
+
+    Each entry is stored in its own file, named after a content hash
+    (see `ConvertInfo.cache_key`). When the total size of the entries
+    exceeds `max_size` bytes, the least recently used ones are evicted.
+    A `max_size` of zero disables the cache.
+    """
+
+    DEFAULT_MAX_SIZE = 20*1024*1024
+
+    def __init__(self, path=None, max_size=DEFAULT_MAX_SIZE):
+        if path is None:
+            path = os.path.join(get_config_dir(), "textext-cache")
+        self.path = path
+        self.max_size = max_size
+
+    # Prefix of the ids in the stored entries
+    NEUTRAL_ID_PREFIX = "id"
+
+    def get(self, key, id_prefix=None):
+        """
+        Return the cached <svg:g> node for `key`, or None if not cached.
+
+        The ids in the node are renamed to `id_prefix` + running number,
+        if it is given: the same entry may be inserted in a document
+        more than once, and ids must stay unique there.
+        """
+        if not self.max_size:
+            return None
+
+        filename = self._filename(key)
+        try:
+            node = etree.parse(filename).getroot()
+        except (IOError, OSError, etree.XMLSyntaxError):
+            return None
+
+        # Mark the entry as recently used
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+
+        if id_prefix is not None:
+            rename_ids(node, id_prefix)
+        return node
+
+    def put(self, key, node):
+        """
+        Store a copy of `node` under `key`, evicting old entries if needed.
+        The ids are stored renamed to neutral ones.
+        """
+        if not self.max_size:
+            return
+
+        node = copy.deepcopy(node)
+        rename_ids(node, self.NEUTRAL_ID_PREFIX)
+
+        filename = self._filename(key)
+        tmp_filename = "%s.%d-%d.tmp" % (filename, os.getpid(),
+                                         id(threading.currentThread()))
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            f = open(tmp_filename, 'w')
+            try:
+                f.write(etree.tostring(node, with_tail=False))
+            finally:
+                f.close()
+            if USE_WINDOWS and os.path.exists(filename):
+                os.remove(filename)
+            os.rename(tmp_filename, filename)
+        except (IOError, OSError):
+            # The cache is best-effort only
+            if os.path.isfile(tmp_filename):
+                os.remove(tmp_filename)
+            return
+
+        self._evict()
+
+    def _filename(self, key):
+        return os.path.join(self.path, key + '.svg')
+
+    def _evict(self):
+        """Remove least recently used entries until within `max_size`"""
+        entries = []
+        total = 0
+        for filename in glob.glob(os.path.join(self.path, '*.svg')):
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, filename))
+            total += st.st_size
+
+        entries.sort()
+        while total > self.max_size and entries:
+            mtime, size, filename = entries.pop(0)
+            try:
+                os.remove(filename)
+            except OSError:
+                continue
+            total -= size
+
+class FormatCache(object):
+    """
+    Precompiled Latex formats (.fmt) for document preambles.
+
+    A format is dumped the first time a preamble is seen, and is
+    named after a hash of the preamble content, so that changing the
+    preamble automatically leads to a new format. Only the
+    `MAX_FORMATS` most recently used formats are kept.
+
+    A failure to dump a format is remembered for `RETRY_DELAY`
+    seconds, after which the format is tried again: the cause may well
+    have been temporary.
+    """
+
+    MAX_FORMATS = 10
+    RETRY_DELAY = 3600
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(get_config_dir(), "textext-formats")
+        self.path = path
+
+    def get(self, head, engine, work_path, timeout=None, jobs=None):
+        """
+        Return the format name for a document starting with `head`,
+        dumping it with `engine` in `work_path` if necessary.
+
+        :Parameters:
+          - `timeout`: deadline in seconds for dumping, or None
+          - `jobs`: JobControl to dump under, or None
+        :Returns: absolute file name of the format without the .fmt
+                  suffix, or None if the preamble cannot be dumped.
+        """
+        key = hashlib.md5("%s\n%s" % (engine, head)).hexdigest()
+        name = os.path.join(self.path, key)
+
+        if os.path.isfile(name + '.fmt'):
+            try:
+                os.utime(name + '.fmt', None)
+            except OSError:
+                pass
+            return name
+        if self._failed_recently(name):
+            return None
+
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            self._dump(head, engine, work_path, key, name, timeout, jobs)
+        except (RuntimeError, IOError, OSError):
+            if jobs is not None and jobs.cancelled:
+                raise
+            # Remember the failure, so that we don't retry on every run;
+            # the time of the failure is that of the marker file
+            try:
+                open(name + '.failed', 'w').close()
+            except (IOError, OSError):
+                pass
+            self._prune()
+            return None
+
+        self._prune()
+        return name
+
+    def invalidate(self, name):
+        """Remove a format that turned out to be unusable"""
+        if os.path.isfile(name + '.fmt'):
+            os.remove(name + '.fmt')
+
+    def _failed_recently(self, name):
+        """Whether dumping the format `name` failed less than
+        `RETRY_DELAY` seconds ago"""
+        try:
+            mtime = os.stat(name + '.failed').st_mtime
+        except OSError:
+            return False
+        return 0 <= time.time() - mtime < self.RETRY_DELAY
+
+    def _dump(self, head, engine, work_path, key, name, timeout, jobs):
+        tex_file = os.path.join(work_path, key + '.tex')
+        f = open(tex_file, 'w')
+        try:
+            f.write(head)
+            f.write("\n\\dump\n")
+        finally:
+            f.close()
+
+        try:
+            exec_command([engine, '-ini', '-jobname=%s' % key,
+                          '-interaction=nonstopmode', '-halt-on-error',
+                          '&%s' % engine, tex_file], cwd=work_path,
+                         timeout=timeout, jobs=jobs)
+
+            fmt_file = os.path.join(work_path, key + '.fmt')
+            if not os.path.isfile(fmt_file):
+                raise RuntimeError("%s didn't produce a format file" % engine)
+
+            # Others may be dumping the same format concurrently
+            tmp_name = "%s.%d-%d.tmp" % (name, os.getpid(),
+                                         id(threading.currentThread()))
+            shutil.move(fmt_file, tmp_name)
+            if USE_WINDOWS and os.path.exists(name + '.fmt'):
+                os.remove(name + '.fmt')
+            os.rename(tmp_name, name + '.fmt')
+        finally:
+            for filename in glob.glob(os.path.join(work_path, key + '.*')):
+                os.remove(filename)
+
+    def _prune(self):
+        """Remove the least recently used formats and failure markers,
+        and the expired failure markers"""
+        entries = []
+        for filename in (glob.glob(os.path.join(self.path, '*.fmt'))
+                         + glob.glob(os.path.join(self.path, '*.failed'))):
+            name, ext = os.path.splitext(filename)
+            try:
+                if ext == '.failed' and not self._failed_recently(name):
+                    os.remove(filename)
+                else:
+                    entries.append((os.stat(filename).st_mtime, filename))
+            except OSError:
+                pass
+        entries.sort()
+        for mtime, filename in entries[:-self.MAX_FORMATS]:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+class TexWorker(object):
+    """
+    Resident pdflatex process, ready for the next conversion.
+
+    The process is started ahead of time with the document preamble
+    loaded, and then waits in a ``\\read`` on stdin for the name of a
+    file containing the document body. As pdflatex writes the PDF only
+    once the document ends, each process typesets a single document: a
+    replacement is started as soon as the previous one is taken into
+    use, so that the startup and preamble costs are paid in the
+    background. A worker that has exited or crashed is simply replaced.
+
+    This only pays off when more jobs are known to follow, as in batch
+    conversions and previews; single conversions do without. No
+    replacement is started after a job typeset with ``standby=False``,
+    nor once the worker has been closed.
+    """
+
+    DRIVER = r"""%s
+{\endlinechar=-1 \global\read16 to \textextbody}
+\input{\textextbody}
+"""
+
+    def __init__(self, engine='pdflatex', workspaces=None):
+        self.engine = engine
+        self.workspaces = workspaces
+        self.process = None
+        self.path = None
+        self.signature = None
+        self.closed = False
+        self._registered = False
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        # Running processes cannot be shared with other Python processes
+        state = self.__dict__.copy()
+        state['process'] = state['path'] = state['signature'] = None
+        state['_registered'] = False
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def typeset(self, head, body, latex_opts, pdf_file, timeout=None,
+                jobs=None, standby=True):
+        """
+        Typeset the document `head` + `body` to `pdf_file`.
+
+        :Parameters:
+          - `head`: document class and preamble
+          - `body`: rest of the document
+          - `latex_opts`: additional options for pdflatex
+          - `pdf_file`: output file name
+          - `timeout`: deadline in seconds, or None
+          - `jobs`: JobControl to run under, or None
+          - `standby`: whether to get a process ready for the next job
+        :Returns: pdflatex output
+        """
+        signature = (head, tuple(latex_opts))
+        self._lock.acquire()
+        try:
+            if (self.process is None or self.signature != signature
+                    or self.process.poll() is not None):
+                self._close()
+                self._start(head, latex_opts)
+
+            # Take the waiting process for ourselves
+            process, path = self.process, self.path
+            self.process = self.path = self.signature = None
+        finally:
+            self._lock.release()
+
+        try:
+            f = open(os.path.join(path, 'body.tex'), 'w')
+            try:
+                f.write(body)
+            finally:
+                f.close()
+
+            if jobs is not None:
+                jobs.acquire()
+            try:
+                out, err, expired = communicate(process, "body.tex\n",
+                                                timeout, jobs)
+            finally:
+                if jobs is not None:
+                    jobs.release()
+            if expired:
+                raise CommandTimeout("%s timed out after %g s"
+                                     % (self.engine, timeout))
+            if process.returncode != 0:
+                raise RuntimeError("Command %s failed (code %d): %s"
+                                   % (self.engine, process.returncode, out))
+            if not os.path.isfile(os.path.join(path, 'tmp.pdf')):
+                raise RuntimeError("%s didn't produce output:\n\n%s"
+                                   % (self.engine, out))
+            shutil.move(os.path.join(path, 'tmp.pdf'), pdf_file)
+        finally:
+            self._remove_path(path)
+
+            # Get the next one ready, unless another thread already did
+            self._lock.acquire()
+            try:
+                if standby and not self.closed and self.process is None:
+                    self._start(head, latex_opts)
+            finally:
+                self._lock.release()
+        return out
+
+    def close(self):
+        """Stop the waiting process, if any, and don't start new ones"""
+        self._lock.acquire()
+        try:
+            self.closed = True
+            self._close()
+        finally:
+            self._lock.release()
+
+    def _close(self):
+        if self.process is not None:
+            # Pdflatex exits when its \read hits end of file
+            try:
+                self.process.stdin.close()
+                self.process.wait()
+            except (IOError, OSError):
+                pass
+            self.process = None
+        if self.path is not None:
+            self._remove_path(self.path)
+            self.path = None
+        self.signature = None
+
+    def _remove_path(self, path):
+        if self.workspaces is not None:
+            self.workspaces.release(path)
+        else:
+            shutil.rmtree(path, True)
+
+    def _start(self, head, latex_opts):
+        if self.workspaces is not None:
+            self.path = self.workspaces.acquire()
+        else:
+            self.path = tempfile.mkdtemp()
+        f = open(os.path.join(self.path, 'driver.tex'), 'w')
+        try:
+            f.write(self.DRIVER % head)
+        finally:
+            f.close()
+
+        # Reading from the terminal is not possible in nonstop mode
+        cmd = ([self.engine, '-jobname=tmp', '-interaction=scrollmode',
+                '-halt-on-error'] + list(latex_opts) + ['driver.tex'])
+        try:
+            self.process = subprocess.Popen(cmd, cwd=self.path,
+                                            stdin=subprocess.PIPE,
+                                            stdout=subprocess.PIPE,
+                                            stderr=subprocess.STDOUT,
+                                            **process_group_options())
+        except OSError, e:
+            self._remove_path(self.path)
+            self.path = None
+            raise RuntimeError("Command %s failed: %s" % (' '.join(cmd), e))
+        self.signature = (head, tuple(latex_opts))
+
+        if not self._registered:
+            atexit.register(self.close)
+            self._registered = True
+
+class WorkspacePool(object):
+    """
+    Pool of scratch directories for the converters, reused across
+    conversions instead of being created and removed for each one.
+
+    The directories are placed under `base`: by default /dev/shm if it
+    is available, so that the Latex intermediate files never hit the
+    disk, and the system temporary directory otherwise.
+    """
+
+    SHM_PATH = '/dev/shm'
+
+    def __init__(self, base=None, max_idle=4):
+        """
+        :Parameters:
+          - `base`: directory to create the workspaces in, or None
+          - `max_idle`: maximum number of unused workspaces kept around
+        """
+        if not base:
+            base = self.get_default_base()
+        self.base = base
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+        self._registered = False
+
+    def __getstate__(self):
+        # Each process has its own workspaces
+        return {'base': self.base, 'max_idle': self.max_idle}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def get_default_base(cls):
+        path = cls.SHM_PATH
+        if os.path.isdir(path) and os.access(path, os.W_OK | os.X_OK):
+            return path
+        return None
+    get_default_base = classmethod(get_default_base)
+
+    def acquire(self):
+        """
+        :Returns: path of an empty directory for exclusive use, until
+                  passed to `release`
+        """
+        self._lock.acquire()
+        try:
+            if self._idle:
+                return self._idle.pop()
+            if not self._registered:
+                atexit.register(self.close)
+                self._registered = True
+        finally:
+            self._lock.release()
+
+        try:
+            return tempfile.mkdtemp(prefix='textext-', dir=self.base)
+        except (IOError, OSError):
+            # e.g. the tmpfs is full
+            return tempfile.mkdtemp(prefix='textext-')
+
+    def release(self, path):
+        """Empty the directory `path`, and return it to the pool"""
+        try:
+            for name in os.listdir(path):
+                filename = os.path.join(path, name)
+                if os.path.isdir(filename) and not os.path.islink(filename):
+                    shutil.rmtree(filename, True)
+                else:
+                    os.remove(filename)
+        except OSError:
+            shutil.rmtree(path, True)
+            return
+
+        self._lock.acquire()
+        try:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(path)
+                return
+        finally:
+            self._lock.release()
+        shutil.rmtree(path, True)
+
+    def close(self):
+        """Remove the unused workspaces"""
+        self._lock.acquire()
+        try:
+            idle, self._idle = self._idle, []
+        finally:
+            self._lock.release()
+        for path in idle:
+            shutil.rmtree(path, True)
+
+class InkscapeShell(object):
+    """
+    Inkscape running in ``--shell`` mode, reading one set of command
+    line arguments per line from stdin and printing a ``>`` prompt when
+    done. This saves the Inkscape startup, the slowest part of the
+    Inkscape converters, on all but the first conversion.
+
+    Crashed or killed processes are replaced on the next command.
+    """
+
+    PROMPT = '>'
+
+    # Seconds to wait for more output after what looks like a prompt
+    PROMPT_DELAY = 0.05
+
+    def __init__(self, executable='inkscape'):
+        self.executable = executable
+        self.process = None
+        self._output = None
+
+    def run(self, args, timeout=None, jobs=None):
+        """
+        Run Inkscape with command line arguments `args`.
+
+        :Parameters:
+          - `timeout`: deadline in seconds, or None
+          - `jobs`: JobControl to run under, or None
+        :Returns: Inkscape output
+        """
+        if jobs is not None:
+            jobs.acquire()
+        try:
+            deadline = None
+            if timeout:
+                deadline = time.time() + timeout
+            if self.process is None or self.process.poll() is not None:
+                self._start(deadline)
+
+            process = self.process
+            if jobs is not None:
+                jobs.add(process)
+            try:
+                line = ' '.join([self._quote(arg) for arg in args])
+                try:
+                    process.stdin.write(line + '\n')
+                    process.stdin.flush()
+                except (IOError, OSError):
+                    pass # noticed when reading
+                out = self._read_prompt(deadline, timeout)
+            finally:
+                if jobs is not None:
+                    jobs.remove(process)
+        finally:
+            if jobs is not None:
+                jobs.release()
+        return out
+
+    def close(self):
+        """Stop the process, if any"""
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.write('quit\n')
+            self.process.stdin.close()
+            self.process.wait()
+        except (IOError, OSError):
+            pass
+        self.process = None
+
+    def _quote(self, arg):
+        # The shell splits the line like a Unix shell would
+        if arg and not re.search(r"""[\s'"\\]""", arg):
+            return arg
+        return "'%s'" % arg.replace("'", "'\\''")
+
+    def _start(self, deadline):
+        self.close()
+        cmd = [self.executable, '--shell']
+        try:
+            self.process = subprocess.Popen(cmd,
+                                            stdin=subprocess.PIPE,
+                                            stdout=subprocess.PIPE,
+                                            stderr=subprocess.STDOUT,
+                                            **process_group_options())
+        except OSError, e:
+            raise RuntimeError("Command %s failed: %s" % (' '.join(cmd), e))
+
+        # Reading the pipe blocks: do it in a thread, so that the
+        # deadline can be applied
+        self._output = Queue.Queue()
+        reader = threading.Thread(target=self._read_output,
+                                  args=(self.process.stdout, self._output))
+        reader.setDaemon(True)
+        reader.start()
+
+        timeout = None
+        if deadline is not None:
+            timeout = max(0, deadline - time.time())
+        self._read_prompt(deadline, timeout)
+
+    def _read_output(self, stream, output):
+        while True:
+            try:
+                data = os.read(stream.fileno(), 4096)
+            except (IOError, OSError):
+                data = ''
+            if not data:
+                output.put(None)
+                break
+            output.put(data)
+
+    def _read_prompt(self, deadline, timeout):
+        # The prompt may arrive split over several reads, and output
+        # ending in something like it may still continue: only a prompt
+        # at the start of a line, with no output following it shortly,
+        # ends the command.
+        out = ''
+        while True:
+            at_prompt = self._ends_with_prompt(out)
+            if at_prompt:
+                wait = self.PROMPT_DELAY
+            elif deadline is None:
+                # Queue.get without a timeout can't be interrupted
+                wait = 3600
+            else:
+                wait = max(0, deadline - time.time())
+            try:
+                data = self._output.get(True, wait)
+            except Queue.Empty:
+                if at_prompt:
+                    return out.rstrip(' ')[:-len(self.PROMPT)]
+                if deadline is None:
+                    continue
+                self._kill()
+                raise CommandTimeout("%s timed out after %g s"
+                                     % (self.executable, timeout))
+            if data is None:
+                self._kill()
+                raise RuntimeError("%s exited unexpectedly: %s"
+                                   % (self.executable, out))
+            out += data
+
+    def _ends_with_prompt(self, out):
+        out = out.rstrip(' ')
+        return out == self.PROMPT or out.endswith('\n' + self.PROMPT)
+
+    def _kill(self):
+        if self.process is not None:
+            kill_process_tree(self.process)
+            try:
+                self.process.wait()
+            except OSError:
+                pass
+            self.process = None
+
+class InkscapeShellPool(object):
+    """
+    Pool of `InkscapeShell` processes, one for each thread running
+    Inkscape at the same time.
+    """
+
+    def __init__(self, max_idle=2):
+        """
+        :Parameters:
+          - `max_idle`: maximum number of unused processes kept running
+        """
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+        self._registered = False
+
+    def __getstate__(self):
+        # Running processes cannot be shared with other Python processes
+        return {'max_idle': self.max_idle}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def run(self, executable, args, timeout=None, jobs=None):
+        """
+        Run `executable` with command line arguments `args`, in a
+        resident shell.
+
+        :Returns: Inkscape output
+        """
+        shell = self.acquire(executable)
+        try:
+            out = shell.run(args, timeout, jobs)
+        finally:
+            self.release(shell)
+        return out
+
+    def acquire(self, executable):
+        """:Returns: InkscapeShell for exclusive use, until released"""
+        self._lock.acquire()
+        try:
+            for shell in self._idle:
+                if shell.executable == executable:
+                    self._idle.remove(shell)
+                    return shell
+            if not self._registered:
+                atexit.register(self.close)
+                self._registered = True
+        finally:
+            self._lock.release()
+        return InkscapeShell(executable)
+
+    def release(self, shell):
+        if shell.process is not None:
+            self._lock.acquire()
+            try:
+                if len(self._idle) < self.max_idle:
+                    self._idle.append(shell)
+                    return
+            finally:
+                self._lock.release()
+        shell.close()
+
+    def close(self):
+        """Stop the unused processes"""
+        self._lock.acquire()
+        try:
+            idle, self._idle = self._idle, []
+        finally:
+            self._lock.release()
+        for shell in idle:
+            shell.close()
+
+#------------------------------------------------------------------------------
+# SVG optimization
+#------------------------------------------------------------------------------
+
+# NumPy is optional, and imported only when the optimizer runs
+_numpy = None
+
+def get_numpy():
+    """Return the numpy module, or None if it is not installed"""
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = False
+    return _numpy or None
+
+IDENTITY = (1.0, 0.0, 0.0, 1.0, 0.0, 0.0)
+
+TRANSFORM_RE = re.compile(r'(matrix|translate|scale|rotate|skewX|skewY)'
+                          r'\s*\(([^)]*)\)')
+NUMBER_RE = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+
+def multiply_transforms(m1, m2):
+    """
+    Compose two affine matrices (a, b, c, d, e, f); the result applies
+    `m2` first and then `m1`.
+    """
+    a1, b1, c1, d1, e1, f1 = m1
+    a2, b2, c2, d2, e2, f2 = m2
+    return (a1*a2 + c1*b2, b1*a2 + d1*b2,
+            a1*c2 + c1*d2, b1*c2 + d1*d2,
+            a1*e2 + c1*f2 + e1, b1*e2 + d1*f2 + f1)
+
+def parse_transform(value):
+    """
+    Parse the value of an SVG transform attribute.
+
+    :Returns: affine matrix (a, b, c, d, e, f), or None if `value`
+              is not a valid transform
+    """
+    m = IDENTITY
+    for name, args in TRANSFORM_RE.findall(value):
+        args = [float(x) for x in NUMBER_RE.findall(args)]
+        n = len(args)
+        if name == 'matrix' and n == 6:
+            t = tuple(args)
+        elif name == 'translate' and n in (1, 2):
+            t = (1.0, 0.0, 0.0, 1.0, args[0], (args + [0.0])[1])
+        elif name == 'scale' and n in (1, 2):
+            t = (args[0], 0.0, 0.0, (args + args)[1], 0.0, 0.0)
+        elif name == 'rotate' and n in (1, 3):
+            a = math.radians(args[0])
+            t = (math.cos(a), math.sin(a), -math.sin(a), math.cos(a), 0.0, 0.0)
+            if n == 3:
+                cx, cy = args[1:]
+                t = multiply_transforms((1.0, 0.0, 0.0, 1.0, cx, cy), t)
+                t = multiply_transforms(t, (1.0, 0.0, 0.0, 1.0, -cx, -cy))
+        elif name == 'skewX' and n == 1:
+            t = (1.0, 0.0, math.tan(math.radians(args[0])), 1.0, 0.0, 0.0)
+        elif name == 'skewY' and n == 1:
+            t = (1.0, math.tan(math.radians(args[0])), 0.0, 1.0, 0.0, 0.0)
+        else:
+            return None
+        m = multiply_transforms(m, t)
+    if TRANSFORM_RE.sub('', value).strip(' \t\r\n,'):
+        return None
+    return m
+
+PATH_TOKEN_RE = re.compile(r'([MmZzLlHhVvCcSsQqTtAa])|'
+                           r'([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)')
+PATH_NARGS = {'M': 2, 'L': 2, 'H': 1, 'V': 1, 'C': 6, 'S': 4,
+              'Q': 4, 'T': 2, 'A': 7}
+
+def parse_path(d):
+    """
+    Parse SVG path data into absolute commands, with H and V turned
+    into L, S into C, and T into Q.
+
+    :Returns: list of (command, [x0, y0, x1, y1, ...]) with command in
+              'MLCQZ', or None if the path contains arcs or is malformed
+    """
+    if PATH_TOKEN_RE.sub(' ', d).strip(' \t\r\n,'):
+        return None
+
+    tokens = PATH_TOKEN_RE.findall(d)
+    commands = []
+    x = y = x0 = y0 = 0.0
+    ctrl_c = ctrl_q = None
+    cmd = None
+    i = 0
+    n = len(tokens)
+    while i < n:
+        if tokens[i][0]:
+            cmd = tokens[i][0]
+            i += 1
+            if cmd in 'Zz':
+                commands.append(('Z', []))
+                x, y = x0, y0
+                ctrl_c = ctrl_q = None
+                cmd = None
+                continue
+        elif cmd is None:
+            return None
+
+        c = cmd.upper()
+        k = PATH_NARGS[c]
+        args = [t[1] for t in tokens[i:i+k]]
+        if len(args) < k or '' in args:
+            return None
+        args = [float(v) for v in args]
+        i += k
+        if cmd != c:
+            # relative command
+            if c == 'H':
+                args[0] += x
+            elif c == 'V':
+                args[0] += y
+            elif c != 'A':
+                for j in xrange(0, k, 2):
+                    args[j] += x
+                    args[j+1] += y
+
+        if c == 'M':
+            x = x0 = args[0]
+            y = y0 = args[1]
+            commands.append(('M', args))
+            # Further coordinate pairs are implicit line-tos
+            cmd = (cmd == 'm') and 'l' or 'L'
+        elif c in 'LHV':
+            if c == 'H':
+                args = [args[0], y]
+            elif c == 'V':
+                args = [x, args[0]]
+            x, y = args
+            commands.append(('L', args))
+        elif c in 'CS':
+            if c == 'S':
+                if ctrl_c is None:
+                    args = [x, y] + args
+                else:
+                    args = [2*x - ctrl_c[0], 2*y - ctrl_c[1]] + args
+            commands.append(('C', args))
+            ctrl_c = args[2:4]
+            x, y = args[4:6]
+        elif c in 'QT':
+            if c == 'T':
+                if ctrl_q is None:
+                    args = [x, y] + args
+                else:
+                    args = [2*x - ctrl_q[0], 2*y - ctrl_q[1]] + args
+            commands.append(('Q', args))
+            ctrl_q = args[0:2]
+            x, y = args[2:4]
+        else:
+            return None
+
+        if c not in 'CS':
+            ctrl_c = None
+        if c not in 'QT':
+            ctrl_q = None
+    return commands
+
+BBOX_SKIP_TAGS = ('defs', 'clipPath', 'mask', 'symbol', 'metadata')
+
+def get_bbox(node, matrix=IDENTITY):
+    """
+    Compute the extent of the paths in `node`, following svg:use
+    references inside it. Curve control points are included, so the
+    box may be slightly larger than the drawing.
+
+    :Returns: (xmin, ymin, xmax, ymax), or None if nothing was found
+    """
+    ids = {}
+    for el in node.iter():
+        if isinstance(el.tag, basestring) and el.get('id'):
+            ids[el.get('id')] = el
+
+    points = []
+    def walk(el, m, depth):
+        if not isinstance(el.tag, basestring) or depth > 20:
+            return
+        name = el.tag.split('}')[-1]
+        if name in BBOX_SKIP_TAGS:
+            return
+        t = el.get('transform')
+        if t:
+            t = parse_transform(t)
+            if t is None:
+                return
+            m = multiply_transforms(m, t)
+        if name == 'use':
+            ref = ids.get(el.get('{%s}href' % XLINK_NS, '').lstrip('#'))
+            if ref is not None:
+                try:
+                    x = float(el.get('x', 0))
+                    y = float(el.get('y', 0))
+                except ValueError:
+                    return
+                m = multiply_transforms(m, (1.0, 0.0, 0.0, 1.0, x, y))
+                # The referenced element is drawn even if it is in defs
+                t = ref.get('transform')
+                if t:
+                    t = parse_transform(t)
+                    if t is None:
+                        return
+                    m = multiply_transforms(m, t)
+                for child in ref:
+                    walk(child, m, depth + 1)
+                if ref.tag.split('}')[-1] not in BBOX_SKIP_TAGS + ('g',):
+                    walk_shape(ref, m)
+            return
+        walk_shape(el, m)
+        for child in el:
+            walk(child, m, depth + 1)
+
+    def walk_shape(el, m):
+        name = el.tag.split('}')[-1]
+        coords = []
+        try:
+            if name == 'path':
+                for cmd, args in parse_path(el.get('d', '')) or []:
+                    coords.extend(args)
+            elif name == 'rect':
+                x = float(el.get('x', 0))
+                y = float(el.get('y', 0))
+                w = float(el.get('width', 0))
+                h = float(el.get('height', 0))
+                coords = [x, y, x + w, y + h]
+        except ValueError:
+            return
+        a, b, c, d, e, f = m
+        for j in xrange(0, len(coords), 2):
+            x, y = coords[j], coords[j+1]
+            points.append((a*x + c*y + e, b*x + d*y + f))
+
+    walk(node, matrix, 0)
+    if not points:
+        return None
+    xs = [p[0] for p in points]
+    ys = [p[1] for p in points]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+# Attributes that may refer to elements with url(#id), and the references
+URL_ATTRS = ['clip-path', 'mask', 'filter', 'fill', 'stroke', 'style']
+URL_RE = re.compile(r'url\(\s*(#[^)\s]+)\s*\)')
+
+def rename_ids(root, id_prefix):
+    """
+    Rename the ids in the tree `root` to `id_prefix` + running number,
+    and rewrite the references to them.
+    """
+    href = '{%s}href' % XLINK_NS
+
+    # Rename ids and find references in a single pass
+    href_map = {}
+    refs = []
+    for el in root.iter(etree.Element):
+        attrib = el.attrib
+        if not attrib:
+            continue
+        cur_id = attrib.get('id')
+        if cur_id is not None:
+            new_id = "%s%d" % (id_prefix, len(href_map))
+            href_map['#' + cur_id] = '#' + new_id
+            attrib['id'] = new_id
+        if href in attrib:
+            refs.append(el)
+            continue
+        for key in URL_ATTRS:
+            if key in attrib:
+                refs.append(el)
+                break
+
+    # References may point forward, so replace them only at the end
+    for el in refs:
+        attrib = el.attrib
+        value = attrib.get(href)
+        if value is not None:
+            attrib[href] = href_map.get(value, value)
+        for key in URL_ATTRS:
+            value = attrib.get(key)
+            if value is not None and 'url(' in value:
+                attrib[key] = URL_RE.sub(
+                    lambda m: 'url(%s)' % href_map.get(m.group(1),
+                                                       m.group(1)),
+                    value)
+
+class SvgOptimizer(object):
+    """
+    Make a converted SVG fragment smaller and cheaper for Inkscape to
+    handle:
+
+    - bake a transform into the path coordinates (optional),
+    - round the coordinates to `precision` decimals (optional), and
+      write them as relative path commands,
+    - drop empty attributes, and collapse groups without attributes.
+
+    Transforms are baked only if the fragment consists of groups and
+    paths alone; other fragments keep their transform.
+
+    The coordinates are transformed with NumPy, if available.
+    """
+
+    BAKE_TAGS = ('g', 'path')
+    REF_ATTRS = ('clip-path', 'mask', 'filter')
+    STROKE_WIDTH_RE = re.compile(r'(stroke-width\s*:\s*)(%s)'
+                                 % NUMBER_RE.pattern)
+
+    def __init__(self, precision=None):
+        self.precision = precision
+
+    def optimize(self, node, matrix=None):
+        """
+        Optimize the children of `node` in place, baking the affine
+        `matrix` into the coordinates if given and possible.
+
+        :Returns: True if the matrix was baked
+        """
+        baked = matrix is not None and self.can_bake(node)
+        if baked:
+            self._bake(node, matrix)
+        else:
+            for el in node.iter('path'):
+                self._compact_path(el, IDENTITY)
+        self._drop_empty_attributes(node)
+        self._collapse_groups(node)
+        return baked
+
+    def can_bake(self, node):
+        """Check whether a transform can be baked into `node`'s children"""
+        for el in node.iterdescendants():
+            if el.tag not in self.BAKE_TAGS:
+                return False
+            for key in self.REF_ATTRS:
+                if key in el.attrib:
+                    return False
+            transform = el.attrib.get('transform')
+            if transform is not None and parse_transform(transform) is None:
+                return False
+            if el.tag == 'path' and parse_path(el.attrib.get('d', '')) is None:
+                return False
+        return True
+
+    def _bake(self, node, matrix):
+        stack = [(child, matrix) for child in node]
+        while stack:
+            el, m = stack.pop()
+            transform = el.attrib.pop('transform', None)
+            if transform is not None:
+                m = multiply_transforms(m, parse_transform(transform))
+            self._scale_stroke_width(el, m)
+            if el.tag == 'path':
+                self._compact_path(el, m)
+            else:
+                stack.extend([(child, m) for child in el])
+
+    def _scale_stroke_width(self, el, m):
+        a, b, c, d = m[:4]
+        scale = abs(a*d - b*c) ** 0.5
+        if scale == 1.0:
+            return
+
+        width = el.attrib.get('stroke-width')
+        if width is not None:
+            try:
+                el.attrib['stroke-width'] = self._format(float(width) * scale)
+            except ValueError:
+                pass
 
-    def set(self, key, value):
-        self.values[key] = str(value)
+        style = el.attrib.get('style')
+        if style is not None and 'stroke-width' in style:
+            def repl(match):
+                return match.group(1) + self._format(
+                    float(match.group(2)) * scale)
+            el.attrib['style'] = self.STROKE_WIDTH_RE.sub(repl, style)
+
+    def _compact_path(self, el, m):
+        commands = parse_path(el.attrib.get('d', ''))
+        if commands is None:
+            return
 
+        # Coordinates, and for each point the index of the current point
+        # it is relative to (0 is the origin, k + 1 is point k)
+        coords = []
+        bases = []
+        cur = start = 0
+        for cmd, args in commands:
+            if cmd == 'Z':
+                cur = start
+                continue
+            npoints = len(args) // 2
+            coords.extend(args)
+            bases.extend([cur] * npoints)
+            cur = len(bases)
+            if cmd == 'M':
+                start = cur
+
+        rel = self._transform_points(coords, bases, m)
+
+        parts = []
+        last = None
+        pos = 0
+        for cmd, args in commands:
+            letter = cmd.lower()
+            if letter != last or letter == 'm':
+                parts.append(letter)
+            last = letter
+            if cmd == 'Z':
+                continue
+            nums = [self._format(v) for v in rel[pos:pos+len(args)]]
+            pos += len(args)
+            parts.append(' '.join(nums))
+            parts.append(' ')
+
+        d = ''.join(parts).replace(' -', '-').replace(' z', 'z')
+        d = re.sub(r' ([a-z])', r'\1', d).strip()
+        el.attrib['d'] = d
+
+    def _transform_points(self, coords, bases, m):
+        """
+        Transform and round the points, and return the coordinates
+        relative to the current point as a flat list.
+        """
+        a, b, c, d, e, f = m
+        numpy = get_numpy()
+        if numpy is not None and coords:
+            pts = numpy.array(coords, dtype=float).reshape(-1, 2)
+            pts = pts.dot(numpy.array([[a, b], [c, d]])) + (e, f)
+            if self.precision is not None:
+                pts = numpy.round(pts, self.precision)
+            origin = numpy.vstack([numpy.zeros((1, 2)), pts])
+            return (pts - origin[bases]).ravel().tolist()
+
+        precision = self.precision
+        pts = [(0.0, 0.0)]
+        for i in xrange(0, len(coords), 2):
+            x, y = coords[i], coords[i+1]
+            x, y = a*x + c*y + e, b*x + d*y + f
+            if precision is not None:
+                x, y = round(x, precision), round(y, precision)
+            pts.append((x, y))
+        rel = []
+        for k, base in enumerate(bases):
+            x, y = pts[k+1]
+            bx, by = pts[base]
+            rel.append(x - bx)
+            rel.append(y - by)
+        return rel
+
+    def _format(self, value):
+        if self.precision is None:
+            s = '%.10g' % value
+        else:
+            s = '%.*f' % (self.precision, value)
+            if '.' in s:
+                s = s.rstrip('0').rstrip('.')
+        if s.startswith('0.'):
+            s = s[1:]
+        elif s.startswith('-0.'):
+            s = '-' + s[2:]
+        if s in ('-0', ''):
+            s = '0'
+        return s
+
+    def _drop_empty_attributes(self, node):
+        for el in node.iter(etree.Element):
+            for key, value in el.attrib.items():
+                if not value.strip():
+                    del el.attrib[key]
+
+    def _collapse_groups(self, node):
+        for g in reversed(list(node.iterdescendants('g'))):
+            if g.attrib:
+                continue
+            parent = g.getparent()
+            index = parent.index(g)
+            for child in reversed(list(g)):
+                parent.insert(index, child)
+            parent.remove(g)
 
 #------------------------------------------------------------------------------
 # LaTeX converters
@@ -679,20 +2784,34 @@ class Settings(object):
 try:
     import subprocess
 
-    def exec_command(cmd, ok_return_value=0, combine_error=False):
+    def exec_command(cmd, ok_return_value=0, combine_error=False,
+                     cwd=None, env=None, timeout=None, jobs=None):
         """
         Run given command, check return value, and return
         concatenated stdout and stderr.
         """
+        if jobs is not None:
+            jobs.acquire()
         try:
-            p = subprocess.Popen(cmd,
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE,
-                                 stdin=subprocess.PIPE)
-            out, err = p.communicate()
-        except OSError, e:
-            raise RuntimeError("Command %s failed: %s" % (' '.join(cmd), e))
-        
+            try:
+                p = subprocess.Popen(cmd,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE,
+                                     stdin=subprocess.PIPE,
+                                     cwd=cwd, env=env,
+                                     **process_group_options())
+            except OSError, e:
+                raise RuntimeError("Command %s failed: %s" % (' '.join(cmd), e))
+            out, err, expired = communicate(p, None, timeout, jobs)
+        finally:
+            if jobs is not None:
+                jobs.release()
+
+        if expired:
+            raise CommandTimeout("Command %s timed out after %g s"
+                                 % (' '.join(cmd), timeout))
+        if jobs is not None and jobs.cancelled:
+            raise RuntimeError("Command %s cancelled" % ' '.join(cmd))
         if ok_return_value is not None and p.returncode != ok_return_value:
             raise RuntimeError("Command %s failed (code %d): %s"
                                % (' '.join(cmd), p.returncode, out + err))
@@ -703,13 +2822,21 @@ except ImportError:
     # Python < 2.4 ...
     import popen2
     
-    def exec_command(cmd, ok_return_value=0, combine_error=False):
+    def exec_command(cmd, ok_return_value=0, combine_error=False,
+                     cwd=None, env=None, timeout=None, jobs=None):
         """
         Run given command, check return value, and return
         concatenated stdout and stderr.
         """
         
-        # XXX: unix-only!
+        # XXX: unix-only! Deadlines and job control are not supported.
+
+        # Popen4 has no cwd and env arguments: let the shell set them
+        if env is not None:
+            cmd = (['env', '-i'] + ['%s=%s' % item for item in env.items()]
+                   + list(cmd))
+        if cwd is not None:
+            cmd = ['/bin/sh', '-c', 'cd "$0" && exec "$@"', cwd] + list(cmd)
 
         try:
             p = popen2.Popen4(cmd, True)
@@ -724,6 +2851,186 @@ except ImportError:
                                % (' '.join(cmd), returncode, out))
         return out
 
+_exec_command = exec_command
+
+def exec_command(cmd, ok_return_value=0, combine_error=False,
+                 cwd=None, env=None, timeout=None, jobs=None):
+    """
+    Run given command, check return value, and return
+    concatenated stdout and stderr.
+
+    :Parameters:
+      - `cwd`: working directory for the command, instead of ours
+      - `env`: environment for the command, instead of ours
+      - `timeout`: seconds after which the command and all processes
+        it started are killed, and CommandTimeout raised; None for no
+        deadline
+      - `jobs`: JobControl to run the command under, or None
+    """
+    stage = tracer.start('exec', command=os.path.basename(cmd[0]),
+                         args=cmd[1:])
+    try:
+        try:
+            out = _exec_command(cmd, ok_return_value, combine_error,
+                                cwd=cwd, env=env, timeout=timeout, jobs=jobs)
+        except RuntimeError, e:
+            stage['failed'] = True
+            if isinstance(e, CommandTimeout):
+                stage['timeout'] = timeout
+            raise
+        stage['output_bytes'] = len(out)
+        return out
+    finally:
+        stage.end()
+
+class CommandTimeout(RuntimeError):
+    """A command did not finish before its deadline"""
+    pass
+
+def process_group_options():
+    """
+    :Returns: keyword arguments for subprocess.Popen, that start the
+              process in a new process group, so that the processes it
+              starts can be killed along with it
+    """
+    if USE_WINDOWS:
+        return {'creationflags': 0x200} # CREATE_NEW_PROCESS_GROUP
+    return {'preexec_fn': os.setsid}
+
+def kill_process_tree(p):
+    """Kill the process `p`, started with `process_group_options`,
+    and all the processes it started"""
+    try:
+        if USE_WINDOWS:
+            devnull = open(os.devnull, 'w')
+            try:
+                subprocess.call(['taskkill', '/F', '/T', '/PID', str(p.pid)],
+                                stdout=devnull, stderr=devnull)
+            finally:
+                devnull.close()
+        else:
+            os.killpg(p.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+def communicate(p, input=None, timeout=None, jobs=None):
+    """
+    Like ``p.communicate(input)``, but kill the process tree of `p` if it
+    is still running after `timeout` seconds.
+
+    :Returns: (stdout, stderr, whether the deadline expired)
+    """
+    expired = []
+    def kill():
+        expired.append(True)
+        kill_process_tree(p)
+
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, kill)
+        timer.setDaemon(True)
+        timer.start()
+    if jobs is not None:
+        jobs.add(p)
+    try:
+        out, err = p.communicate(input)
+    finally:
+        if timer is not None:
+            # Wait for the timer thread, so that it doesn't outlive the
+            # interpreter
+            timer.cancel()
+            timer.join()
+        if jobs is not None:
+            jobs.remove(p)
+    return out, err, bool(expired)
+
+class JobControl(object):
+    """
+    Control over the external programs run by the converters: a limit
+    on how many run at the same time, a deadline for each stage of the
+    conversion, and cancellation of all of them at once.
+
+    Converters sharing a JobControl are cancelled together; give each
+    its own to cancel them separately. In batch mode with worker
+    processes, each process applies the limit on its own.
+    """
+
+    # Seconds; None or zero for no deadline
+    DEFAULT_DEADLINES = {'tex_to_pdf': 120, 'pdf_to_svg': 120}
+
+    def __init__(self, max_processes=0, deadlines=None):
+        """
+        :Parameters:
+          - `max_processes`: maximum number of programs running at the
+            same time, or zero for no limit
+          - `deadlines`: {stage name: seconds}, overriding the defaults
+        """
+        self.max_processes = max_processes
+        self.deadlines = dict(self.DEFAULT_DEADLINES)
+        if deadlines:
+            self.deadlines.update(deadlines)
+        self.cancelled = False
+        self._semaphore = None
+        if max_processes:
+            self._semaphore = threading.BoundedSemaphore(max_processes)
+        self._processes = []
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {'max_processes': self.max_processes,
+                'deadlines': self.deadlines}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def get_deadline(self, stage):
+        """:Returns: deadline for `stage` in seconds, or None"""
+        return self.deadlines.get(stage) or None
+
+    def acquire(self):
+        """Wait for a free slot for starting a program"""
+        if self.cancelled:
+            raise RuntimeError("Conversion cancelled")
+        if self._semaphore is not None:
+            self._semaphore.acquire()
+            if self.cancelled:
+                self._semaphore.release()
+                raise RuntimeError("Conversion cancelled")
+
+    def release(self):
+        if self._semaphore is not None:
+            self._semaphore.release()
+
+    def add(self, p):
+        """Register a running process, started with `process_group_options`"""
+        self._lock.acquire()
+        try:
+            if not self.cancelled:
+                self._processes.append(p)
+                return
+        finally:
+            self._lock.release()
+        kill_process_tree(p)
+
+    def remove(self, p):
+        self._lock.acquire()
+        try:
+            if p in self._processes:
+                self._processes.remove(p)
+        finally:
+            self._lock.release()
+
+    def cancel(self):
+        """Kill the running programs, and refuse to start new ones"""
+        self._lock.acquire()
+        try:
+            self.cancelled = True
+            processes, self._processes = self._processes, []
+        finally:
+            self._lock.release()
+        for p in processes:
+            kill_process_tree(p)
+
 if USE_WINDOWS:
     # Try to add some commonly needed paths to PATH
     paths = os.environ.get('PATH', '').split(os.path.pathsep)
@@ -744,6 +3051,62 @@ if USE_WINDOWS:
     os.environ['PATH'] = os.path.pathsep.join(paths)
 
 
+LATEX_PAGES_RE = re.compile(r'Output written on .*?\((\d+) pages?', re.S)
+
+# Defines \textextcounters, setting the counters back to their values
+# at the start of the document
+SNIPPET_SETUP = r"""\begingroup\makeatletter
+\def\@elt#1{\noexpand\setcounter{#1}{\the\value{#1}}}%
+\xdef\textextcounters{\cl@@ckpt}%
+\endgroup"""
+
+# Snippets doing any of this affect the ones after them even in a group
+GLOBAL_DEF_RE = re.compile(r'\\(?:[gx]def|global|new(?:counter|length|'
+                           r'savebox|if|toks|count|dimen|skip|box|read|'
+                           r'write|font))(?![A-Za-z])')
+
+def join_snippets(snippets):
+    """
+    Join `snippets` into a document body typesetting each on a page of
+    its own, as it would be alone: each snippet is in a group, and the
+    counters are set back in between. Snippets matching
+    `GLOBAL_DEF_RE` cannot be kept apart like this.
+    """
+    return "%s\n%s" % (SNIPPET_SETUP,
+        "\n\\clearpage\n\\textextcounters\n\\noindent\n".join(
+            ["\\begingroup\n%s\n\\endgroup" % s for s in snippets]))
+
+def count_pages(output):
+    """
+    :Returns: number of pages Latex reports having written in `output`,
+              or None if it does not say
+    """
+    m = LATEX_PAGES_RE.search(output or '')
+    if m is None:
+        return None
+    return int(m.group(1))
+
+def find_executable(name):
+    """
+    Return the full path of the executable `name` found on PATH,
+    or None if there is none.
+    """
+    extensions = ['']
+    if USE_WINDOWS:
+        extensions += os.environ.get('PATHEXT', '.EXE;.BAT').split(';')
+
+    if os.path.dirname(name):
+        paths = ['']
+    else:
+        paths = os.environ.get('PATH', '').split(os.path.pathsep)
+
+    for path in paths:
+        for ext in extensions:
+            filename = os.path.join(path, name + ext)
+            if os.path.isfile(filename):
+                return os.path.abspath(filename)
+    return None
+
 class ConvertInfo(object):
     def __init__(self):
         self.text = None
@@ -751,38 +3114,112 @@ class ConvertInfo(object):
         self.page_width = None
         self.scale_factor = None
         self.has_node = False
-        self.text_to_path = False
+        self.old_fingerprint = None
+        # None for no preference: the first available converter is used
+        self.text_to_path = None
         self.selected_converter = None
 
-        self.available_converters = []
-        self.unavailable_converters = []
+        # Output optimization: decimals to round coordinates to (None
+        # for no rounding), and whether to bake the transform into them
+        self.precision = None
+        self.bake_transform = False
 
+        # Converter availability, probed lazily: {conv_cls: error or None}
+        self.settings = None
+        self._probed = {}
+
+    def available_converters(self):
         self._find_converters()
+        return [cls for cls in CONVERTERS if self._probed[cls] is None]
+    available_converters = property(available_converters)
 
-    def _find_converters(self):
-        converter_errors = []
-        for conv_cls in CONVERTERS:
+    def unavailable_converters(self):
+        self._find_converters()
+        return [cls for cls in CONVERTERS if self._probed[cls] is not None]
+    unavailable_converters = property(unavailable_converters)
+
+    def probe(self, conv_cls):
+        """
+        Check whether the given converter is available. The result is
+        stored in the settings, and reused for as long as PATH and
+        the converter's executables stay the same.
+
+        :Returns: None if the converter is available, else an error message
+        """
+        try:
+            return self._probed[conv_cls]
+        except KeyError:
+            pass
+
+        key = "probe_%s" % conv_cls.__name__
+        signature = conv_cls.get_probe_signature()
+        cached = None
+        if self.settings is not None and conv_cls.executables:
+            cached = self.settings.get(key, str)
+
+        if cached is not None and cached.startswith(signature + ':'):
+            error = cached[len(signature)+1:] or None
+        else:
+            stage = tracer.start('probe', converter=conv_cls.name)
             try:
-                conv_cls.check_available()
-                self.available_converters.append(conv_cls)
-            except StandardError, e:
-                self.unavailable_converters.append(conv_cls)
-                converter_errors.append("%s: %s" % (conv_cls.__name__, str(e)))
+                try:
+                    conv_cls.check_available()
+                    error = None
+                except StandardError, e:
+                    error = ' '.join(str(e).split()) or "not available"
+            finally:
+                stage.end(available=error is None)
+            if self.settings is not None and conv_cls.executables:
+                self.settings.set(key, "%s:%s" % (signature, error or ''))
+
+        self._probed[conv_cls] = error
+        return error
 
-        if not self.available_converters:
+    def _find_converters(self):
+        """Probe all converters not probed yet, in parallel"""
+        missing = [cls for cls in CONVERTERS if cls not in self._probed]
+        if not missing:
+            return
+
+        threads = []
+        for conv_cls in missing:
+            thread = threading.Thread(target=self.probe, args=(conv_cls,))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        self._save_probes()
+
+        converter_errors = ["%s: %s" % (cls.__name__, self._probed[cls])
+                            for cls in CONVERTERS
+                            if self._probed[cls] is not None]
+        if len(converter_errors) == len(CONVERTERS):
             raise RuntimeError(("No Latex -> SVG converter available:\n%s\n\n"
                                 "TexText does not work without one.")
                                % ';\n'.join(converter_errors))
 
+    def _save_probes(self):
+        if self.settings is not None:
+            try:
+                self.settings.save()
+            except (IOError, OSError, EnvironmentError):
+                pass
+
     def get_converter_cls(self):
-        # Try to find the selected one
-        for cls in self.available_converters:
+        # Try to find the selected one, probing only it
+        for cls in CONVERTERS:
             if cls.name == self.selected_converter:
-                return cls
-
-        # Try to use one conforming to the chosen text-to-path setting
+                if cls not in self._probed:
+                    self.probe(cls)
+                    self._save_probes()
+                if self._probed[cls] is None:
+                    return cls
+
+        # Try to use one conforming to the chosen text-to-path setting,
+        # if any
         for cls in self.available_converters:
-            if cls.text_to_path == self.text_to_path:
+            if (self.text_to_path is None
+                    or cls.text_to_path == self.text_to_path):
                 return cls
 
         raise RuntimeError("No converter supporting the chosen 'Text to path' setting "
@@ -792,9 +3229,42 @@ class ConvertInfo(object):
         s = "%s\n%s\n%s\n%s\n%d" % (
             self.text, self.preamble_file,
             self.page_width, self.scale_factor,
-            self.text_to_path)
+            bool(self.text_to_path))
         return hashlib.md5(s).hexdigest()[:8]
 
+    def unique_hash(self):
+        """
+        Return a hash for naming the ids of a converted node. Unlike
+        `hash`, this differs on every call, as the same text may be
+        inserted in a document more than once.
+        """
+        return hashlib.md5(self.hash() + os.urandom(8)).hexdigest()[:8]
+
+    def fingerprint(self, converter_cls):
+        """
+        Return a fingerprint of the source `converter_cls` renders for
+        this info. Unlike `hash`, this covers the *contents* of the text
+        and preamble files, and not the scale factor.
+
+        It is stored in the converted node, to detect re-edits that do
+        not change anything. Whether the transform is baked in is not
+        included, as that follows the node on re-edits.
+        """
+        s = "%s\n%s\n%s\n%d\n%s\n%s\n%s" % (
+            converter_cls.__module__, converter_cls.__name__,
+            self.page_width, bool(self.text_to_path), self.precision,
+            self.read_preamble(), self.read_text())
+        return hashlib.md5(s).hexdigest()
+
+    def cache_key(self, converter_cls):
+        """
+        Return a key identifying the output of `converter_cls` for this
+        info in the render cache.
+        """
+        s = "%s\n%d" % (self.fingerprint(converter_cls),
+                        bool(self.bake_transform))
+        return hashlib.md5(s).hexdigest()
+
     #-- Getters
 
     def get_text_encoded(self):
@@ -803,6 +3273,31 @@ class ConvertInfo(object):
             text = text.encode('utf-8')
         return text
 
+    def read_text(self):
+        """
+        Return the Latex code. If the text is a file name,
+        the file content is used instead.
+        """
+        text = self.get_text_encoded()
+        if text and os.path.isfile(text):
+            f = open(text, 'r')
+            try:
+                text = f.read()
+            finally:
+                f.close()
+        return text
+
+    def read_preamble(self):
+        """Return the content of the preamble file, or an empty string"""
+        preamble = ""
+        if self.preamble_file and os.path.isfile(self.preamble_file):
+            f = open(self.preamble_file, 'r')
+            try:
+                preamble = f.read()
+            finally:
+                f.close()
+        return preamble
+
     #-- Serialization
 
     def load_from_settings(self, settings):
@@ -817,11 +3312,14 @@ class ConvertInfo(object):
                 return False
             raise ValueError(x)
 
+        self.settings = settings
         self.preamble_file = settings.get("preamble", str, "")
         self.scale_factor = settings.get("scale", float, 1.0)
         self.page_width = settings.get("page_width", str, "10cm")
-        self.text_to_path = settings.get("text_to_path", str_to_bool, False)
+        self.text_to_path = settings.get("text_to_path", str_to_bool, None)
         self.selected_converter = settings.get("selected_converter", str, "")
+        self.precision = settings.get("precision", int, None)
+        self.bake_transform = settings.get("bake_transform", str_to_bool, False)
 
     def load_from_node(self, node):
         self.has_node = True
@@ -839,6 +3337,9 @@ class ConvertInfo(object):
         self.text = node.attrib.get('{%s}text'%ns, '').decode('string-escape')
         self.preamble_file = node.attrib.get('{%s}preamble'%ns, '').decode('string-escape')
         self.page_width = node.attrib.get('{%s}page_width'%ns, '').decode('string-escape')
+        self.old_fingerprint = node.attrib.get('{%s}fingerprint'%TEXTEXT_NS)
+        # Keep the existing transform meaningful when re-rendering
+        self.bake_transform = node.attrib.get('{%s}baked'%TEXTEXT_NS) == '1'
 
     def load_from_options(self, options):
         # Set from option if option is given
@@ -852,6 +3353,9 @@ class ConvertInfo(object):
         get_opt("scale_factor")
         get_opt("text_to_path")
         get_opt("selected_converter")
+        get_opt("precision")
+        if not self.has_node:
+            get_opt("bake_transform")
 
         if self.text is None:
             self.text = ""
@@ -877,6 +3381,10 @@ class ConvertInfo(object):
             settings.set("text_to_path", self.text_to_path)
         if self.selected_converter is not None:
             settings.set("selected_converter", self.selected_converter)
+        if self.precision is not None:
+            settings.set("precision", self.precision)
+        if not self.has_node:
+            settings.set("bake_transform", int(bool(self.bake_transform)))
         settings.save()
  
     def __str__(self):
@@ -894,17 +3402,44 @@ class LatexConverterBase(object):
     Base class for Latex -> SVG converters
     """
 
+    # External programs used by the converter
+    executables = ['pdflatex']
+
+    # Latex engine run by `tex_to_pdf`, and the type of file it writes
+    latex = 'pdflatex'
+    latex_output = 'pdf'
+
     # --- Public api
     
-    def __init__(self, document):
+    def __init__(self, document, cache=None, formats=None, tex_worker=None,
+                 workspaces=None, jobs=None, shells=None):
         """
         Initialize Latex -> SVG converter.
 
         :Parameters:
           - `document`: Document where the result is to be embedded (read-only)
+          - `cache`: RenderCache for converted fragments, or None
+          - `formats`: FormatCache for precompiled preambles, or None
+          - `tex_worker`: TexWorker to run pdflatex in, or None
+          - `workspaces`: WorkspacePool to take the temporary directory
+            from, or None
+          - `jobs`: JobControl for running the external programs, or None
+          - `shells`: InkscapeShellPool for running Inkscape, or None
         """
-        self.tmp_path = tempfile.mkdtemp()
+        self.workspaces = workspaces
+        self.jobs = jobs
+        self.shells = shells
+        if workspaces is not None:
+            self.tmp_path = workspaces.acquire()
+        else:
+            self.tmp_path = tempfile.mkdtemp()
         self.tmp_base = 'tmp'
+        self.cache = cache
+        self.formats = formats
+        self.tex_worker = tex_worker
+
+        # Unique hash of the info being converted, for generating ids
+        self.hash = None
 
     def convert(self, info):
         """
@@ -921,6 +3456,15 @@ class LatexConverterBase(object):
         """
         raise NotImplementedError
 
+    def convert_many(self, infos, standby=True):
+        """
+        Convert several objects at once. Unless `standby`, no resident
+        Latex process is left waiting for another conversion.
+
+        :Returns: list of XML DOM nodes, in the same order as `infos`
+        """
+        return [self.convert(info) for info in infos]
+
     def check_available(cls):
         """
         :Returns: Check if converter is available, raise RuntimeError if not
@@ -936,12 +3480,57 @@ class LatexConverterBase(object):
             return False
     is_available = classmethod(is_available)
 
+    def get_probe_signature(cls):
+        """
+        :Returns: a hash identifying the executables `check_available`
+                  would look at, for caching its result
+        """
+        parts = [cls.__name__, os.environ.get('PATH', '')]
+        for name in cls.executables:
+            filename = find_executable(name)
+            mtime = None
+            if filename is not None:
+                mtime = os.stat(filename).st_mtime
+            parts.append("%s=%s@%s" % (name, filename, mtime))
+        return hashlib.md5("\n".join(parts)).hexdigest()[:16]
+    get_probe_signature = classmethod(get_probe_signature)
+
     def finish(self):
         """
         Clean up any temporary files
         """
         self.remove_temp_files()
 
+    def exec_command(self, cmd, stage=None, **kw):
+        """
+        Run `cmd` with `exec_command`, in the temporary directory, and
+        under the deadline for `stage`.
+        """
+        kw.setdefault('cwd', self.tmp_path)
+        if self.jobs is not None:
+            kw.setdefault('jobs', self.jobs)
+            kw.setdefault('timeout', self.jobs.get_deadline(stage))
+        return exec_command(cmd, **kw)
+
+    def cancel(self):
+        """
+        Abort the conversion running in another thread, by killing the
+        programs it runs. This also affects other converters sharing
+        the same JobControl.
+        """
+        if self.jobs is not None:
+            self.jobs.cancel()
+
+    def start_stage(self, name, **fields):
+        """
+        Start timing a stage of the conversion. Override to hook into
+        the stages; by default they are recorded by the `Tracer`.
+
+        :Returns: stage, whose ``end`` method is called when it is done
+        """
+        fields['converter'] = self.__class__.__name__
+        return tracer.start(name, **fields)
+
     # --- Internal
 
     def tmp(self, suffix):
@@ -953,27 +3542,30 @@ class LatexConverterBase(object):
                             self.tmp_base + '.' + suffix)
 
     def _get_text(self, info):
-        latex_text = info.text
-        if os.path.isfile(latex_text):
-            f = open(latex_text, 'r')
-            latex_text = f.read()
-            f.close()
-        return latex_text
+        return info.read_text()
 
-    def tex_to_pdf(self, info):
+    def tex_to_pdf(self, info, snippets=None, use_format=True, standby=True):
         """
-        Create a PDF file from latex text
+        Create a PDF file from latex text, or whichever type of file
+        the converter's `latex` engine writes
+
+        If a list of `snippets` is given, they are typeset each on
+        its own page, instead of the text in `info`. Unless `standby`,
+        no resident pdflatex is started for another run.
+
+        :Returns: Latex output
         """
 
         # Read preamble
-        preamble = ""
-        if os.path.isfile(info.preamble_file):
-            f = open(info.preamble_file, 'r')
-            preamble += f.read()
-            f.close()
+        preamble = info.read_preamble()
 
         # If latex_text is a file, use the file content instead
-        latex_text = self._get_text(info)
+        if snippets is None:
+            snippets = [self._get_text(info)]
+        if len(snippets) == 1:
+            latex_text = snippets[0]
+        else:
+            latex_text = join_snippets(snippets)
 
         # Geometry and document class
         width = info.page_width
@@ -989,11 +3581,30 @@ class LatexConverterBase(object):
         if r"\documentclass" in preamble:
             document_class = ""
 
-        # Write the template to a file
-        texwrapper = r"""
+        # Options pass to LaTeX-related commands
+        latex_opts = ['-interaction=nonstopmode', '-halt-on-error']
+
+        # Use a precompiled format for the preamble, if possible
+        fmt = None
+        fmt_opts = []
+        if use_format and self.formats is not None and preamble.strip():
+            timeout = None
+            if self.jobs is not None:
+                timeout = self.jobs.get_deadline('tex_to_pdf')
+            fmt = self.formats.get("\n".join([document_class, preamble,
+                                              geometry]),
+                                   self.latex, self.tmp_path,
+                                   timeout, self.jobs)
+        if fmt is not None:
+            fmt_opts.append('-fmt=%s' % fmt)
+            document_class = preamble = geometry = ""
+
+        # The template
+        texhead = r"""
         %(document_class)s
         %(preamble)s
-        %(geometry)s
+        %(geometry)s""" % locals()
+        texbody = r"""
         \pagestyle{empty}
         \begin{document}
         \noindent
@@ -1001,22 +3612,61 @@ class LatexConverterBase(object):
         \end{document}
         """ % locals()
 
-        f_tex = open(self.tmp('tex'), 'w')
+        # Exec latex: tex -> pdf
+        output = self.tmp(self.latex_output)
+        self.try_remove(output)
+        tex_worker = self.tex_worker
+        if tex_worker is not None and tex_worker.engine != self.latex:
+            tex_worker = None
+        stage = self.start_stage('tex_to_pdf', snippets=len(snippets),
+                                 format=fmt is not None,
+                                 worker=tex_worker is not None)
         try:
-            f_tex.write(texwrapper)
+            try:
+                if tex_worker is not None:
+                    timeout = None
+                    if self.jobs is not None:
+                        timeout = self.jobs.get_deadline('tex_to_pdf')
+                    out = tex_worker.typeset(texhead, texbody, fmt_opts,
+                                             output, timeout, self.jobs,
+                                             standby)
+                else:
+                    write = self.start_stage('write_tex')
+                    f_tex = open(self.tmp('tex'), 'w')
+                    try:
+                        f_tex.write(texhead + texbody)
+                    finally:
+                        f_tex.close()
+                        write.end(bytes=len(texhead) + len(texbody))
+
+                    out = self.exec_command([self.latex, self.tmp('tex')]
+                                            + latex_opts + fmt_opts,
+                                            stage='tex_to_pdf')
+            except RuntimeError, e:
+                stage['failed'] = True
+                if fmt is None or 'format file' not in str(e):
+                    raise
+                out = None
         finally:
-            f_tex.close()
-
-        # Options pass to LaTeX-related commands
-        latex_opts = ['-interaction=nonstopmode', '-halt-on-error']
-
-        # Exec pdflatex: tex -> pdf
-        out = exec_command(['pdflatex', self.tmp('tex')] + latex_opts)
-        if not os.path.exists(self.tmp('pdf')):
-            raise RuntimeError("pdflatex didn't produce output:\n\n" + out)
+            if os.path.exists(output):
+                stage['bytes'] = os.path.getsize(output)
+            stage.end()
+
+        if out is None:
+            # The format is stale (e.g. TeX was upgraded): retry without
+            self.formats.invalidate(fmt)
+            return self.tex_to_pdf(info, snippets, False, standby)
+        if not os.path.exists(output):
+            raise RuntimeError("%s didn't produce output:\n\n%s"
+                               % (self.latex, out))
+        return out
 
     def remove_temp_files(self):
         """Remove temporary files"""
+        if self.workspaces is not None:
+            self.workspaces.release(self.tmp_path)
+            return
+
         base = os.path.join(self.tmp_path, self.tmp_base)
         for filename in glob.glob(base + '*'):
             self.try_remove(filename)
@@ -1036,30 +3686,141 @@ class PdfConverterBase(LatexConverterBase):
 
     text_to_path = True
 
+    # Whether pdf_to_svg can convert a single page of a multi-page PDF
+    supports_pages = False
+
     def convert(self, info):
-        cwd = os.getcwd()
-        try:
-            os.chdir(self.tmp_path)
-            self.tex_to_pdf(info)
-            self.pdf_to_svg()
-        finally:
-            os.chdir(cwd)
-        
-        new_node = self.svg_to_group()
-        if new_node is None:
-            return None
+        return self.convert_many([info])[0]
 
-        if info.scale_factor is not None:
-            new_node.attrib['transform'] = self.get_transform(info.scale_factor)
-        return new_node
+    def convert_many(self, infos, standby=True):
+        """
+        Convert several objects at once. If the converter supports
+        multi-page PDFs, objects sharing a preamble and page width are
+        typeset in a single pdflatex run, one page each. Unless
+        `standby`, no resident pdflatex is left waiting after the last
+        run.
+        """
+        nodes = [None] * len(infos)
+        keys = [None] * len(infos)
+
+        # Group the infos not found in the cache
+        groups = {}
+        group_order = []
+        for j, info in enumerate(infos):
+            if self.cache is not None:
+                keys[j] = info.cache_key(self.__class__)
+                nodes[j] = self.cache.get(keys[j], "%s%s-" % (
+                    ID_PREFIX, info.unique_hash()))
+                tracer.record('cache', converter=self.__class__.__name__,
+                              key=keys[j], hit=nodes[j] is not None)
+                if nodes[j] is not None:
+                    continue
+
+            if (self.supports_pages
+                    and not GLOBAL_DEF_RE.search(info.read_text())):
+                group_key = (info.read_preamble(), info.page_width)
+            else:
+                group_key = j
+            if group_key not in groups:
+                groups[group_key] = []
+                group_order.append(group_key)
+            groups[group_key].append(j)
+
+        # Convert each group
+        for n, group_key in enumerate(group_order):
+            group = groups[group_key]
+            last_group = n == len(group_order) - 1
+            if len(group) > 1:
+                out = self.tex_to_pdf(infos[group[0]],
+                                      [infos[j].read_text() for j in group],
+                                      standby=standby or not last_group)
+                pages = count_pages(out)
+                if pages == len(group):
+                    self.convert_pages(infos, group, nodes, keys)
+                    continue
+
+                # A snippet broke its page (or the page count is not
+                # known), so the pages can't be matched with the objects:
+                # typeset them one by one instead
+                tracer.record('page_mismatch',
+                              converter=self.__class__.__name__,
+                              snippets=len(group), pages=pages)
+
+            for k, j in enumerate(group):
+                last = last_group and k == len(group) - 1
+                self.tex_to_pdf(infos[j], standby=standby or not last)
+                self.convert_pages(infos, [j], nodes, keys)
+
+        baked = '{%s}baked' % TEXTEXT_NS
+        for new_node, info in zip(nodes, infos):
+            if new_node is None or info.scale_factor is None:
+                continue
+            if new_node.attrib.get(baked) == '1':
+                new_node.attrib['transform'] = 'scale(%f,%f)' % (
+                    info.scale_factor, info.scale_factor)
+            else:
+                new_node.attrib['transform'] = \
+                    self.get_transform(info.scale_factor)
+        return nodes
 
-    def pdf_to_svg(self):
-        """Convert the PDF file to a SVG file"""
+    def convert_pages(self, infos, group, nodes, keys):
+        """
+        Convert the typeset PDF to nodes for the objects `group`, given
+        as indices to `infos`: one page each, or the first page for a
+        single object. The nodes are stored in `nodes`, and in the
+        cache under `keys`.
+        """
+        for page, j in enumerate(group):
+            self.hash = infos[j].unique_hash()
+            stage = self.start_stage('pdf_to_svg', page=page + 1)
+            try:
+                if len(group) == 1:
+                    self.pdf_to_svg()
+                else:
+                    self.pdf_to_svg(page + 1)
+            finally:
+                if os.path.exists(self.tmp('svg')):
+                    stage['bytes'] = os.path.getsize(self.tmp('svg'))
+                stage.end()
+
+            stage = self.start_stage('svg_to_group')
+            try:
+                nodes[j] = self.svg_to_group()
+            finally:
+                stage.end()
+            if nodes[j] is not None:
+                stage = self.start_stage('optimize')
+                try:
+                    self.optimize_group(nodes[j], infos[j])
+                finally:
+                    stage.end()
+            if nodes[j] is not None and keys[j] is not None:
+                self.cache.put(keys[j], nodes[j])
+
+    def optimize_group(self, node, info):
+        """
+        Run the optimizer on a converted group, if enabled in `info`.
+
+        The transform baked in is ``get_transform(1.0)``; this relies on
+        ``get_transform(s)`` being ``scale(s)`` applied after it, which
+        holds for all converters.
+        """
+        if info.precision is None and not info.bake_transform:
+            return
+        matrix = None
+        if info.bake_transform:
+            matrix = parse_transform(self.get_transform(1.0))
+        if SvgOptimizer(info.precision).optimize(node, matrix):
+            node.attrib['{%s}baked' % TEXTEXT_NS] = '1'
+
+    def pdf_to_svg(self, page=1):
+        """Convert the given page of the PDF file to a SVG file"""
         raise NotImplementedError
 
-    def get_transform(self, scale_factor):
+    def get_transform(cls, scale_factor):
         """Get a suitable default value for the transform attribute"""
         raise NotImplementedError
+    get_transform = classmethod(get_transform)
 
     def svg_to_group(self):
         """
@@ -1067,28 +3828,53 @@ class PdfConverterBase(LatexConverterBase):
 
         :Returns: <svg:g> node
         """
-        tree = etree.parse(self.tmp('svg'))
-        self.fix_xml_namespace(tree.getroot())
+        root = self.read_svg()
+        for c in root:
+            if c.tag == 'g':
+                return copy.copy(c)
+        return None
+
+    SVG_XMLNS_RE = re.compile(r'(<svg\b[^>]*?)\s+xmlns\s*=\s*'
+                              r'(["\'])http://www\.w3\.org/2000/svg\2')
+
+    def read_svg(self, id_prefix=None):
+        """
+        Parse the SVG file with the SVG namespace stripped, and if
+        `id_prefix` is given, rename the ids to `id_prefix` + running
+        number and rewrite the references to them.
+
+        :Returns: root element
+        """
+        # Drop the default namespace declaration from the root element
+        # while feeding the parser, so that it creates un-namespaced
+        # elements directly instead of them being renamed afterwards
+        parser = etree.XMLParser(huge_tree=True)
+        f = open(self.tmp('svg'), 'rb')
         try:
-            return copy.copy(tree.getroot().xpath('g')[0])
-        except IndexError:
-            return None
+            head = f.read(65536)
+            parser.feed(self.SVG_XMLNS_RE.sub(r'\1', head, 1))
+            while True:
+                chunk = f.read(65536)
+                if not chunk:
+                    break
+                parser.feed(chunk)
+        finally:
+            f.close()
+        root = parser.close()
 
-    def fix_xml_namespace(self, node):
+        # Anything still in the SVG namespace, e.g. with an svg: prefix
         svg = '{%s}' % SVG_NS
-        
-        if node.tag.startswith(svg):
-            node.tag = node.tag[len(svg):]
-        
-        for key in node.attrib.keys():
-            if key.startswith(svg):
-                new_key = key[len(svg):]
-                node.attrib[new_key] = node.attrib[key]
-                del node.attrib[key]
-        
-        for c in node:
-            self.fix_xml_namespace(c)
-    
+        n = len(svg)
+        for el in root.xpath('descendant-or-self::svg:*', namespaces=NSS):
+            el.tag = el.tag[n:]
+        for attr in root.xpath('//@svg:*', namespaces=NSS):
+            el = attr.getparent()
+            name = attr.attrname
+            el.attrib[name[n:]] = el.attrib.pop(name)
+
+        if id_prefix is not None:
+            rename_ids(root, id_prefix)
+        return root
 
 class SkConvert(PdfConverterBase):
     """
@@ -1097,26 +3883,30 @@ class SkConvert(PdfConverterBase):
 
     name = "Skconvert"
     text_to_path = True
+    executables = ['pdflatex', 'pstoedit', 'skconvert']
 
-    def get_transform(self, scale_factor):
+    def get_transform(cls, scale_factor):
         # Correct for SVG units -> points scaling
         scale_factor *= 1.25
         return 'scale(%f,%f)' % (scale_factor, scale_factor)
+    get_transform = classmethod(get_transform)
 
     def pdf_to_svg(self):
         # Options for pstoedit command
         pstoeditOpts = '-dt -ssp -psarg -r9600x9600'.split()
 
         # Exec pstoedit: pdf -> sk
-        exec_command(['pstoedit', '-f', 'sk',
-                      self.tmp('pdf'), self.tmp('sk')]
-                     + pstoeditOpts)
+        self.exec_command(['pstoedit', '-f', 'sk',
+                           self.tmp('pdf'), self.tmp('sk')]
+                          + pstoeditOpts, stage='pdf_to_svg')
         if not os.path.exists(self.tmp('sk')):
             raise RuntimeError("pstoedit didn't produce output")
 
         # Exec skconvert: sk -> svg
-        os.environ['LC_ALL'] = 'C'
-        exec_command(['skconvert', self.tmp('sk'), self.tmp('svg')])
+        env = os.environ.copy()
+        env['LC_ALL'] = 'C'
+        self.exec_command(['skconvert', self.tmp('sk'), self.tmp('svg')],
+                          stage='pdf_to_svg', env=env)
         if not os.path.exists(self.tmp('svg')):
             raise RuntimeError("skconvert didn't produce output")
 
@@ -1136,22 +3926,24 @@ class PstoeditPlotSvg(PdfConverterBase):
 
     name = "Pstoedit"
     text_to_path = True
+    executables = ['pdflatex', 'pstoedit']
 
-    def get_transform(self, scale_factor):
+    def get_transform(cls, scale_factor):
         # Correct for SVG units -> points scaling
         scale_factor *= 1.25
         return 'matrix(%f,0,0,%f,%f,%f)' % (
             scale_factor, -scale_factor,
             -200*scale_factor/1.25, 750*scale_factor/1.25)
+    get_transform = classmethod(get_transform)
 
     def pdf_to_svg(self):
         # Options for pstoedit command
         pstoeditOpts = '-dt -ssp -psarg -r9600x9600'.split()
 
         # Exec pstoedit: pdf -> svg
-        exec_command(['pstoedit', '-f', 'plot-svg',
-                      self.tmp('pdf'), self.tmp('svg')]
-                     + pstoeditOpts)
+        self.exec_command(['pstoedit', '-f', 'plot-svg',
+                           self.tmp('pdf'), self.tmp('svg')]
+                          + pstoeditOpts, stage='pdf_to_svg')
         if not os.path.exists(self.tmp('svg')):
             raise RuntimeError("pstoedit didn't produce output")
 
@@ -1173,52 +3965,22 @@ class Pdf2Svg(PdfConverterBase):
 
     name = "Pdf2Svg"
     text_to_path = True
+    executables = ['pdflatex', 'pdf2svg']
+    supports_pages = True
 
-    def __init__(self, document):
-        PdfConverterBase.__init__(self, document)
-        self.hash = None
-
-    def convert(self, info):
-        # compute hash for generating unique ids for sub-elements
-        self.hash = info.hash()
-        return PdfConverterBase.convert(self, info)
-
-    def pdf_to_svg(self):
-        exec_command(['pdf2svg', self.tmp('pdf'), self.tmp('svg'), '1'])
+    def pdf_to_svg(self, page=1):
+        self.exec_command(['pdf2svg', self.tmp('pdf'), self.tmp('svg'),
+                           str(page)], stage='pdf_to_svg')
 
-    def get_transform(self, scale_factor):
+    def get_transform(cls, scale_factor):
         # Correct for SVG units -> points scaling
         scale_factor *= 1.25
         return 'scale(%f,%f)' % (scale_factor, scale_factor)
+    get_transform = classmethod(get_transform)
 
     def svg_to_group(self):
-        # create xml.dom representation of the TeX file
-        tree = etree.parse(self.tmp('svg'))
-        root = tree.getroot()
-        self.fix_xml_namespace(root)
-
-        href_map = {}
-
-        # Map items to new ids
-        for i, el in enumerate(root.xpath('//*[attribute::id]')):
-            cur_id = el.attrib['id']
-            new_id = "%s%s-%d" % (ID_PREFIX, self.hash, i)
-            href_map['#' + cur_id] = "#" + new_id
-            el.attrib['id'] = new_id
-
-        # Replace hrefs
-        url_re = re.compile('^url\((.*)\)$')
-
-        for el in root.xpath('//*[attribute::xlink:href]', namespaces=NSS):
-            href = el.attrib['{%s}href'%XLINK_NS]
-            el.attrib['{%s}href'%XLINK_NS] = href_map.get(href, href)
-
-        for el in root.xpath('//*[attribute::svg:clip-path]', namespaces=NSS):
-            value = el.attrib['clip-path']
-            m = url_re.match(value)
-            if m:
-                el.attrib['clip-path'] = \
-                    'url(%s)' % href_map.get(m.group(1), m.group(1))
+        # make ids unique within the document
+        root = self.read_svg("%s%s-" % (ID_PREFIX, self.hash))
 
         # Bundle everything in a single group
         master_group = etree.SubElement(root, 'g')
@@ -1234,6 +3996,58 @@ class Pdf2Svg(PdfConverterBase):
     check_available = classmethod(check_available)
 
 
+class DviSvgm(Pdf2Svg):
+    """
+    Convert DVI -> SVG using dvisvgm
+
+    This goes through DVI instead of PDF: the glyphs are converted to
+    paths by dvisvgm, which keeps the outlines in its own cache, and
+    each glyph is defined once and referenced for each use.
+    """
+
+    name = "dvisvgm"
+    text_to_path = True
+    executables = ['latex', 'dvisvgm']
+    supports_pages = True
+
+    latex = 'latex'
+    latex_output = 'dvi'
+
+    def pdf_to_svg(self, page=1):
+        cmd = ['dvisvgm', '--no-fonts', '--page=%d' % page,
+               '--output=%s' % self.tmp('svg')]
+        cache_path = self.get_cache_path()
+        if cache_path is not None:
+            cmd.append('--cache=%s' % cache_path)
+        self.exec_command(cmd + [self.tmp('dvi')], stage='pdf_to_svg')
+
+    def get_cache_path(cls):
+        """
+        :Returns: directory for the dvisvgm glyph cache, or None for
+                  dvisvgm's default
+        """
+        path = os.path.join(get_config_dir(), "textext-dvisvgm")
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                return None
+        return path
+    get_cache_path = classmethod(get_cache_path)
+
+    def check_available(cls):
+        """Check whether latex is found, and dvisvgm sufficiently new"""
+        exec_command(['latex', '--version'])
+        out = exec_command(['dvisvgm', '--version'])
+        m = re.search(r'(\d+)\.(\d+)', out)
+        if not m:
+            raise RuntimeError('dvisvgm could not be located')
+        # --no-fonts appeared in 1.0
+        if int(m.group(1)) < 1:
+            raise RuntimeError('dvisvgm %s.%s found, but it is too old'
+                               % (m.group(1), m.group(2)))
+    check_available = classmethod(check_available)
+
 class Inkscape(PdfConverterBase):
     """
     Convert PDF -> SVG using Inkscape
@@ -1243,20 +4057,56 @@ class Inkscape(PdfConverterBase):
     text_to_path = False
 
     INKSCAPE = os.environ.get('INKSCAPE', 'inkscape')
+    executables = ['pdflatex', INKSCAPE]
 
-    def __init__(self, document):
-        PdfConverterBase.__init__(self, document)
+    def __init__(self, document, **kw):
+        PdfConverterBase.__init__(self, document, **kw)
 
     def pdf_to_svg(self):
-        exec_command([self.INKSCAPE, '--export-plain-svg=%s' % self.tmp('svg'),
-                      self.tmp('pdf')])
+        self.run_inkscape(['--export-plain-svg=%s' % self.tmp('svg'),
+                           self.tmp('pdf')])
+        if not os.path.isfile(self.tmp('svg')):
+            raise RuntimeError("Inkscape didn't produce output")
+
+    def run_inkscape(self, args):
+        """
+        Run Inkscape with the command line arguments `args`, in a
+        resident Inkscape shell if there is a pool of them. Should the
+        shell fail, Inkscape is run on its own instead, as are all later
+        commands of this converter; a command that timed out is not run
+        again.
+        """
+        if self.shells is None:
+            return self.exec_command([self.INKSCAPE] + args,
+                                     stage='pdf_to_svg')
+
+        timeout = jobs = None
+        if self.jobs is not None:
+            jobs = self.jobs
+            timeout = jobs.get_deadline('pdf_to_svg')
+        stage = self.start_stage('exec', command='inkscape --shell',
+                                 args=args)
+        try:
+            try:
+                return self.shells.run(self.INKSCAPE, args, timeout, jobs)
+            except RuntimeError, e:
+                stage['failed'] = True
+                if (isinstance(e, CommandTimeout)
+                        or jobs is not None and jobs.cancelled):
+                    raise
+        finally:
+            stage.end()
+
+        self.shells = None
+        return self.exec_command([self.INKSCAPE] + args, stage='pdf_to_svg')
 
-    def get_transform(self, scale_factor):
+    def get_transform(cls, scale_factor):
         # Correct for SVG units -> points scaling
         scale_factor *= 1.25
         return 'matrix(%f,0,0,-%f,%f,%f)' % (
                 scale_factor, scale_factor,
                 0, 11328.62*scale_factor)
+    get_transform = classmethod(get_transform)
 
     def _get_version(cls):
         out = exec_command([cls.INKSCAPE, '--version'])
@@ -1281,7 +4131,8 @@ class InkscapePath(Inkscape):
     """
     Convert PDF -> SVG using Inkscape, with text-to-path applied first
 
-    This is currently quite slow, as we invoke Inkscape twice.
+    This needs two Inkscape runs; with a resident Inkscape shell, both
+    go to the same process.
     """
 
     name = "Inkscape (+ text-to-path)"
@@ -1292,29 +4143,31 @@ class InkscapePath(Inkscape):
         #    inkscape -z --verb=EditSelectAll --verb=ObjectToPath --verb FileSave
         # so we need to invoke inkscape twice
         shutil.move(self.tmp('pdf'), self.tmp('2.pdf'))
-        exec_command([self.INKSCAPE, '-T',
-                      '--export-pdf=%s' % self.tmp('pdf'),
-                      self.tmp('2.pdf')])
+        self.run_inkscape(['-T', '--export-pdf=%s' % self.tmp('pdf'),
+                           self.tmp('2.pdf')])
         Inkscape.pdf_to_svg(self)
 
 class MatplotlibSVG(PdfConverterBase):
     name = "Matplotlib"
     text_to_path = False
+    executables = []
 
-    def tex_to_pdf(self, info):
-        import matplotlib as mpl
-        mpl.use('svg')
-        import matplotlib.pyplot as plt
+    def tex_to_pdf(self, info, standby=True):
+        # Use the object API: pyplot and matplotlib.use change global state
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_svg import FigureCanvasSVG
 
-        fig = plt.figure()
+        fig = Figure()
+        FigureCanvasSVG(fig)
         fig.patch.set_visible(False)
         fig.text(0., 1., self._get_text(info), ha='left', va='top')
-        plt.savefig(self.tmp('svg'))
+        fig.savefig(self.tmp('svg'))
 
-    def get_transform(self, scale_factor):
+    def get_transform(cls, scale_factor):
         # Correct for SVG units -> points scaling
         scale_factor *= 1.25
         return 'scale(%f,%f)' % (scale_factor, scale_factor)
+    get_transform = classmethod(get_transform)
 
     def pdf_to_svg(self):
         pass
@@ -1327,7 +4180,7 @@ class MatplotlibSVG(PdfConverterBase):
     check_available = classmethod(check_available)
 
 CONVERTERS = [
-    Pdf2Svg, PstoeditPlotSvg, Inkscape, SkConvert, InkscapePath,
+    DviSvgm, Pdf2Svg, PstoeditPlotSvg, Inkscape, SkConvert, InkscapePath,
     MatplotlibSVG,
 ]
 